@@ -0,0 +1,342 @@
+# Benchmarks of the BirdCount inference paths against the implementations they replaced.
+#
+# Usage (from backend/):
+#     python -m BirdCount.model_files.benchmarks                 # stub model, runs anywhere
+#     python -m BirdCount.model_files.benchmarks --model         # the real model, needs its checkpoint
+#     python -m BirdCount.model_files.benchmarks --latency       # per-image latency vs. windows for each precision
+import argparse
+import copy
+import time
+
+import numpy as np
+import torch
+import torch.nn as nn
+import torchvision.transforms.functional as TF
+from torchvision import transforms
+
+from BirdCount.model_files.clusters import (CLUSTER_PARAMETERS, HDBSCAN_MIN_CLUSTER_SIZES, ClusterSets, cluster_points_mod,
+                                            compute_clusters_for_range, fit_HDBSCAN, get_sillouttes_HDBSCAN)
+from BirdCount.model_files.runtime import PRECISIONS, prepare_model
+from BirdCount.model_files.windows import (WINDOW, LatentCache, image_key, sliding_window_density, tile_density,
+                                           window_starts)
+
+
+class StubModel(nn.Module):
+    # Stands in for the counting model with a similar shape of work: 16 px patch tokens through a few 768 wide
+    # layers, then back to (n, 384, 384) density maps that depend on the window content, so any stitching error
+    # shows up
+    def __init__(self, depth=4, seed=0):
+        super().__init__()
+        torch.manual_seed(seed)
+        self.embed = nn.Conv2d(3, 768, 16, 16)
+        self.blocks = nn.Sequential(*(nn.Sequential(nn.Linear(768, 768), nn.GELU()) for _ in range(depth)))
+        self.head = nn.Linear(768, 256)
+        self.calls = 0
+
+    def forward_encoder(self, imgs):
+        self.calls += 1
+        return self.blocks(self.embed(imgs).flatten(2).transpose(1, 2))  # (n, 576, 768)
+
+    def encode_exemplars(self, boxes, shot_num=3):
+        return boxes.flatten(1).mean(1)[:, None, None]  # (n, 1, 1)
+
+    def forward_decoder(self, x, boxes, shot_num=3, shot_tokens=None):
+        y = self.encode_exemplars(boxes, shot_num) if shot_tokens is None else shot_tokens
+        x = self.head(x).transpose(1, 2).reshape(len(x), 256, 24, 24)
+        return nn.functional.pixel_shuffle(x, 16).squeeze(1).abs() * y
+
+    def forward(self, imgs, boxes, shot_num):
+        with torch.no_grad():
+            latent = self.forward_encoder(imgs)
+        return self.forward_decoder(latent, boxes, shot_num)
+
+
+def legacy_density(samples, boxes, model):
+    # The window loop density_map_nomongo used before batching: one forward pass per window, stitched by padding
+    _, _, h, w = samples.shape
+    density_map = torch.zeros([h, w])
+    density_map = density_map.to(samples.device, non_blocking=True)
+    start = 0
+    prev = -1
+    with torch.no_grad():
+        while start + 383 < w:
+            output, = model(samples[:, :, :, start:start + 384], boxes, 3)
+            output = output.squeeze(0)
+            b1 = nn.ZeroPad2d(padding=(start, w - prev - 1, 0, 0))
+            d1 = b1(output[:, 0:prev - start + 1])
+            b2 = nn.ZeroPad2d(padding=(prev + 1, w - start - 384, 0, 0))
+            d2 = b2(output[:, prev - start + 1:384])
+
+            b3 = nn.ZeroPad2d(padding=(0, w - start, 0, 0))
+            density_map_l = b3(density_map[:, 0:start])
+            density_map_m = b1(density_map[:, start:prev + 1])
+            b4 = nn.ZeroPad2d(padding=(prev + 1, 0, 0, 0))
+            density_map_r = b4(density_map[:, prev + 1:w])
+
+            density_map = density_map_l + density_map_r + density_map_m / 2 + d1 / 2 + d2
+
+            prev = start + 383
+            start = start + 128
+            if start + 383 >= w:
+                if start == w - 384 + 128:
+                    break
+                else:
+                    start = w - 384
+    return density_map
+
+
+def legacy_tiles(samples, boxes, model):
+    # The small-object path before batching: 9 tiles upscaled and counted one after another, with the tile maps
+    # stitched for display by misc.make_grid
+    _, _, h, w = samples.shape
+    r_images = []
+    for i in range(3):
+        for j in range(3):
+            r_images.append(TF.crop(samples[0], int(h * i / 3), int(w * j / 3), int(h / 3), int(w / 3)))
+    pred_cnt = 0
+    r_densities = []
+    for r_image in r_images:
+        r_image = transforms.Resize((h, w))(r_image).unsqueeze(0)
+        density_map = legacy_density(r_image, boxes, model)
+        pred_cnt += torch.sum(density_map / 60).item()
+        r_densities += [density_map]
+    rows = [torch.cat((r_densities[i], r_densities[i + 1], r_densities[i + 2]), -1) for i in range(0, 9, 3)]
+    grid = transforms.Resize((h, w))(torch.cat(rows, 0).unsqueeze(0)).squeeze(0)
+    return pred_cnt, r_densities, grid
+
+
+def legacy_clusters(density_map, scale_factors):
+    # compute_clusters_for_range before grid clustering: sklearn DBSCAN on the pixels above each threshold
+    from sklearn.cluster import DBSCAN
+    cluster_centers_sets = []
+    for param in CLUSTER_PARAMETERS:
+        y, x = np.where(density_map > param['threshold'])
+        points = np.array(list(zip(x, y)))
+        cluster_centers = []
+        if points.size:
+            clustering = DBSCAN(eps=param['eps'], min_samples=param['min_samples']).fit(points)
+            for label in np.unique(clustering.labels_):
+                if label != -1:
+                    cluster_centers.append(points[clustering.labels_ == label].mean(axis=0))
+        cluster_centers_sets.append([{'x': int(c[0] * scale_factors['W']), 'y': int(c[1] * scale_factors['H'])}
+                                     for c in cluster_centers])
+    return cluster_centers_sets
+
+
+def legacy_hdbscan(sampled_coordinates, parameters=HDBSCAN_MIN_CLUSTER_SIZES):
+    # cluster_points_mod before the sampled silhouettes: one sklearn HDBSCAN fit and full silhouette score per
+    # min_cluster_size, then a final fit. A single cluster scores 0 instead of raising in silhouette_score
+    from sklearn.cluster import HDBSCAN
+    from sklearn.metrics import silhouette_score
+    sillouttes = []
+    for min_cluster_size in parameters:
+        cluster_labels = HDBSCAN(min_cluster_size=min_cluster_size, copy=True).fit_predict(sampled_coordinates)
+        data = sampled_coordinates[cluster_labels != -1]
+        cluster_labels = cluster_labels[cluster_labels != -1]
+        sillouttes.append(silhouette_score(data, cluster_labels) if len(np.unique(cluster_labels)) > 1 else 0)
+    best_min_cluster_size = parameters[np.argmax(sillouttes)]
+    clusterer = HDBSCAN(min_cluster_size=best_min_cluster_size, store_centers="centroid", copy=True)
+    cluster_labels = clusterer.fit_predict(sampled_coordinates)
+    return best_min_cluster_size, len(np.unique(cluster_labels[cluster_labels != -1])), clusterer.centroids_
+
+
+def synthetic_density(birds, h=WINDOW, w=512, seed=0, background=0.05):
+    # Density map of `birds` Gaussian blobs with random peaks and sizes, plus background noise up to `background`
+    rng = np.random.default_rng(seed)
+    yy, xx = np.mgrid[:h, :w]
+    density = rng.random((h, w)) * background
+    for cx, cy, peak, sigma in zip(rng.random(birds) * w, rng.random(birds) * h, rng.uniform(0.1, 1.5, birds),
+                                   rng.uniform(1, 5, birds)):
+        y0, y1, x0, x1 = int(max(cy - 4 * sigma, 0)), int(cy + 4 * sigma) + 1, int(max(cx - 4 * sigma, 0)), int(cx + 4 * sigma) + 1
+        density[y0:y1, x0:x1] += peak * np.exp(-((xx[y0:y1, x0:x1] - cx) ** 2 + (yy[y0:y1, x0:x1] - cy) ** 2) / (2 * sigma ** 2))
+    return density.astype(np.float32)
+
+
+def timed(fn, n):
+    fn()  # warmup
+    t = time.perf_counter()
+    for _ in range(n):
+        fn()
+    return (time.perf_counter() - t) / n * 1E3
+
+
+def compare_windows(model, widths, device, n=3):
+    # Batched sliding-window density vs. the legacy loop, per image width
+    print(f"{'width':>6} {'windows':>8} {'legacy (ms)':>12} {'batched (ms)':>13} {'max abs diff':>13} {'count diff':>11}")
+    g = torch.Generator().manual_seed(0)
+    boxes = torch.rand(1, 3, 3, 64, 64, generator=g).to(device)
+    ok = True
+    for w in widths:
+        samples = torch.rand(1, 3, WINDOW, w, generator=g).to(device)
+        legacy = legacy_density(samples, boxes, model)
+        batched = sliding_window_density(samples, boxes, model)[0]
+        diff = (legacy - batched).abs().max().item()
+        count_diff = abs(legacy.sum().item() - batched.sum().item()) / 60
+        ok &= torch.allclose(legacy, batched, rtol=1e-5, atol=1e-5)
+        t_legacy = timed(lambda: legacy_density(samples, boxes, model), n)
+        t_batched = timed(lambda: sliding_window_density(samples, boxes, model), n)
+        print(f"{w:>6} {len(window_starts(w)):>8} {t_legacy:>12.1f} {t_batched:>13.1f} {diff:>13.2e} {count_diff:>11.2e}")
+    print(f"batched windows match the legacy stitching: {ok}")
+    return ok
+
+
+def compare_tiles(model, widths, device, n=3):
+    # Batched 3x3 small-object tiles vs. the legacy per-tile loop, per image width
+    print(f"{'width':>6} {'passes':>7} {'legacy (ms)':>12} {'batched (ms)':>13} {'count':>9} {'count diff':>11} "
+          f"{'map count':>10} {'tiles match':>12}")
+    g = torch.Generator().manual_seed(1)
+    boxes = torch.rand(1, 3, 3, 64, 64, generator=g).to(device)
+    ok = True
+    for w in widths:
+        samples = torch.rand(1, 3, WINDOW, w, generator=g).to(device)
+        count, r_densities, _ = legacy_tiles(samples, boxes, model)
+        calls = getattr(model, 'calls', 0)
+        density, densities = tile_density(samples, boxes, model)
+        passes = getattr(model, 'calls', 0) - calls
+        match = torch.allclose(torch.stack(r_densities), densities, rtol=1e-5, atol=1e-5)
+        count_diff = abs(count - densities.sum().item() / 60)
+        ok &= match and count_diff < 1e-3 * max(count, 1)
+        t_legacy = timed(lambda: legacy_tiles(samples, boxes, model), n)
+        t_batched = timed(lambda: tile_density(samples, boxes, model), n)
+        print(f"{w:>6} {passes:>7} {t_legacy:>12.1f} {t_batched:>13.1f} {count:>9.1f} {count_diff:>11.2e} "
+              f"{density.sum().item() / 60:>10.1f} {match!s:>12}")
+    print(f"batched tiles match the legacy tile loop: {ok}")
+    return ok
+
+
+def compare_recount(model, widths, device, n=3):
+    # Recounting an image with new exemplars: uncached vs. with the encoder latents cached by the first count
+    print(f"{'width':>6} {'windows':>8} {'uncached (ms)':>14} {'cached (ms)':>12} {'max abs diff':>13} {'cache MB':>9}")
+    g = torch.Generator().manual_seed(2)
+    ok = True
+    for w in widths:
+        samples = torch.rand(1, 3, WINDOW, w, generator=g).to(device)
+        boxes = [torch.rand(1, 3, 3, 64, 64, generator=g).to(device) for _ in range(n + 3)]  # new exemplars each run
+        cache, key = LatentCache(), image_key(samples)
+        sliding_window_density(samples, boxes[0], model, cache=cache, keys=[key])  # first count fills the cache
+        uncached = sliding_window_density(samples, boxes[1], model)
+        cached = sliding_window_density(samples, boxes[1], model, cache=cache, keys=[key])
+        diff = (uncached - cached).abs().max().item()
+        ok &= torch.allclose(uncached, cached, rtol=1e-5, atol=1e-5)
+        t_uncached = timed(lambda: sliding_window_density(samples, boxes[1], model), n)
+        it = iter(boxes[2:])
+        t_cached = timed(lambda: sliding_window_density(samples, next(it), model, cache=cache, keys=[key]), n)
+        print(f"{w:>6} {len(window_starts(w)):>8} {t_uncached:>14.1f} {t_cached:>12.1f} {diff:>13.2e} "
+              f"{cache.size / 2 ** 20:>9.1f}")
+    print(f"cached recounts match uncached counts: {ok}")
+    return ok
+
+
+def compare_clusters(birds=(10, 100, 500, 2000), n=3):
+    # Grid connected-component cluster sets vs. the legacy DBSCAN sweep on synthetic density maps, and the time of
+    # computing level 3 alone, which is all /model_cluster/ asks for
+    print(f"{'birds':>6} {'pixels':>8} {'DBSCAN (ms)':>12} {'grid (ms)':>10} {'level 3 (ms)':>13} {'clusters':>9} "
+          f"{'identical':>10}")
+    scale_factors = {'W': 1.0, 'H': 1.0}
+    ok = True
+    for i, b in enumerate(birds):
+        density = synthetic_density(b, seed=i)
+        legacy = legacy_clusters(density, scale_factors)
+        fast = compute_clusters_for_range(density, scale_factors)
+        same = legacy == fast and ClusterSets(density, scale_factors).select([3])[3] == legacy[3]
+        ok &= same
+        t_legacy = timed(lambda: legacy_clusters(density, scale_factors), n)
+        t_fast = timed(lambda: compute_clusters_for_range(density, scale_factors), n)
+        t_level = timed(lambda: ClusterSets(density, scale_factors).get(3), n)
+        pixels = int((density > CLUSTER_PARAMETERS[-1]['threshold']).sum())
+        print(f"{b:>6} {pixels:>8} {t_legacy:>12.1f} {t_fast:>10.1f} {t_level:>13.1f} {sum(map(len, fast)):>9} "
+              f"{same!s:>10}")
+    print(f"grid cluster sets match DBSCAN: {ok}")
+    return ok
+
+
+def compare_hdbscan(birds=(5, 20, 100, 300, 1000), n=3, num_samples=1000):
+    # HDBSCAN min_cluster_size search with sampled silhouettes and the best fit reused vs. full silhouettes and a
+    # final fit, on points sampled from synthetic density maps without background, like the model's. Both fit every
+    # size the same way, only the sampled silhouettes may pick another size; 'exact' checks that the centroids match
+    # the legacy ones when the size is the same
+    print(f"{'birds':>6} {'legacy (ms)':>12} {'size':>5} {'clusters':>9} {'sampled (ms)':>13} {'size':>5} "
+          f"{'clusters':>9} {'exact':>6}")
+    ok = True
+    for i, b in enumerate(birds):
+        density = synthetic_density(b, seed=i, background=0)
+        sampled = np.searchsorted(np.cumsum(density.ravel() / density.sum()),
+                                  np.random.default_rng(i).random(num_samples))
+        points = np.column_stack(np.unravel_index(sampled, density.shape))
+        legacy_size, legacy_count, legacy_centers = legacy_hdbscan(points)
+        t_legacy = timed(lambda: legacy_hdbscan(points), n)
+        count, centers = cluster_points_mod(points)
+        t_sampled = timed(lambda: cluster_points_mod(points), n)
+        sillouttes = get_sillouttes_HDBSCAN(points, HDBSCAN_MIN_CLUSTER_SIZES,
+                                            fit_HDBSCAN(points, HDBSCAN_MIN_CLUSTER_SIZES))
+        size = HDBSCAN_MIN_CLUSTER_SIZES[np.argmax(sillouttes)]
+        exact = size != legacy_size or (count == legacy_count and np.allclose(centers, legacy_centers))
+        ok &= exact
+        print(f"{b:>6} {t_legacy:>12.1f} {legacy_size:>5} {legacy_count:>9} {t_sampled:>13.1f} {size:>5} {count:>9} "
+              f"{exact!s:>6}")
+    print(f"same fits as sklearn HDBSCAN per size: {ok}")
+    return ok
+
+
+def latency(model, widths, device, precisions=PRECISIONS, n=3):
+    # Per-image latency against the number of windows for each precision, with the count deviation from fp32
+    print(f"{'width':>6} {'windows':>8} " + " ".join(f"{p + ' (ms)':>10} {'ms/window':>9} {'count dev':>9}"
+                                                   for p in precisions))
+    g = torch.Generator().manual_seed(3)
+    boxes = torch.rand(1, 3, 3, 64, 64, generator=g).to(device)
+    models = {p: prepare_model(copy.deepcopy(model), device, p) for p in precisions}
+    for w in widths:
+        samples = torch.rand(1, 3, WINDOW, w, generator=g).to(device)
+        windows = len(window_starts(w))
+        reference = None
+        row = f"{w:>6} {windows:>8} "
+        for p, m in models.items():
+            t = timed(lambda: sliding_window_density(samples, boxes, m, precision=p), n)
+            count = sliding_window_density(samples, boxes, m, precision=p).sum().item() / 60
+            reference = count if reference is None else reference
+            dev = abs(count - reference) / max(abs(reference), 1e-9)
+            row += f"{t:>10.1f} {t / max(windows, 1):>9.1f} {dev:>9.2%} "
+        print(row)
+
+
+def parse_opt():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model', action='store_true', help='use the real counting model instead of a stub')
+    parser.add_argument('--widths', nargs='+', type=int, default=[384, 400, 512, 640, 768, 1000, 1536, 2048],
+                        help='image widths for the sliding-window comparison')
+    parser.add_argument('--tile-widths', nargs='+', type=int, default=[512, 640, 1000],
+                        help='image widths for the small-object tile comparison')
+    parser.add_argument('--latency', action='store_true', help='per-image latency vs. window count per precision')
+    parser.add_argument('--clusters', action='store_true', help='cluster extraction vs. the DBSCAN sweep only')
+    parser.add_argument('--hdbscan', action='store_true', help='HDBSCAN size search vs. one fit per size only')
+    parser.add_argument('--precisions', nargs='+', default=list(PRECISIONS), choices=PRECISIONS,
+                        help='precisions for --latency')
+    parser.add_argument('--n', type=int, default=3, help='timed runs per configuration')
+    opt = parser.parse_args()
+    if opt.n < 1:
+        parser.error('--n must be at least 1')
+    return opt
+
+
+def main(opt):
+    if opt.model:
+        from BirdCount.model_files import demomodified
+        model, device = demomodified.model, demomodified.device
+    else:
+        model, device = StubModel().eval(), torch.device('cpu')
+    if opt.latency:
+        latency(model, opt.widths, device, opt.precisions, opt.n)
+        return
+    if opt.clusters:
+        compare_clusters(n=opt.n)
+        return
+    if opt.hdbscan:
+        compare_hdbscan(n=opt.n)
+        return
+    compare_windows(model, opt.widths, device, opt.n)
+    compare_tiles(model, opt.tile_widths, device, opt.n)
+    compare_recount(model, opt.widths, device, opt.n)
+
+
+if __name__ == "__main__":
+    main(parse_opt())
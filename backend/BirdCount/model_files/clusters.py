@@ -0,0 +1,247 @@
+# Cluster centers of thresholded density maps.
+#
+# compute_clusters_for_range thresholds a density map at 10 levels and clusters the pixels above each level. On pixel
+# coordinates, DBSCAN with min_samples <= 2 is the connected components of the graph linking pixels within eps of each
+# other (with min_samples 2, pixels without a neighbour are noise), so grid_clusters labels them with scipy.ndimage
+# and links components with one vectorized pass per neighbour offset over their edge pixels, instead of a neighbour
+# search around every pixel. Clusters are ordered like DBSCAN labels,
+# by their first pixel in row-major order, and centers are member means, so the output is the same as DBSCAN's.
+# Larger min_samples fall back to DBSCAN. benchmarks.py compares both.
+#
+# ClusterSets computes the sets on demand: the thresholds are nested, so the masks of all levels are kept as one
+# uint8 map of how many thresholds each pixel exceeds, and a set is only clustered when it is first asked for.
+# ClusterCache keeps the ClusterSets of recently analyzed images, so other levels can be fetched later without
+# running the model again.
+#
+# compute_clusters_for_range_mod clusters points sampled from a density map with HDBSCAN, picking the
+# min_cluster_size with the best silhouette score. Every size is still its own sklearn fit (min_samples defaults to
+# min_cluster_size, so the hierarchies differ), but the silhouettes are scored on a sample of the clustered points
+# from one distance matrix, and the best fit is reused for the centroids instead of fitted again.
+import os
+import threading
+from collections import OrderedDict
+
+import numpy as np
+from scipy import ndimage
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+from sklearn.cluster import DBSCAN, HDBSCAN
+
+from BirdCount.model_files.runtime import CLUSTER_PARAMETERS, parse_levels  # defined there for the API
+
+CLUSTER_CACHE_SIZE = int(os.getenv("BIRDCOUNT_CLUSTER_CACHE_SIZE", 64))  # images whose cluster sets are kept
+
+# min_cluster_size candidates of the HDBSCAN clustering, points sampled from the density map and the size of the
+# subsample the silhouette score of each candidate is computed on
+HDBSCAN_MIN_CLUSTER_SIZES = [5, 10, 15, 30, 45, 50, 60, 70, 85, 100]
+HDBSCAN_SAMPLES = 1000
+SILHOUETTE_SAMPLE = 500
+
+
+def neighbour_offsets(eps):
+    # Offsets (dy, dx) of the pixels within eps of a pixel, one of each +/- pair
+    r = int(np.floor(eps))
+    return [(dy, dx) for dy in range(r + 1) for dx in range(-r, r + 1)
+            if dy * dy + dx * dx <= eps * eps and (dy > 0 or dx > 0)]
+
+
+def grid_clusters(mask, eps, min_samples):
+    # DBSCAN clustering of the set pixels of a 2D boolean mask for min_samples <= 2.
+    # Returns the (n, 2) points as (x, y) in row-major order and their labels, -1 for noise
+    y, x = np.nonzero(mask)
+    points = np.column_stack((x, y))
+    if len(points) == 0:
+        return points, np.zeros(0, np.int64)
+    if eps < 1:
+        labels = np.arange(len(points))
+    elif eps < np.sqrt(2):
+        labels = ndimage.label(mask)[0][y, x]  # 4-connectivity
+    else:
+        # eps covers the 8-neighbours, so 8-connected components are joined when any of their pixels are within eps.
+        # Walking from a pixel towards one of another component, each step getting closer, leaves the component at a
+        # pixel with an unset 4-neighbour: it is enough to link those edge pixels
+        base, n = ndimage.label(mask, structure=np.ones((3, 3)))
+        ey, ex = np.nonzero(mask & ~ndimage.binary_erosion(mask, border_value=1))
+        r = int(np.floor(eps))
+        index = np.zeros((mask.shape[0] + 2 * r, mask.shape[1] + 2 * r), base.dtype)  # padded, no bounds checks
+        index[ey + r, ex + r] = own = base[ey, ex]
+        rows, cols = [np.zeros(0, base.dtype)], [np.zeros(0, base.dtype)]
+        for dy, dx in neighbour_offsets(eps):
+            neighbour = index[ey + r + dy, ex + r + dx]
+            found = (neighbour > 0) & (neighbour != own)
+            rows.append(own[found])
+            cols.append(neighbour[found])
+        rows, cols = np.concatenate(rows), np.concatenate(cols)
+        graph = coo_matrix((np.ones(len(rows), bool), (rows, cols)), shape=(n + 1, n + 1))
+        labels = connected_components(graph, directed=False)[1][base[y, x]]
+    if min_samples >= 2:
+        labels = np.where(np.bincount(labels)[labels] < 2, -1, labels)  # no neighbour, not a core point
+    keep = labels >= 0
+    _, first, inverse = np.unique(labels[keep], return_index=True, return_inverse=True)
+    labels[keep] = np.argsort(np.argsort(first))[inverse]  # number clusters by their first pixel, like DBSCAN
+    return points, labels
+
+
+def dbscan_clusters(mask, eps, min_samples):
+    # grid_clusters with sklearn DBSCAN, for any min_samples
+    y, x = np.nonzero(mask)
+    points = np.column_stack((x, y))
+    if len(points) == 0:
+        return points, np.zeros(0, np.int64)
+    return points, DBSCAN(eps=eps, min_samples=min_samples).fit(points).labels_
+
+
+def threshold_density_map(density_map, threshold):
+    # Apply threshold
+    binary_mask = density_map > threshold
+    return binary_mask
+
+
+def cluster_points(binary_mask, eps, min_samples):
+    # Centers [x, y] of the clusters of the set pixels of binary_mask (array or tensor), in label order
+    if not isinstance(binary_mask, np.ndarray):
+        binary_mask = binary_mask.cpu().numpy()
+    fn = grid_clusters if min_samples <= 2 else dbscan_clusters
+    points, labels = fn(binary_mask, eps, min_samples)
+    keep = labels >= 0
+    if not keep.any():
+        return []
+    counts = np.bincount(labels[keep])
+    cx = np.bincount(labels[keep], weights=points[keep, 0]) / counts
+    cy = np.bincount(labels[keep], weights=points[keep, 1]) / counts
+    return list(np.column_stack((cx, cy)))
+
+
+class ClusterSets:
+    # Cluster centers of one density map per parameter set, each computed when first requested
+    def __init__(self, density_map, scale_factors, parameters=CLUSTER_PARAMETERS):
+        if not isinstance(density_map, np.ndarray):
+            density_map = density_map.detach().cpu().numpy()
+        self.scale_factors = scale_factors
+        self.parameters = parameters
+        # Compared in the density map's dtype, like threshold_density_map
+        self.thresholds = np.unique([param['threshold'] for param in parameters]).astype(density_map.dtype)
+        # Number of thresholds each pixel is above: pixel > thresholds[i] exactly when rank > i
+        self.rank = np.searchsorted(self.thresholds, density_map).astype(np.uint8)
+        self.sets = {}
+        self.lock = threading.Lock()
+
+    def mask(self, threshold):
+        # threshold_density_map of one of the parameter sets' thresholds
+        return self.rank > np.searchsorted(self.thresholds, np.asarray(threshold, self.thresholds.dtype))
+
+    def get(self, level):
+        # Cluster centers {'x', 'y'} of parameter set `level`, scaled by scale_factors {'W', 'H'}
+        with self.lock:
+            if level not in self.sets:
+                param = self.parameters[level]
+                cluster_centers = cluster_points(self.mask(param['threshold']), param['eps'], param['min_samples'])
+                self.sets[level] = [{'x': int(center[0] * self.scale_factors['W']),
+                                     'y': int(center[1] * self.scale_factors['H'])} for center in cluster_centers]
+            return self.sets[level]
+
+    def select(self, levels=None):
+        # List with the centers of every parameter set, None for those not in levels (default: all of them)
+        levels = range(len(self.parameters)) if levels is None else set(levels)
+        return [self.get(level) if level in levels else None for level in range(len(self.parameters))]
+
+
+class ClusterCache:
+    # LRU cache of the ClusterSets of the last `size` images, keyed by image key
+    def __init__(self, size=CLUSTER_CACHE_SIZE):
+        self.size = size
+        self.sets = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            sets = self.sets.get(key)
+            if sets is not None:
+                self.sets.move_to_end(key)
+            return sets
+
+    def put(self, key, sets):
+        with self.lock:
+            self.sets[key] = sets
+            self.sets.move_to_end(key)
+            while len(self.sets) > self.size:
+                self.sets.popitem(last=False)
+
+
+def compute_clusters_for_range(density_map, scale_factors, parameters=CLUSTER_PARAMETERS):
+    # One list of cluster centers {'x', 'y'} per parameter set, scaled by scale_factors {'W', 'H'}
+    return ClusterSets(density_map, scale_factors, parameters).select()
+
+
+def sampled_silhouette(distances, labels, sample_size=SILHOUETTE_SAMPLE, seed=0):
+    # sklearn's silhouette_score of the clustered points (noise excluded) on a random subsample of at most
+    # sample_size points, from their (n, n) distances. 0 when there are fewer than 2 clusters
+    keep = np.flatnonzero(labels >= 0)
+    if len(keep) > sample_size:
+        keep = np.sort(np.random.default_rng(seed).choice(keep, sample_size, replace=False))
+    clusters, labels = np.unique(labels[keep], return_inverse=True)
+    if not 2 <= len(clusters) < len(keep):
+        return 0
+    members = np.eye(len(clusters))[labels]  # one-hot (m, k)
+    sizes = members.sum(axis=0)
+    mean = distances[np.ix_(keep, keep)] @ members / sizes  # mean distance of each point to each cluster
+    own = np.arange(len(keep)), labels
+    a = mean[own] * sizes[labels] / np.maximum(sizes[labels] - 1, 1)  # without the point itself
+    mean[own] = np.inf
+    b = mean.min(axis=1)
+    with np.errstate(invalid='ignore'):
+        score = np.nan_to_num((b - a) / np.maximum(a, b))
+    return np.mean(np.where(sizes[labels] > 1, score, 0))
+
+
+def pairwise_distances(points):
+    # (n, n) euclidean distances of points (n, d)
+    points = np.asarray(points, dtype=np.float64)
+    squared = np.zeros((len(points), len(points)))
+    for x in points.T:
+        squared += (x[:, None] - x[None]) ** 2
+    return np.sqrt(squared)
+
+
+def fit_HDBSCAN(data, min_cluster_params):
+    # One HDBSCAN fit (centroids stored) per min_cluster_size in min_cluster_params
+    return [HDBSCAN(min_cluster_size=min_cluster_size, store_centers="centroid", copy=True).fit(data)
+            for min_cluster_size in min_cluster_params]
+
+
+def get_sillouttes_HDBSCAN(data, min_cluster_params, clusterers=None):
+    # Silhouette score of the HDBSCAN clustering of data for each min_cluster_size in min_cluster_params
+    if len(data) <= 2:
+        return [0] * len(min_cluster_params)
+    if clusterers is None:
+        clusterers = fit_HDBSCAN(data, min_cluster_params)
+    distances = pairwise_distances(data)
+    return [sampled_silhouette(distances, clusterer.labels_) for clusterer in clusterers]
+
+
+def cluster_points_mod(sampled_coordinates, parameters=HDBSCAN_MIN_CLUSTER_SIZES):
+    # Number of clusters and their centroids for the min_cluster_size in parameters with the best silhouette score
+    if len(sampled_coordinates) <= 2:
+        return 0, np.zeros((0, sampled_coordinates.shape[1]))
+    clusterers = fit_HDBSCAN(sampled_coordinates, parameters)
+    sillouttes = get_sillouttes_HDBSCAN(sampled_coordinates, parameters, clusterers)
+    # find the best silloutte score parameters, its fit is reused
+    clusterer = clusterers[np.argmax(sillouttes)]
+    return int(clusterer.labels_.max() + 1), clusterer.centroids_
+
+
+def compute_clusters_for_range_mod(density_map, scale_factors, num_samples=HDBSCAN_SAMPLES, seed=None):
+    # Clusters num_samples points drawn from density_map with HDBSCAN, see cluster_points_mod. Returns the number of
+    # clusters and cluster_centers_sets, a list with the one set of centers {'x', 'y'} scaled by scale_factors
+    if not isinstance(density_map, np.ndarray):
+        density_map = density_map.detach().cpu().numpy()
+    density_map_normalized = density_map / np.sum(density_map)
+    cumulative_density = np.cumsum(density_map_normalized.ravel())
+    random_values = np.random.default_rng(seed).random(num_samples)
+    sampled_indices = np.searchsorted(cumulative_density, random_values)
+    y_coords, x_coords = np.unravel_index(sampled_indices, density_map.shape)
+    sampled_coordinates = np.column_stack((y_coords, x_coords))
+    count, cluster_centers = cluster_points_mod(sampled_coordinates, HDBSCAN_MIN_CLUSTER_SIZES)
+    cluster_centers_sets = [[{'x': int(center[1] * scale_factors['W']), 'y': int(center[0] * scale_factors['H'])}
+                             for center in cluster_centers]]
+    return count, cluster_centers_sets
@@ -7,21 +7,25 @@ import torch.nn as nn
 import torchvision
 from torchvision import transforms
 import torchvision.transforms.functional as TF
+from torchvision.ops import roi_align
 import matplotlib.pyplot as plt
 import matplotlib
 matplotlib.use('Agg')
 import timm
 from BirdCount.model_files.utils import save_image_to_gridfs
 assert "0.4.5" <= timm.__version__ <= "0.4.9"  # version check
-from sklearn.cluster import DBSCAN
+from BirdCount.model_files.clusters import (CLUSTER_CACHE_SIZE, ClusterCache, ClusterSets, cluster_points,
+                                            cluster_points_mod, compute_clusters_for_range,
+                                            compute_clusters_for_range_mod, get_sillouttes_HDBSCAN,
+                                            threshold_density_map)
 import numpy as np
 from BirdCount.model_files.misc import make_grid
 from BirdCount.model_files import models_mae_cross
+from BirdCount.model_files.runtime import ANALYSIS_OUTPUTS, DEVICE, inference, prepare_model
+from BirdCount.model_files.windows import LATENT_CACHE_MB, LatentCache, image_key, sliding_window_density, tile_density
 import matplotlib.cm as cm
-device = torch.device('cuda')
+device = DEVICE  # BIRDCOUNT_DEVICE, see runtime.py
 import warnings  
-from sklearn.metrics import silhouette_samples, silhouette_score
-from sklearn.cluster import HDBSCAN
 global model, model_without_ddp
 warnings.filterwarnings('ignore')
 
@@ -52,9 +56,9 @@ def plot_heatmap(density_map, count, buffer):
 def load_model(checkpoint_path):
     global model, model_without_ddp
     model = models_mae_cross.__dict__['mae_vit_base_patch16'](norm_pix_loss='store_true')
-    checkpoint = torch.load(checkpoint_path, map_location='cuda')
+    checkpoint = torch.load(checkpoint_path, map_location=device)
     model.load_state_dict(checkpoint['model'], strict=False)
-    model.eval()
+    model = prepare_model(model, device)
     model_without_ddp = model
     print("Loaded the new model" , checkpoint_path)
     return model
@@ -124,7 +128,6 @@ def load_image_nomongo(image):
         [[209, 125], [742, 150]],
         [[602, 168], [758, 200]]
 ]
-    boxes = list()
     rects = list()
     for bbox in bboxes:
         x1 = int(bbox[0][0] * scale_factor_W)
@@ -132,12 +135,11 @@ def load_image_nomongo(image):
         x2 = int(bbox[1][0] * scale_factor_W)
         y2 = int(bbox[1][1] * scale_factor_H)
         rects.append([y1, x1, y2, x2])
-        bboxnew = image[:, y1:y2 + 1, x1:x2 + 1]
-        bboxnew = transforms.Resize((64, 64))(bboxnew)
-        boxes.append(bboxnew.numpy())
 
-    boxes = np.array(boxes)
-    boxes = torch.Tensor(boxes)
+    # Crop and resize all exemplars to 64x64 in one op, clipped to the image like slicing would
+    rois = torch.tensor([[x1, y1, min(x2 + 1, new_W), min(y2 + 1, new_H)] for y1, x1, y2, x2 in rects],
+                        dtype=torch.float)
+    boxes = roi_align(image.unsqueeze(0), [rois], output_size=64, aligned=True)
 
     return image, boxes, rects
 
@@ -182,102 +184,36 @@ def load_image_with_boxes(file_id,fs,boxes1):
 
     return image, boxes, rects
 
-def run_one_image_nomongo(samples, boxes, pos, model, orig_image_size):
-    _, _, h, w = samples.shape
-    orig_h, orig_w = orig_image_size
-
-    # Calculate the scaling factors
-    print("test : ",orig_h, orig_w, h, w)
-    scale_factor_H = orig_h / h
-    scale_factor_W = orig_w / w
+def density_map_nomongo(samples, boxes, pos, model, key=None):
+    # Sliding-window density map of samples (1, 3, h, w). When an exemplar box is tiny the image is counted as 3x3
+    # upscaled tiles instead, see tile_density. key is image_key(samples), computed here when not passed in.
+    # Returns density_map, pred_cnt, elapsed time, s_cnt and the tile density maps
+    if key is None and latent_cache is not None:
+        key = image_key(samples)
+    with inference(samples.device):
+        shot_tokens = model.encode_exemplars(boxes, 3)  # shared by every window and tile
+    r_densities = []
     s_cnt = 0
     for rect in pos:
         if rect[2] - rect[0] < 10 and rect[3] - rect[1] < 10:
             s_cnt += 1
     if s_cnt >= 1:
-        r_densities = []
-        r_images = []
-        r_images.append(TF.crop(samples[0], 0, 0, int(h / 3), int(w / 3)))  # 1
-        r_images.append(TF.crop(samples[0], 0, int(w / 3), int(h / 3), int(w / 3)))  # 3
-        r_images.append(TF.crop(samples[0], 0, int(w * 2 / 3), int(h / 3), int(w / 3)))  # 7
-        r_images.append(TF.crop(samples[0], int(h / 3), 0, int(h / 3), int(w / 3)))  # 2
-        r_images.append(TF.crop(samples[0], int(h / 3), int(w / 3), int(h / 3), int(w / 3)))  # 4
-        r_images.append(TF.crop(samples[0], int(h / 3), int(w * 2 / 3), int(h / 3), int(w / 3)))  # 8
-        r_images.append(TF.crop(samples[0], int(h * 2 / 3), 0, int(h / 3), int(w / 3)))  # 5
-        r_images.append(TF.crop(samples[0], int(h * 2 / 3), int(w / 3), int(h / 3), int(w / 3)))  # 6
-        r_images.append(TF.crop(samples[0], int(h * 2 / 3), int(w * 2 / 3), int(h / 3), int(w / 3)))  # 9
-
-        pred_cnt = 0
         with measure_time() as et:
-            for r_image in r_images:
-                r_image = transforms.Resize((h, w))(r_image).unsqueeze(0)
-                density_map = torch.zeros([h, w])
-                density_map = density_map.to(device, non_blocking=True)
-                start = 0
-                prev = -1
-                with torch.no_grad():
-                    while start + 383 < w:
-                        output, = model(r_image[:, :, :, start:start + 384], boxes, 3)
-                        output = output.squeeze(0)
-                        b1 = nn.ZeroPad2d(padding=(start, w - prev - 1, 0, 0))
-                        d1 = b1(output[:, 0:prev - start + 1])
-                        b2 = nn.ZeroPad2d(padding=(prev + 1, w - start - 384, 0, 0))
-                        d2 = b2(output[:, prev - start + 1:384])
-
-                        b3 = nn.ZeroPad2d(padding=(0, w - start, 0, 0))
-                        density_map_l = b3(density_map[:, 0:start])
-                        density_map_m = b1(density_map[:, start:prev + 1])
-                        b4 = nn.ZeroPad2d(padding=(prev + 1, 0, 0, 0))
-                        density_map_r = b4(density_map[:, prev + 1:w])
-
-                        density_map = density_map_l + density_map_r + density_map_m / 2 + d1 / 2 + d2
-
-                        prev = start + 383
-                        start = start + 128
-                        if start + 383 >= w:
-                            if start == w - 384 + 128:
-                                break
-                            else:
-                                start = w - 384
-
-                pred_cnt += torch.sum(density_map / 60).item()
-                r_densities += [density_map]
+            density_map, r_densities = tile_density(samples, boxes, model, cache=latent_cache, key=key,
+                                                      shot_tokens=shot_tokens)
+            pred_cnt = torch.sum(r_densities / 60).item()
     else:
-        density_map = torch.zeros([h, w])
-        density_map = density_map.to(device, non_blocking=True)
-        start = 0
-        prev = -1
         with measure_time() as et:
-            with torch.no_grad():
-                while start + 383 < w:
-                    output, = model(samples[:, :, :, start:start + 384], boxes, 3)
-                    output = output.squeeze(0)
-                    b1 = nn.ZeroPad2d(padding=(start, w - prev - 1, 0, 0))
-                    d1 = b1(output[:, 0:prev - start + 1])
-                    b2 = nn.ZeroPad2d(padding=(prev + 1, w - start - 384, 0, 0))
-                    d2 = b2(output[:, prev - start + 1:384])
-
-                    b3 = nn.ZeroPad2d(padding=(0, w - start, 0, 0))
-                    density_map_l = b3(density_map[:, 0:start])
-                    density_map_m = b1(density_map[:, start:prev + 1])
-                    b4 = nn.ZeroPad2d(padding=(prev + 1, 0, 0, 0))
-                    density_map_r = b4(density_map[:, prev + 1:w])
-
-                    density_map = density_map_l + density_map_r + density_map_m / 2 + d1 / 2 + d2
-
-                    prev = start + 383
-                    start = start + 128
-                    if start + 383 >= w:
-                        if start == w - 384 + 128:
-                            break
-                        else:
-                            start = w - 384
-
+            density_map = sliding_window_density(samples, boxes, model, cache=latent_cache, keys=[key],
+                                                 shot_tokens=shot_tokens)[0]
             pred_cnt = torch.sum(density_map / 60).item()
 
+    return density_map, pred_cnt, et.duration, s_cnt, r_densities
+
+def blend_heatmap(samples, density_map):
     # Normalize density_map for visualization
-    density_map = density_map.to('cuda')
-    samples = samples.to('cuda')
+    density_map = density_map.to(device)
+    samples = samples.to(device)
 
     # Normalize density_map for visualization
     density_normalized = density_map / density_map.max()
@@ -290,7 +226,7 @@ def run_one_image_nomongo(samples, boxes, pos, model, orig_image_size):
     density_rgb = density_colormap[...,:3]
 
     # Convert to tensor and move to GPU
-    density_rgb_tensor = torch.from_numpy(density_rgb).float().permute(2, 0, 1).to('cuda')
+    density_rgb_tensor = torch.from_numpy(density_rgb).float().permute(2, 0, 1).to(device)
 
     # Resize density_rgb_tensor to match the size of the original image
     density_resized = TF.resize(density_rgb_tensor, samples.shape[2:])
@@ -301,7 +237,20 @@ def run_one_image_nomongo(samples, boxes, pos, model, orig_image_size):
     blended_image = (1 - alpha) * samples[0] + alpha * density_resized
     
     # Clamp the values to be between 0 and 1
-    blended_image_clamped = torch.clamp(blended_image, 0, 1)
+    return torch.clamp(blended_image, 0, 1)
+
+def run_one_image_nomongo(samples, boxes, pos, model, orig_image_size):
+    _, _, h, w = samples.shape
+    orig_h, orig_w = orig_image_size
+
+    # Calculate the scaling factors
+    print("test : ",orig_h, orig_w, h, w)
+    scale_factor_H = orig_h / h
+    scale_factor_W = orig_w / w
+    density_map, pred_cnt, duration, s_cnt, r_densities = density_map_nomongo(samples, boxes, pos, model)
+
+    blended_image_clamped = blend_heatmap(samples, density_map)
+    samples = samples.to(device)
     
     # Save or display the blended image
     # Convert blended_image_clamped to PIL image to save or display
@@ -329,8 +278,7 @@ def run_one_image_nomongo(samples, boxes, pos, model, orig_image_size):
             box_map[min(rect[0], fig.shape[1] - 1), min(rect[1] + i, fig.shape[2] - 1)] = 10
             box_map[min(rect[2], fig.shape[1] - 1), min(rect[1] + i, fig.shape[2] - 1)] = 10
     box_map = box_map.unsqueeze(0).repeat(3, 1, 1)
-    pred = density_map.unsqueeze(0).repeat(3, 1, 1) if s_cnt < 1 \
-        else make_grid(r_densities, h, w).unsqueeze(0).repeat(3, 1, 1)
+    pred = density_map.unsqueeze(0).repeat(3, 1, 1)
     fig = fig + box_map + pred / 2
     fig = torch.clamp(fig, 0, 1)
     heatmap_buffer = BytesIO()
@@ -344,7 +292,7 @@ def run_one_image_nomongo(samples, boxes, pos, model, orig_image_size):
     # This will be useful for sending data to the frontend
     
      # Include cluster_centers_json in the return statement
-    return pred_cnt_ceil, et.duration, blended_image_clamped, density_map, pred_cnt
+    return pred_cnt_ceil, duration, blended_image_clamped, density_map, pred_cnt
 
 def run_one_image(samples, boxes, pos, model,fs, orig_image_size):
     _, _, h, w = samples.shape
@@ -354,94 +302,12 @@ def run_one_image(samples, boxes, pos, model,fs, orig_image_size):
     print("test : ",orig_h, orig_w, h, w)
     scale_factor_H = orig_h / h
     scale_factor_W = orig_w / w
-    s_cnt = 0
-    for rect in pos:
-        if rect[2] - rect[0] < 10 and rect[3] - rect[1] < 10:
-            s_cnt += 1
-    if s_cnt >= 1:
-        r_densities = []
-        r_images = []
-        r_images.append(TF.crop(samples[0], 0, 0, int(h / 3), int(w / 3)))  # 1
-        r_images.append(TF.crop(samples[0], 0, int(w / 3), int(h / 3), int(w / 3)))  # 3
-        r_images.append(TF.crop(samples[0], 0, int(w * 2 / 3), int(h / 3), int(w / 3)))  # 7
-        r_images.append(TF.crop(samples[0], int(h / 3), 0, int(h / 3), int(w / 3)))  # 2
-        r_images.append(TF.crop(samples[0], int(h / 3), int(w / 3), int(h / 3), int(w / 3)))  # 4
-        r_images.append(TF.crop(samples[0], int(h / 3), int(w * 2 / 3), int(h / 3), int(w / 3)))  # 8
-        r_images.append(TF.crop(samples[0], int(h * 2 / 3), 0, int(h / 3), int(w / 3)))  # 5
-        r_images.append(TF.crop(samples[0], int(h * 2 / 3), int(w / 3), int(h / 3), int(w / 3)))  # 6
-        r_images.append(TF.crop(samples[0], int(h * 2 / 3), int(w * 2 / 3), int(h / 3), int(w / 3)))  # 9
-
-        pred_cnt = 0
-        with measure_time() as et:
-            for r_image in r_images:
-                r_image = transforms.Resize((h, w))(r_image).unsqueeze(0)
-                density_map = torch.zeros([h, w])
-                density_map = density_map.to(device, non_blocking=True)
-                start = 0
-                prev = -1
-                with torch.no_grad():
-                    while start + 383 < w:
-                        output, = model(r_image[:, :, :, start:start + 384], boxes, 3)
-                        output = output.squeeze(0)
-                        b1 = nn.ZeroPad2d(padding=(start, w - prev - 1, 0, 0))
-                        d1 = b1(output[:, 0:prev - start + 1])
-                        b2 = nn.ZeroPad2d(padding=(prev + 1, w - start - 384, 0, 0))
-                        d2 = b2(output[:, prev - start + 1:384])
-
-                        b3 = nn.ZeroPad2d(padding=(0, w - start, 0, 0))
-                        density_map_l = b3(density_map[:, 0:start])
-                        density_map_m = b1(density_map[:, start:prev + 1])
-                        b4 = nn.ZeroPad2d(padding=(prev + 1, 0, 0, 0))
-                        density_map_r = b4(density_map[:, prev + 1:w])
-
-                        density_map = density_map_l + density_map_r + density_map_m / 2 + d1 / 2 + d2
-
-                        prev = start + 383
-                        start = start + 128
-                        if start + 383 >= w:
-                            if start == w - 384 + 128:
-                                break
-                            else:
-                                start = w - 384
-
-                pred_cnt += torch.sum(density_map / 60).item()
-                r_densities += [density_map]
-    else:
-        density_map = torch.zeros([h, w])
-        density_map = density_map.to(device, non_blocking=True)
-        start = 0
-        prev = -1
-        with measure_time() as et:
-            with torch.no_grad():
-                while start + 383 < w:
-                    output, = model(samples[:, :, :, start:start + 384], boxes, 3)
-                    output = output.squeeze(0)
-                    b1 = nn.ZeroPad2d(padding=(start, w - prev - 1, 0, 0))
-                    d1 = b1(output[:, 0:prev - start + 1])
-                    b2 = nn.ZeroPad2d(padding=(prev + 1, w - start - 384, 0, 0))
-                    d2 = b2(output[:, prev - start + 1:384])
-
-                    b3 = nn.ZeroPad2d(padding=(0, w - start, 0, 0))
-                    density_map_l = b3(density_map[:, 0:start])
-                    density_map_m = b1(density_map[:, start:prev + 1])
-                    b4 = nn.ZeroPad2d(padding=(prev + 1, 0, 0, 0))
-                    density_map_r = b4(density_map[:, prev + 1:w])
-
-                    density_map = density_map_l + density_map_r + density_map_m / 2 + d1 / 2 + d2
-
-                    prev = start + 383
-                    start = start + 128
-                    if start + 383 >= w:
-                        if start == w - 384 + 128:
-                            break
-                        else:
-                            start = w - 384
-
-            pred_cnt = torch.sum(density_map / 60).item()
+    # Same batched, cached windows (and BIRDCOUNT_PRECISION) as the nomongo path
+    density_map, pred_cnt, duration, s_cnt, r_densities = density_map_nomongo(samples, boxes, pos, model)
 
     # Normalize density_map for visualization
-    density_map = density_map.to('cuda')
-    samples = samples.to('cuda')
+    density_map = density_map.to(device)
+    samples = samples.to(device)
 
     # Normalize density_map for visualization
     density_normalized = density_map / density_map.max()
@@ -454,7 +320,7 @@ def run_one_image(samples, boxes, pos, model,fs, orig_image_size):
     density_rgb = density_colormap[...,:3]
 
     # Convert to tensor and move to GPU
-    density_rgb_tensor = torch.from_numpy(density_rgb).float().permute(2, 0, 1).to('cuda')
+    density_rgb_tensor = torch.from_numpy(density_rgb).float().permute(2, 0, 1).to(device)
 
     # Resize density_rgb_tensor to match the size of the original image
     density_resized = TF.resize(density_rgb_tensor, samples.shape[2:])
@@ -508,118 +374,14 @@ def run_one_image(samples, boxes, pos, model,fs, orig_image_size):
     # This will be useful for sending data to the frontend
     
      # Include cluster_centers_json in the return statement
-    return pred_cnt, et.duration, str(blended_image_file_id), density_map
+    return pred_cnt, duration, str(blended_image_file_id), density_map
     
     
 ##########################################################################################################
-def compute_clusters_for_range(density_map, scale_factors):
-    cluster_centers_sets = []
-    # Define sets of parameters for thresholds, eps, and min_samples
-    parameters = [
-        {'threshold': 0.999, 'eps': 0.5, 'min_samples': 1},
-        {'threshold': 0.9, 'eps': 1, 'min_samples': 2},
-        {'threshold': 0.8, 'eps': 2, 'min_samples': 2},
-        {'threshold': 0.7, 'eps': 3, 'min_samples': 2},
-        {'threshold': 0.6, 'eps': 4, 'min_samples': 2},
-        {'threshold': 0.5, 'eps': 5, 'min_samples': 2},
-        {'threshold': 0.4, 'eps': 6, 'min_samples': 2},
-        {'threshold': 0.3, 'eps': 7, 'min_samples': 2},
-        {'threshold': 0.2, 'eps': 8, 'min_samples': 2},
-        {'threshold': 0.1, 'eps': 9, 'min_samples': 2},
-    ]
-    
-    for param in parameters:
-        binary_mask = threshold_density_map(density_map, param['threshold'])
-        cluster_centers = cluster_points(binary_mask, eps=param['eps'], min_samples=param['min_samples'])
-        # Adjust cluster centers based on scale_factors if necessary
-        adjusted_centers = [{'x': int(center[0] * scale_factors['W']), 'y': int(center[1] * scale_factors['H'])} for center in cluster_centers]
-        cluster_centers_sets.append(adjusted_centers)
-    
-    return cluster_centers_sets
-
-def threshold_density_map(density_map, threshold):
-    # Apply threshold
-    binary_mask = density_map > threshold
-    return binary_mask
-
-def cluster_points(binary_mask, eps, min_samples):
-    # Ensure binary_mask is on CPU before using numpy functions
-    binary_mask = binary_mask.cpu().numpy()
-
-    # Find coordinates of potential locations
-    y, x = np.where(binary_mask)
-    points = np.array(list(zip(x, y)))
-    print(points)
-    print(x, y)
-
-    # Check if points array is empty
-    if points.size == 0:
-        print("No points to cluster")
-        return []  # or handle this case as appropriate
-
-    # Apply DBSCAN clustering
-    clustering = DBSCAN(eps=eps, min_samples=min_samples).fit(points)
-    cluster_centers = []
-    for label in np.unique(clustering.labels_):
-        if label != -1:  # Ignore noise points
-            members = points[clustering.labels_ == label]
-            center = members.mean(axis=0)
-            cluster_centers.append(center)
-    
-    return cluster_centers
-#####################################################################################################################################
-def compute_clusters_for_range_mod(density_map, scale_factors):
-    cluster_centers_sets = []
-    # Define sets of parameters for thresholds, eps, and min_samples
-    
+# compute_clusters_for_range, threshold_density_map and cluster_points are in clusters.py
 
-    density_map = density_map.cpu().numpy()
-    density_map_normalized = density_map / np.sum(density_map)
-    cumulative_density = np.cumsum(density_map_normalized.ravel())
-    num_samples = 1000
-    random_values = np.random.rand(num_samples)
-    sampled_indices = np.searchsorted(cumulative_density, random_values)
-    sampled_points = np.unravel_index(sampled_indices, density_map.shape)
-    x_coords, y_coords = sampled_points
-    sampled_coordinates = np.column_stack((x_coords, y_coords))
-    montecarlo_op = np.zeros_like(density_map)
-    for x, y in zip(x_coords, y_coords):
-        montecarlo_op[x, y] += 1
-    parameters = [5, 10, 15, 30, 45, 50, 60, 70, 85, 100]
-    count, cluster_centers = cluster_points_mod(sampled_coordinates, parameters)
-    # Adjust cluster centers based on scale_factors if necessary    
-    return count, cluster_centers_sets
-
-def get_sillouttes_HDBSCAN(data, min_cluster_params):
-    silhouette_avg = []
-    if len(data) <= 2:
-        return [0] * len(min_cluster_params)
-    for min_cluster_size in min_cluster_params:
-        clusterer = HDBSCAN(min_cluster_size=min_cluster_size)
-        cluster_labels = clusterer.fit_predict(data)
-        #remove noise data with label -1
-        datanew = data[cluster_labels != -1]
-        cluster_labels = cluster_labels[cluster_labels != -1]
-        if len(np.unique(cluster_labels)) < 1:
-            silhouette_avg.append(0)
-            continue
-        score = silhouette_score(datanew, cluster_labels)
-        silhouette_avg.append(score)
-    return silhouette_avg
-
-def cluster_points_mod(sampled_coordinates, parameters):
-    sillouttes = get_sillouttes_HDBSCAN(sampled_coordinates, parameters)
-    # find the best silloutte score parameters
-    best_min_cluster_size = parameters[np.argmax(sillouttes)]
-
-    clusterer = HDBSCAN(min_cluster_size=best_min_cluster_size, store_centers="centroid")
-    cluster_labels = clusterer.fit_predict(sampled_coordinates)
-    cluster_centers = clusterer.centroids_
-    #remove noise data with label -1
-    data = sampled_coordinates[cluster_labels != -1]
-    cluster_labels = cluster_labels[cluster_labels != -1]
-    return len(np.unique(cluster_labels)), cluster_centers
-    
+#####################################################################################################################################
+# compute_clusters_for_range_mod, get_sillouttes_HDBSCAN and cluster_points_mod are in clusters.py
 
 #####################################################################################################################################
 
@@ -631,11 +393,13 @@ model_without_ddp = model
 from pathlib import Path
 
 checkpoint_path = Path(__file__).resolve().parent / 'pth/original.pth'
-checkpoint = torch.load(checkpoint_path, map_location='cuda')
+checkpoint = torch.load(checkpoint_path, map_location=device)
 model_without_ddp.load_state_dict(checkpoint['model'], strict=False)
 # print("Resume checkpoint %s" % './checkpoint-400.pth')
 
-model.eval()
+model = prepare_model(model, device)  # eval mode, channels-last and BIRDCOUNT_PRECISION on CPU
+latent_cache = LatentCache() if LATENT_CACHE_MB > 0 else None  # encoder latents of recently counted windows
+cluster_cache = ClusterCache() if CLUSTER_CACHE_SIZE > 0 else None  # cluster sets of recently analyzed images
 
 def run_demo_with_boxes(file_id, fs ,boxes1, checkpoint_path=None):
     if not checkpoint_path:
@@ -675,7 +439,16 @@ def run_demo(file_id, fs ,checkpoint_path=None):
 
     return pred_cnt, elapsed_time, heatmap_file_id, cluster_centers_sets, orig_image_size
 
-def run_demo_image_nomongo(image):
+def analyze_image(image, outputs=ANALYSIS_OUTPUTS, cluster_levels=None):
+    # Runs the counting model once on a PIL image and computes only the requested outputs from its density map:
+    #   count: 'count' (float) and 'count_int' (rounded up)
+    #   grid: 'grid_counts' of the 3x3 subgrids and 'grid' as [(int, decimal part), ...]
+    #   clusters: 'clusters', the cluster centers sets of compute_clusters_for_range, only those at the indices in
+    #             cluster_levels (default: all) are computed and the others are None
+    #   heatmap: 'heatmap', the image blended with the density map as a (3, h, w) tensor
+    # 'image_size' (h, w) of the model input, which the density map and cluster centers refer to, and
+    # 'elapsed_time' are always included. The cluster sets of recent images are cached, so asking for clusters
+    # alone of an image seen before does not run the model (elapsed_time is then 0)
     basewidth = 1000
     wpercent = (basewidth / float(image.size[0]))
     hsize = int((float(image.size[1]) * float(wpercent)))
@@ -684,14 +457,13 @@ def run_demo_image_nomongo(image):
     samples = samples.unsqueeze(0).to(device, non_blocking=True)
     boxes = boxes.unsqueeze(0).to(device, non_blocking=True)
     orig_image_size = samples.shape[2:]  # Capture the original image size
-    # Now, run_one_image returns the density_map as well
-    pred_cnt_int, elapsed_time, heatmap_file, density_map, pred_cnt_flt = run_one_image_nomongo(samples, boxes, pos, model, orig_image_size)
-
-    # Compute scale factors based on the original image size and the processed size
-    scale_factors = {'W': orig_image_size[1]/density_map.shape[1], 'H': orig_image_size[0]/density_map.shape[0]}
-
-    # Generate multiple sets of cluster centers
-    cluster_centers_sets = compute_clusters_for_range(density_map, scale_factors)
+    key = image_key(samples) if latent_cache is not None or cluster_cache is not None else None
+    cluster_sets = cluster_cache.get(key) if cluster_cache is not None and 'clusters' in outputs else None
+    if cluster_sets is not None and set(outputs) == {'clusters'}:
+        return {'image_size': tuple(orig_image_size), 'elapsed_time': 0.0,
+                'clusters': cluster_sets.select(cluster_levels)}
+    density_map, _, elapsed_time, _, _ = density_map_nomongo(samples, boxes, pos, model, key)
+    result = {'image_size': tuple(orig_image_size), 'elapsed_time': elapsed_time}
 
     density_map_height = density_map.shape[0]
     density_map_width = density_map.shape[1]
@@ -704,18 +476,40 @@ def run_demo_image_nomongo(image):
             subgrid_count = torch.sum(subgrid / 60).item()
             subgrid_counts.append(subgrid_count)
 
-    # subgridcnts are floats, put into format of [(int, float), (int, float), ...] where int is rounded (not floored) and flt is decimal part
-    subgrid_counts_with_error = []
-    for subgrid_count in subgrid_counts:
-        subgrid_count_int = int(subgrid_count)
-        subgrid_count_flt = subgrid_count - subgrid_count_int
-        subgrid_counts_with_error.append((subgrid_count_int, subgrid_count_flt))
-    pred_cnt_flt =  sum(subgrid_counts)
-    pred_cnt_int = int(pred_cnt_flt + 0.99)
-    
+    if 'count' in outputs:
+        result['count'] = sum(subgrid_counts)
+        result['count_int'] = int(result['count'] + 0.99)
+
+    if 'grid' in outputs:
+        # subgridcnts are floats, put into format of [(int, float), (int, float), ...] where int is rounded (not floored) and flt is decimal part
+        subgrid_counts_with_error = []
+        for subgrid_count in subgrid_counts:
+            subgrid_count_int = int(subgrid_count)
+            subgrid_count_flt = subgrid_count - subgrid_count_int
+            subgrid_counts_with_error.append((subgrid_count_int, subgrid_count_flt))
+        result['grid_counts'] = subgrid_counts
+        result['grid'] = subgrid_counts_with_error
+
+    if 'clusters' in outputs:
+        # Compute scale factors based on the original image size and the processed size
+        scale_factors = {'W': orig_image_size[1]/density_map.shape[1], 'H': orig_image_size[0]/density_map.shape[0]}
 
+        # Cluster sets are computed on demand and kept for later requests with other levels
+        if cluster_sets is None:
+            cluster_sets = ClusterSets(density_map, scale_factors)
+            if cluster_cache is not None:
+                cluster_cache.put(key, cluster_sets)
+        result['clusters'] = cluster_sets.select(cluster_levels)
 
-    return pred_cnt_int, elapsed_time, heatmap_file, cluster_centers_sets, orig_image_size, subgrid_counts, pred_cnt_flt, subgrid_counts_with_error
+    if 'heatmap' in outputs:
+        result['heatmap'] = blend_heatmap(samples, density_map)
+
+    return result
+
+def run_demo_image_nomongo(image):
+    result = analyze_image(image)
+    return (result['count_int'], result['elapsed_time'], result['heatmap'], result['clusters'], result['image_size'],
+            result['grid_counts'], result['count'], result['grid'])
 
 def run_demo_clusters(file_id, fs ,checkpoint_path=None):
     if not checkpoint_path:
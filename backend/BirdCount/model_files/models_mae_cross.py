@@ -148,11 +148,9 @@ class SupervisedMAE(nn.Module):
 
         return x
 
-    def forward_decoder(self, x, y_, shot_num=3):
-        # embed tokens
-        x = self.decoder_embed(x)
-        # add pos embed
-        x = x + self.decoder_pos_embed
+    def encode_exemplars(self, y_, shot_num=3):
+        # Shot tokens [N,shot_num,C] of the exemplar crops y_ [N,3,3,64,64]. They only depend on the exemplars, so
+        # they can be computed once and passed to forward_decoder for every window of an image
 
         # Exemplar encoder
         y_ = y_.transpose(0,1) # y_ [N,3,3,64,64]->[3,N,3,64,64]
@@ -172,10 +170,20 @@ class SupervisedMAE(nn.Module):
             y1.append(yi.squeeze(-1).squeeze(-1)) # yi [N,C,1,1]->[N,C]       
             
         if shot_num > 0:
-            y = torch.cat(y1,dim=0).reshape(shot_num,N,C).to(x.device)
+            y = torch.cat(y1,dim=0).reshape(shot_num,N,C)
         else:
-            y = self.shot_token.repeat(y_.shape[1],1).unsqueeze(0).to(x.device)
-        y = y.transpose(0,1) # y [3,N,C]->[N,3,C]
+            y = self.shot_token.repeat(y_.shape[1],1).unsqueeze(0)
+        return y.transpose(0,1) # y [3,N,C]->[N,3,C]
+
+    def forward_decoder(self, x, y_, shot_num=3, shot_tokens=None):
+        # shot_tokens: encode_exemplars(y_, shot_num) computed beforehand, y_ is not used then
+        # embed tokens
+        x = self.decoder_embed(x)
+        # add pos embed
+        x = x + self.decoder_pos_embed
+
+        y = self.encode_exemplars(y_, shot_num) if shot_tokens is None else shot_tokens
+        y = y.to(x.device)
         
         # apply Transformer blocks
         for blk in self.decoder_blocks:
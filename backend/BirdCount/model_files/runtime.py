@@ -0,0 +1,67 @@
+# Device, precision and thread settings of BirdCount inference.
+#
+# BIRDCOUNT_DEVICE picks the device (default: cuda when available, else cpu). BIRDCOUNT_PRECISION is one of
+#   fp32  full precision (default)
+#   bf16  bfloat16 autocast, fast on CPUs with AVX512-BF16/AMX and on recent GPUs
+#   int8  dynamic int8 quantization of the linear layers, CPU only
+# On CPU the model is converted to channels-last for its convolutions. torch's intra-op thread count is process-wide
+# and shared with the detector, so it is set once by the API (INFERENCE_THREADS), not here. benchmarks.py --latency
+# reports the latency and count deviation of each precision.
+#
+# The analysis outputs and cluster parameter sets are defined here rather than in demomodified.py and clusters.py so
+# the API can validate requests without importing the model or sklearn
+import contextlib
+import os
+
+import torch
+import torch.nn as nn
+
+PRECISIONS = ("fp32", "bf16", "int8")
+ANALYSIS_OUTPUTS = ("count", "grid", "clusters", "heatmap")  # what demomodified.analyze_image can compute
+# Thresholds, eps and min_samples of the 10 cluster sets of clusters.py, from fine to coarse
+CLUSTER_PARAMETERS = [
+    {'threshold': 0.999, 'eps': 0.5, 'min_samples': 1},
+    {'threshold': 0.9, 'eps': 1, 'min_samples': 2},
+    {'threshold': 0.8, 'eps': 2, 'min_samples': 2},
+    {'threshold': 0.7, 'eps': 3, 'min_samples': 2},
+    {'threshold': 0.6, 'eps': 4, 'min_samples': 2},
+    {'threshold': 0.5, 'eps': 5, 'min_samples': 2},
+    {'threshold': 0.4, 'eps': 6, 'min_samples': 2},
+    {'threshold': 0.3, 'eps': 7, 'min_samples': 2},
+    {'threshold': 0.2, 'eps': 8, 'min_samples': 2},
+    {'threshold': 0.1, 'eps': 9, 'min_samples': 2},
+]
+
+DEVICE = torch.device(os.getenv("BIRDCOUNT_DEVICE") or ("cuda" if torch.cuda.is_available() else "cpu"))
+PRECISION = os.getenv("BIRDCOUNT_PRECISION", "fp32").lower()
+
+
+def prepare_model(model, device=DEVICE, precision=PRECISION):
+    # Moves a model to device in eval mode and applies the CPU optimizations for precision
+    if precision not in PRECISIONS:
+        raise ValueError(f"BirdCount precision must be one of {', '.join(PRECISIONS)}, not {precision}")
+    if precision == "int8" and device.type != "cpu":
+        raise ValueError("int8 BirdCount inference is only supported on CPU")
+    model = model.to(device).eval()
+    if device.type == "cpu":
+        model = model.to(memory_format=torch.channels_last)
+        if precision == "int8":
+            model = torch.ao.quantization.quantize_dynamic(model, {nn.Linear}, dtype=torch.qint8)
+    return model
+
+
+def parse_levels(levels, parameters=CLUSTER_PARAMETERS):
+    # Sorted unique parameter set indices from a comma separated string or a list, ValueError when out of range
+    if isinstance(levels, str):
+        levels = [int(level) for level in levels.split(",") if level.strip()]
+    levels = sorted(set(int(level) for level in levels))
+    if not levels or levels[0] < 0 or levels[-1] >= len(parameters):
+        raise ValueError(f"cluster levels must be between 0 and {len(parameters) - 1}")
+    return levels
+
+
+@contextlib.contextmanager
+def inference(device=DEVICE, precision=PRECISION):
+    # Context for running the model: inference mode, with bf16 autocast when precision is bf16
+    with torch.inference_mode(), torch.autocast(device.type, dtype=torch.bfloat16, enabled=precision == "bf16"):
+        yield
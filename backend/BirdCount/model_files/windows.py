@@ -0,0 +1,176 @@
+# Sliding-window density maps: every 384 px window of an image goes through the model in one batch and the window
+# outputs are blended into the density map with precomputed per-column weights.
+#
+# The weights reproduce the original stitching loop, which added each window to the running map by averaging the
+# overlap with what was already there (old / 2 + new / 2) and copying the rest. A column covered by windows
+# k1 < k2 < ... < km ends up as
+#     out_k1 / 2^(m-1) + out_k2 / 2^(m-1) + out_k3 / 2^(m-2) + ... + out_km / 2
+# i.e. a window's weight halves for every later window covering the column, and every window but the first to
+# cover the column starts at 1/2. The weights of a column sum to 1, so counts are unchanged.
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+from torchvision import transforms
+
+from BirdCount.model_files.runtime import PRECISION, inference
+
+WINDOW = 384  # model input width
+STRIDE = 128
+WINDOW_BATCH = int(os.getenv("BIRDCOUNT_WINDOW_BATCH", 32))  # windows per forward pass, as GPU memory allows
+LATENT_CACHE_MB = float(os.getenv("BIRDCOUNT_LATENT_CACHE_MB", 512))  # encoder latent cache budget, 0 = disabled
+
+_weights = {}
+
+
+def window_starts(w):
+    # Start columns of the windows over a w px wide image: every STRIDE px, the last one aligned to the right edge
+    starts = []
+    start = 0
+    while start + WINDOW - 1 < w:
+        starts.append(start)
+        start += STRIDE
+        if start + WINDOW - 1 >= w:
+            if start == w - WINDOW + STRIDE:
+                break
+            start = w - WINDOW
+    return starts
+
+
+def window_weights(w, device):
+    # (n, 1, WINDOW) blending weights of the n windows of a w px wide image, cached per width and device
+    key = (w, str(device))
+    if key not in _weights:
+        starts = window_starts(w)
+        weights = np.zeros((len(starts), 1, WINDOW), np.float32)
+        later = np.zeros(w, int)  # windows after the current one covering each column
+        for k in reversed(range(len(starts))):
+            s = starts[k]
+            first = np.arange(s, s + WINDOW) > (starts[k - 1] + WINDOW - 1 if k else -1)
+            weights[k, 0] = 0.5 ** later[s:s + WINDOW] * np.where(first, 1.0, 0.5)
+            later[s:s + WINDOW] += 1
+        _weights[key] = torch.from_numpy(weights).to(device)
+    return _weights[key]
+
+
+def image_key(image):
+    # Content hash of an image tensor, the latent cache key of its windows
+    return hashlib.blake2b(image.detach().cpu().numpy().tobytes(), digest_size=16).hexdigest()
+
+
+class LatentCache:
+    # LRU cache of the encoder latents of single windows, keyed by (image key, window start) and limited to `budget`
+    # bytes. The encoder only sees the window, not the exemplars, so recounting an image with other exemplars or for
+    # other outputs only reruns the decoder
+    def __init__(self, budget=LATENT_CACHE_MB * 2 ** 20):
+        self.budget = budget
+        self.size = 0
+        self.latents = OrderedDict()
+        self.lock = threading.Lock()  # the count scheduler may run batches in several threads
+        self.hits = self.misses = 0
+
+    def get(self, key):
+        with self.lock:
+            latent = self.latents.get(key)
+            if latent is None:
+                self.misses += 1
+            else:
+                self.latents.move_to_end(key)
+                self.hits += 1
+            return latent
+
+    def put(self, key, latent):
+        nbytes = latent.numel() * latent.element_size()
+        if nbytes > self.budget:
+            return
+        with self.lock:
+            old = self.latents.pop(key, None)
+            if old is not None:
+                self.size -= old.numel() * old.element_size()
+            self.latents[key] = latent
+            self.size += nbytes
+            while self.size > self.budget:
+                _, old = self.latents.popitem(last=False)
+                self.size -= old.numel() * old.element_size()
+
+    def clear(self):
+        with self.lock:
+            self.latents.clear()
+            self.size = 0
+
+
+def encode_windows(model, crop, keys, cache, stack=torch.stack):
+    # Encoder latents of the windows with cache keys `keys`; crop(j) returns window j, only misses are encoded
+    latents = [cache.get(key) for key in keys]
+    missing = [j for j, latent in enumerate(latents) if latent is None]
+    if missing:
+        encoded = model.forward_encoder(stack([crop(j) for j in missing]))
+        for j, latent in zip(missing, encoded):
+            latents[j] = latent.clone()  # not a view, which would keep the whole batch alive
+            cache.put(keys[j], latents[j])
+    return torch.stack(latents)
+
+
+def sliding_window_density(images, boxes, model, shot_num=3, max_batch=WINDOW_BATCH, cache=None, keys=None,
+                           shot_tokens=None, precision=PRECISION):
+    # Density maps (b, h, w) of images (b, 3, h, w) with exemplars boxes (1, 3, 3, 64, 64). All windows of all images
+    # are run in batches of up to max_batch. Images narrower than a window get an all zero density map.
+    # The exemplars are encoded once, or not at all when their shot_tokens are passed in.
+    # With a LatentCache and per image keys, window latents are looked up and only the decoder runs on hits.
+    # The model runs under runtime.inference with the given precision
+    b, _, h, w = images.shape
+    density = torch.zeros((b, h, w), device=images.device)
+    starts = window_starts(w)
+    if not starts:
+        return density
+    weights = window_weights(w, images.device)
+    windows = [(i, k) for i in range(b) for k in range(len(starts))]
+
+    memory_format = torch.channels_last if images.device.type == "cpu" else torch.contiguous_format
+
+    def crop(n):
+        i, k = chunk[n]
+        return images[i, :, :, starts[k]:starts[k] + WINDOW]
+
+    def stack(crops):
+        return torch.stack(crops).contiguous(memory_format=memory_format)
+
+    with inference(images.device, precision):
+        if shot_tokens is None:
+            shot_tokens = model.encode_exemplars(boxes, shot_num)
+        for j in range(0, len(windows), max_batch):
+            chunk = windows[j:j + max_batch]
+            if cache is None:
+                latents = model.forward_encoder(stack([crop(n) for n in range(len(chunk))]))
+            else:
+                latents = encode_windows(model, crop, [(keys[i], starts[k]) for i, k in chunk], cache, stack)
+            output = model.forward_decoder(latents, None, shot_num,
+                                           shot_tokens=shot_tokens.expand(len(chunk), -1, -1))  # (n, WINDOW, WINDOW)
+            for (i, k), out in zip(chunk, output):
+                density[i, :, starts[k]:starts[k] + WINDOW] += out.float() * weights[k]
+    return density
+
+
+def tile_density(image, boxes, model, grid=3, max_batch=WINDOW_BATCH, cache=None, key=None, shot_tokens=None,
+                 precision=PRECISION):
+    # Small-object mode: image (1, 3, h, w) is cut into grid x grid tiles, each upscaled to the full image size and
+    # counted with the windows of all tiles batched together. Every tile's density map is shrunk back and placed at
+    # its tile, scaled by the area ratio so it keeps its count; pixels no tile covers stay zero.
+    # Returns the (h, w) density map of the image and the (grid * grid, h, w) tile density maps in row-major order.
+    # key is the image's latent cache key and shot_tokens the encoded exemplars, see sliding_window_density
+    _, _, h, w = image.shape
+    th, tw = int(h / grid), int(w / grid)
+    offsets = [(int(h * i / grid), int(w * j / grid)) for i in range(grid) for j in range(grid)]
+    tiles = torch.stack([image[0, :, y:y + th, x:x + tw] for y, x in offsets])
+    keys = [(key, grid, t) for t in range(grid * grid)]
+    densities = sliding_window_density(transforms.Resize((h, w))(tiles), boxes, model, max_batch=max_batch,
+                                       cache=cache, keys=keys, shot_tokens=shot_tokens, precision=precision)
+    placed = F.adaptive_avg_pool2d(densities.unsqueeze(1), (th, tw)).squeeze(1) * (h * w / (th * tw))
+    density = torch.zeros((h, w), device=image.device)
+    for (y, x), tile in zip(offsets, placed):
+        density[y:y + th, x:x + tw] = tile
+    return density, densities
@@ -7,6 +7,7 @@ Format                      | `export.py --include`         | Model
 PyTorch                     | -                             | yolov5s.pt
 TorchScript                 | `torchscript`                 | yolov5s.torchscript
 ONNX                        | `onnx`                        | yolov5s.onnx
+ONNX INT8                   | `onnx --int8`                 | yolov5s-int8.onnx
 OpenVINO                    | `openvino`                    | yolov5s_openvino_model/
 TensorRT                    | `engine`                      | yolov5s.engine
 CoreML                      | `coreml`                      | yolov5s.mlmodel
@@ -66,8 +67,9 @@ if platform.system() != 'Windows':
 
 from models.experimental import attempt_load
 from models.yolo import Detect
-from utils.dataloaders import LoadImages
-from utils.general import (LOGGER, check_dataset, check_img_size, check_requirements, check_version, colorstr,
+from utils.augmentations import letterbox
+from utils.dataloaders import IMG_FORMATS, LoadImages
+from utils.general import (LOGGER, check_dataset, check_img_size, check_requirements, check_version, colorstr, cv2,
                            file_size, print_args, url2file)
 from utils.torch_utils import select_device
 
@@ -168,13 +170,49 @@ def export_onnx(model, im, file, opset, train, dynamic, simplify, prefix=colorst
         LOGGER.info(f'{prefix} export failure: {e}')
 
 
+def export_onnx_int8(file, calib, imgsz, ncalib=100, prefix=colorstr('ONNX INT8:')):
+    # YOLOv5 ONNX Runtime INT8 export, static per-channel quantization calibrated on ncalib images from calib/
+    try:
+        check_requirements(('onnxruntime',))
+        import onnxruntime
+        from onnxruntime.quantization import CalibrationDataReader, QuantFormat, quantize_static
+        from onnxruntime.quantization.shape_inference import quant_pre_process
+
+        LOGGER.info(f'\n{prefix} starting export with onnxruntime {onnxruntime.__version__}...')
+        f_onnx = file.with_suffix('.onnx')
+        f = str(file).replace('.pt', '-int8.onnx')
+        files = sorted(p for p in Path(calib).rglob('*.*') if p.suffix[1:].lower() in IMG_FORMATS)[:ncalib]
+        assert files, f'no calibration images found in {calib}'
+
+        class Reader(CalibrationDataReader):
+            # Letterboxed RGB images, one batch(1) at a time
+            def __init__(self):
+                self.files = iter(files)
+
+            def get_next(self):
+                p = next(self.files, None)
+                if p is None:
+                    return None
+                im = letterbox(cv2.imread(str(p)), imgsz, auto=False)[0].transpose((2, 0, 1))[::-1]  # CHW, RGB
+                return {'images': (im[None] / 255).astype('float32')}
+
+        f_pre = f.replace('.onnx', '-pre.onnx')
+        quant_pre_process(str(f_onnx), f_pre, skip_symbolic_shape=True)  # fold and infer shapes for quantization
+        quantize_static(f_pre, f, Reader(), quant_format=QuantFormat.QDQ, per_channel=True)
+        os.remove(f_pre)
+        LOGGER.info(f'{prefix} export success ({len(files)} calibration images), saved as {f} ({file_size(f):.1f} MB)')
+        return f
+    except Exception as e:
+        LOGGER.info(f'\n{prefix} export failure: {e}')
+
+
 def export_openvino(model, file, half, prefix=colorstr('OpenVINO:')):
     # YOLOv5 OpenVINO export
     try:
         check_requirements(('openvino-dev',))  # requires openvino-dev: https://pypi.org/project/openvino-dev/
-        import openvino.inference_engine as ie
+        import openvino.runtime as ov  # noqa
 
-        LOGGER.info(f'\n{prefix} starting export with openvino {ie.__version__}...')
+        LOGGER.info(f'\n{prefix} starting export with openvino {ov.get_version()}...')
         f = str(file).replace('.pt', f'_openvino_model{os.sep}')
 
         cmd = f"mo --input_model {file.with_suffix('.onnx')} --output_dir {f} --data_type {'FP16' if half else 'FP32'}"
@@ -459,7 +497,8 @@ def run(
         train=False,  # model.train() mode
         keras=False,  # use Keras
         optimize=False,  # TorchScript: optimize for mobile
-        int8=False,  # CoreML/TF INT8 quantization
+        int8=False,  # CoreML/TF/ONNX INT8 quantization
+        calib=None,  # ONNX INT8: calibration image directory, defaults to the dataset 'train' images
         dynamic=False,  # ONNX/TF: dynamic axes
         simplify=False,  # ONNX: simplify model
         opset=12,  # ONNX: opset version
@@ -525,6 +564,8 @@ def run(
         f[2] = export_onnx(model, im, file, opset, train, dynamic, simplify)
     if xml:  # OpenVINO
         f[3] = export_openvino(model, file, half)
+    if onnx and int8:  # ONNX Runtime INT8, exported after OpenVINO which converts the FP32 ONNX
+        f[2] = export_onnx_int8(file, calib or check_dataset(data)['train'], imgsz)
     if coreml:
         _, f[4] = export_coreml(model, im, file, int8, half)
 
@@ -578,7 +619,8 @@ def parse_opt():
     parser.add_argument('--train', action='store_true', help='model.train() mode')
     parser.add_argument('--keras', action='store_true', help='TF: use Keras')
     parser.add_argument('--optimize', action='store_true', help='TorchScript: optimize for mobile')
-    parser.add_argument('--int8', action='store_true', help='CoreML/TF INT8 quantization')
+    parser.add_argument('--int8', action='store_true', help='CoreML/TF/ONNX INT8 quantization')
+    parser.add_argument('--calib', type=str, default=None, help='ONNX INT8: calibration image directory')
     parser.add_argument('--dynamic', action='store_true', help='ONNX/TF: dynamic axes')
     parser.add_argument('--simplify', action='store_true', help='ONNX: simplify model')
     parser.add_argument('--opset', type=int, default=12, help='ONNX: opset version')
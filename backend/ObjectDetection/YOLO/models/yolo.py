@@ -48,6 +48,7 @@ class Detect(nn.Module):
         self.na = len(anchors[0]) // 2  # number of anchors
         self.grid = [torch.zeros(1)] * self.nl  # init grid
         self.anchor_grid = [torch.zeros(1)] * self.nl  # init anchor grid
+        self.grid_cache = {}  # (layer, nx, ny, device, dtype): (grid, anchor_grid)
         self.register_buffer('anchors', torch.tensor(anchors).float().view(self.nl, -1, 2))  # shape(nl,na,2)
         self.m = nn.ModuleList(nn.Conv2d(x, self.no * self.na, 1) for x in ch)  # output conv
         self.inplace = inplace  # use in-place ops (e.g. slice assignment)
@@ -60,8 +61,10 @@ class Detect(nn.Module):
             x[i] = x[i].view(bs, self.na, self.no, ny, nx).permute(0, 1, 3, 4, 2).contiguous()
 
             if not self.training:  # inference
-                if self.onnx_dynamic or self.grid[i].shape[2:4] != x[i].shape[2:4]:
+                if self.onnx_dynamic:
                     self.grid[i], self.anchor_grid[i] = self._make_grid(nx, ny, i)
+                elif self.grid[i].shape[2:4] != x[i].shape[2:4]:
+                    self.grid[i], self.anchor_grid[i] = self._cached_grid(nx, ny, i)
 
                 y = x[i].sigmoid()
                 if self.inplace:
@@ -76,6 +79,15 @@ class Detect(nn.Module):
 
         return x if self.training else (torch.cat(z, 1),) if self.export else (torch.cat(z, 1), x)
 
+    def _cached_grid(self, nx=20, ny=20, i=0):
+        # Grids are kept per input shape, so alternating shape buckets don't rebuild them on every batch
+        if not hasattr(self, 'grid_cache'):  # Detect() unpickled from a checkpoint saved before the cache existed
+            self.grid_cache = {}
+        key = i, nx, ny, self.anchors.device, self.anchors.dtype
+        if key not in self.grid_cache:
+            self.grid_cache[key] = self._make_grid(nx, ny, i)
+        return self.grid_cache[key]
+
     def _make_grid(self, nx=20, ny=20, i=0):
         d = self.anchors[i].device
         t = self.anchors[i].dtype
@@ -247,6 +259,7 @@ class Model(nn.Module):
             m.grid = list(map(fn, m.grid))
             if isinstance(m.anchor_grid, list):
                 m.anchor_grid = list(map(fn, m.anchor_grid))
+            m.grid_cache = {}  # rebuilt on the new device/dtype
         return self
 
 
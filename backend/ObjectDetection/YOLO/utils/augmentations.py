@@ -88,6 +88,12 @@ def replicate(im, labels):
     return im, labels
 
 
+def nearest_bucket(shape, buckets):
+    # Shape bucket (h, w) whose aspect ratio is closest to that of an image of shape (h, w, ...)
+    r = math.log(shape[0] / shape[1])
+    return min(buckets, key=lambda b: abs(math.log(b[0] / b[1]) - r))
+
+
 def letterbox(im, new_shape=(640, 640), color=(114, 114, 114), auto=True, scaleFill=False, scaleup=True, stride=32):
     # Resize and pad image while meeting stride-multiple constraints
     shape = im.shape[:2]  # current shape [height, width]
@@ -0,0 +1,125 @@
+# YOLOv5 🚀 by Ultralytics, GPL-3.0 license
+"""
+Run NMS benchmarks: per-image non_max_suppression() vs. whole-batch batched_non_max_suppression()
+
+Usage:
+    $ python utils/benchmarks.py                                      # synthetic predictions
+    $ python utils/benchmarks.py --weights best.pt --source images/   # real predictions from a model
+"""
+
+import argparse
+import sys
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import torch
+
+FILE = Path(__file__).resolve()
+ROOT = FILE.parents[1]  # YOLOv5 root directory
+if str(ROOT) not in sys.path:
+    sys.path.append(str(ROOT))  # add ROOT to PATH
+
+from utils.augmentations import letterbox
+from utils.general import LOGGER, batched_non_max_suppression, cv2, non_max_suppression, print_args
+from utils.torch_utils import select_device, time_sync
+
+
+def synthetic_predictions(batch_size=16, anchors=25200, nc=11, seed=0, device='cpu'):
+    # Raw Detect() output shape(bs,anchors,5+nc) with mostly low objectness, like a real camera-trap batch
+    g = torch.Generator().manual_seed(seed)
+    p = torch.rand(batch_size, anchors, 5 + nc, generator=g)
+    p[..., :2] *= 640  # xy
+    p[..., 2:4] = p[..., 2:4] * 120 + 4  # wh
+    p[..., 4] = p[..., 4] ** 6  # objectness
+    return p.to(device)
+
+
+def model_predictions(weights, source, data=None, batch_size=16, imgsz=640, device=''):
+    # Raw Detect() output of `weights` on the first batch_size images of `source`
+    from models.common import DetectMultiBackend
+    device = select_device(device)
+    model = DetectMultiBackend(weights, device=device, data=data)
+    files = sorted(p for p in Path(source).glob('*.*') if p.suffix[1:].lower() in ('jpg', 'jpeg', 'png'))[:batch_size]
+    assert files, f'No images found in {source}'
+    ims = [letterbox(cv2.imread(str(f)), imgsz, stride=model.stride, auto=False)[0] for f in files]
+    im = torch.from_numpy(np.ascontiguousarray(np.stack(ims)[..., ::-1].transpose(0, 3, 1, 2))).to(device)
+    with torch.no_grad():
+        return model(im.float() / 255)
+
+
+def same_output(a, b):
+    # Same detections per image, ignoring the order of equal-score boxes
+    def rows(x):
+        x = x.cpu().numpy()
+        return x[np.lexsort(x.T[::-1])]
+
+    return len(a) == len(b) and all(x.shape == y.shape and np.allclose(rows(x), rows(y)) for x, y in zip(a, b))
+
+
+def run(
+        weights=None,  # model.pt path, or None for synthetic predictions
+        source=None,  # image directory used with --weights
+        data=ROOT / 'data/wii_aite_2022_testing.yaml',  # dataset.yaml path
+        batch_size=16,  # images per batch
+        conf_thres=(0.001, 0.25),  # confidence thresholds to benchmark
+        iou_thres=0.45,  # NMS IoU threshold
+        max_det=1000,  # maximum detections per image
+        multi_label=False,  # multiple labels per box
+        n=10,  # timed runs per configuration
+        device='',  # cuda device, i.e. 0 or 0,1,2,3 or cpu
+):
+    if weights:
+        pred = model_predictions(weights, source, data, batch_size, device=device)
+    else:
+        pred = synthetic_predictions(batch_size, device=select_device(device))
+
+    y = []
+    for conf in conf_thres:
+        row = [conf, int((pred[..., 4] > conf).sum())]
+        outputs = []
+        for fn in non_max_suppression, batched_non_max_suppression:
+            fn(pred.clone(), conf, iou_thres, multi_label=multi_label, max_det=max_det)  # warmup
+            dt = []
+            for _ in range(n):
+                p = pred.clone()
+                t = time_sync()
+                out = fn(p, conf, iou_thres, multi_label=multi_label, max_det=max_det)
+                dt.append(time_sync() - t)
+            outputs.append(out)
+            row += [np.median(dt) * 1E3, sum(len(x) for x in out)]
+        row.append(same_output(*outputs))
+        y.append(row)
+
+    # Print results
+    c = ['conf_thres', 'candidates', 'loop (ms)', 'loop boxes', 'batched (ms)', 'batched boxes', 'identical']
+    py = pd.DataFrame(y, columns=c)
+    LOGGER.info(f'\nNMS benchmarks complete (batch-size {batch_size}, max-det {max_det}, {n} runs each)')
+    LOGGER.info(str(py))
+    return py
+
+
+def parse_opt():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--weights', type=str, default=None, help='model.pt path, omit for synthetic predictions')
+    parser.add_argument('--source', type=str, default=None, help='image directory used with --weights')
+    parser.add_argument('--data', type=str, default=ROOT / 'data/wii_aite_2022_testing.yaml', help='dataset.yaml path')
+    parser.add_argument('--batch-size', type=int, default=16, help='batch size')
+    parser.add_argument('--conf-thres', nargs='+', type=float, default=[0.001, 0.25], help='confidence thresholds')
+    parser.add_argument('--iou-thres', type=float, default=0.45, help='NMS IoU threshold')
+    parser.add_argument('--max-det', type=int, default=1000, help='maximum detections per image')
+    parser.add_argument('--multi-label', action='store_true', help='multiple labels per box')
+    parser.add_argument('--n', type=int, default=10, help='timed runs per configuration')
+    parser.add_argument('--device', default='', help='cuda device, i.e. 0 or 0,1,2,3 or cpu')
+    opt = parser.parse_args()
+    print_args(vars(opt))
+    return opt
+
+
+def main(opt):
+    run(**vars(opt))
+
+
+if __name__ == "__main__":
+    opt = parse_opt()
+    main(opt)
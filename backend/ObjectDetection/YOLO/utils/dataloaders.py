@@ -11,7 +11,8 @@ import os
 import random
 import shutil
 import time
-from itertools import repeat
+from collections import deque
+from itertools import count, repeat
 from multiprocessing.pool import Pool, ThreadPool
 from pathlib import Path
 from threading import Thread
@@ -26,7 +27,8 @@ from PIL import ExifTags, Image, ImageOps
 from torch.utils.data import DataLoader, Dataset, dataloader, distributed
 from tqdm import tqdm
 
-from utils.augmentations import Albumentations, augment_hsv, copy_paste, letterbox, mixup, random_perspective
+from utils.augmentations import (Albumentations, augment_hsv, copy_paste, letterbox, mixup, nearest_bucket,
+                                 random_perspective)
 from utils.general import (DATASETS_DIR, LOGGER, NUM_THREADS, check_dataset, check_requirements, check_yaml, clean_str,
                            cv2, is_colab, is_kaggle, segments2boxes, xyn2xy, xywh2xyxy, xywhn2xyxy, xyxy2xywhn)
 from utils.torch_utils import torch_distributed_zero_first
@@ -52,6 +54,39 @@ def get_hash(paths):
     return h.hexdigest()  # return hash
 
 
+def check_image_bytes(buf):
+    # Cheap integrity check of encoded image bytes before decoding, returns the reason an empty, truncated or corrupt
+    # JPEG/PNG file can't be used, else None. Other formats are left to the decoder
+    if not len(buf):
+        return 'empty file'
+    head = buf[:8].tobytes()
+    if head[:2] == b'\xff\xd8':  # JPEG, SOI ... EOI (cameras and phones may append padding or trailers after EOI)
+        if b'\xff\xd9' not in buf[-1024:].tobytes() and buf.tobytes().rfind(b'\xff\xd9') < 2:
+            return 'truncated JPEG (no EOI marker)'
+    elif head == b'\x89PNG\r\n\x1a\n':  # PNG, signature ... IEND chunk
+        if b'IEND' not in buf[-12:].tobytes():
+            return 'truncated PNG (no IEND chunk)'
+    return None
+
+
+def load_image_file(path):
+    # Read and decode an image file exactly once, returns (BGR image, None) or (None, reason) if it can't be used
+    try:
+        buf = np.fromfile(path, np.uint8)
+    except OSError as e:
+        return None, f'unreadable ({e})'
+    reason = check_image_bytes(buf)
+    if reason:
+        return None, reason
+    img0 = cv2.imdecode(buf, cv2.IMREAD_COLOR)
+    return (img0, None) if img0 is not None else (None, 'corrupt image data')
+
+
+def skip_corrupt(path, reason):
+    # Default on_corrupt callback of the image loaders
+    LOGGER.warning(f'WARNING: skipping {path}: {reason}')
+
+
 def exif_size(img):
     # Returns exif-corrected PIL size
     s = img.size  # (width, height)
@@ -187,46 +222,16 @@ class _RepeatSampler:
 
 class LoadImages:
     # YOLOv5 image/video dataloader, i.e. `python detect.py --source image.jpg/vid.mp4`
-    # def __init__(self, path, img_size=640, stride=32, auto=True, resume=False, dir_path=None, empty_path=None):
-    def __init__(self, path, img_size=640, stride=32, auto=True, batch_size=1,resume=False, dir_path=None, empty_path=None):
+    # Corrupt or truncated images are skipped and reported to on_corrupt(path, reason), which logs them by default.
+    # Images already recorded in manifest (utils.manifest.DetectionManifest) are skipped to resume a run
+    def __init__(self, path, img_size=640, stride=32, auto=True, batch_size=1, manifest=None, on_corrupt=None):
         files = []
         for p in sorted(path) if isinstance(path, (list, tuple)) else [path]:
             p = str(Path(p).resolve())
             if '*' in p:
                 files.extend(sorted(glob.glob(p, recursive=True)))  # glob
             elif os.path.isdir(p):
-                all_files = []
-                dir_path = str(Path(dir_path).resolve())
-                if resume:
-                    all_files.extend(sorted(glob.glob(os.path.join(p, '*.*'))))  # dir
-                    # file_names = [(file.split('\\')[-1].split('.')[0], file.split('\\')[-1].split('.')[1]) for file in all_files]
-                    file_names = []
-                    for file in all_files:
-                        file_name = os.path.basename(file)
-                        file_names.append((file_name.split('.')[0], file_name.split('.')[1]))
-
-                    # existing_files = []
-                    # existing_files.extend(sorted(glob.glob(os.path.join(dir_path, '*.*'))))
-                    # include files only whose labels are not generated yet in the destination path. (exclude the ones whose predictions were already generated)
-                    ######################################################
-                    # existing_files = os.listdir(os.path.join(dir_path, 'labels'))
-                    # existing_file_names = [file.split('.')[0] for file in existing_files]
-                    ################################
-                    source_name = os.path.normpath(os.path.dirname(path) + os.sep + os.pardir)
-                    log_folder = os.path.join(source_name, 'logs_files')
-                    detected_path=os.path.join(log_folder, 'detected_files.txt')
-                    d=open(detected_path, "r")
-                    existing_files=d.readlines()
-                    existing_file_names = [file.split('.')[0] for file in existing_files]
-                    # import pdb; pdb.set_trace()
-                    # print(f'filename{file_names[0]}')
-                    # diff_files = [str(path) +'\\'+ file + '.' + extension for (file, extension) in file_names if file not in existing_file_names]
-                    diff_files = [os.path.join(str(path), file + '.' + extension) for (file, extension) in file_names if file not in existing_file_names]
-                    # diff_files = [file + '.' + extension for (file, extension) in file_names if file not in existing_file_names]
-                    files.extend(diff_files)
-                else:
-                    files.extend(sorted(glob.glob(os.path.join(p, '*.*'))))  # dir
-                print("No of files to be processed are: {} ".format(len(files)))
+                files.extend(sorted(glob.glob(os.path.join(p, '*.*'))))  # dir
             elif os.path.isfile(p):
                 files.append(p)  # files
             else:
@@ -234,6 +239,10 @@ class LoadImages:
 
         images = [x for x in files if x.split('.')[-1].lower() in IMG_FORMATS]
         videos = [x for x in files if x.split('.')[-1].lower() in VID_FORMATS]
+        if manifest is not None:
+            n = len(images)
+            images = manifest.pending(images)
+            LOGGER.info(f'Resuming: {n - len(images)} images already processed, {len(images)} to go')
         ni, nv = len(images), len(videos)
 
         self.img_size = img_size
@@ -244,13 +253,13 @@ class LoadImages:
         self.video_flag = [False] * ni + [True] * nv
         self.mode = 'image'
         self.auto = auto
-        self.empty_path = empty_path
+        self.on_corrupt = on_corrupt or skip_corrupt
         if any(videos):
             self.new_video(videos[0])  # new video
         else:
             self.cap = None
         
-        assert self.nf > 0, f'No images or videos found in {p}. ' \
+        assert self.nf > 0 or manifest is not None, f'No images or videos found in {p}. ' \
                             f'Supported formats are:\nimages: {IMG_FORMATS}\nvideos: {VID_FORMATS}'
 
     def __iter__(self):
@@ -258,97 +267,42 @@ class LoadImages:
         return self
 
     def __next__(self):
-        if self.count == self.nf:
-            raise StopIteration
-        path = self.files[self.count]
-        # print(f'original path{path}')
-        if self.video_flag[self.count]:
-            # Read video
-            self.mode = 'video'
-            ret_val, img0 = self.cap.read()
-            while not ret_val:
-                self.count += 1
-                self.cap.release()
-                if self.count == self.nf:  # last video
-                    raise StopIteration
-                path = self.files[self.count]
-                self.new_video(path)
-                ret_val, img0 = self.cap.read()
-
-            self.frame += 1
-            s = f'video {self.count + 1}/{self.nf} ({self.frame}/{self.frames}) {path}: '
+        while True:
+            if self.count == self.nf:
+                raise StopIteration
+            path = self.files[self.count]
 
-        else:
-           
-            # Read image
-            found = False
-            img = None
-            while(not found):
-                ## case 1 image corrupt
-                # import pdb; pdb.set_trace()
-                try:
-
-                    if self.count == self.nf:
-                        # import pdb; pdb.set_trace()
-                        raise StopIteration
+            if self.video_flag[self.count]:
+                # Read video
+                self.mode = 'video'
+                ret_val, img0 = self.cap.read()
+                while not ret_val:
                     self.count += 1
-                    # print(path)
-                    img0 = cv2.imread(path)        # BGR
-                    cv2.imwrite(img0, path)        # write save image to remove corrupt issues. 
-                    img0 = cv2.imread(path)        # read uncorrupt image.
-                    assert img0 is not None, f'Image Not Found {path}'
-                    s = f'image {self.count}/{self.nf} {path}: '
-                    # Padded resize
-                    img = letterbox(img0, self.img_size, stride=self.stride, auto=self.auto)[0]
-
-                    # Convert
-                    img = img.transpose((2, 0, 1))[::-1]  # HWC to CHW, BGR to RGB
-                    img = np.ascontiguousarray(img)
-
-                except:
-                    if self.count == self.nf:
-                        dest_path = self.empty_path
-                        if not os.path.exists(dest_path):
-                            os.mkdir(dest_path)
-                        shutil.move(path, dest_path) 
-                        assert self.count != self.nf, f'No images or videos found in. ' \
-                            f'Supported formats are:\nimages: {IMG_FORMATS}\nvideos: {VID_FORMATS}'
- 
+                    self.cap.release()
+                    if self.count == self.nf:  # last video
                         raise StopIteration
-                    ## handle empty image case. 
-                    ## move this empty file to different directory.
-                    print("haven't found yet! I will search for new image.")
-                    # dest_path = '/home/ashimag/empty_files_new/'
-                    dest_path = self.empty_path
-                    if not os.path.exists(dest_path):
-                        os.mkdir(dest_path)
-                    shutil.move(path, dest_path)       
-                    # set new path
                     path = self.files[self.count]
-                if img is not None: 
-                    found = True
-                    # print("Found an image. Found image at path: {}".format(path))
-        # else:
-        #     # Read image
-        #     found = False
-        #     while(not found)
-        #     ## case 1 image corrupt
-        #     try:
-        #             self.count += 1
-        #             img0 = cv2.imread(path)  # BGR
-
-                    
-                    
-        #             assert img0 is not None, f'Image Not Found {path}'
-        #             s = f'image {self.count}/{self.nf} {path}: '
-        #         # Padded resize
-        #         img = letterbox(img0, self.img_size, stride=self.stride, auto=self.auto)[0]
-
-        #         # Convert
-        #         img = img.transpose((2, 0, 1))[::-1]  # HWC to CHW, BGR to RGB
-        #         img = np.ascontiguousarray(img)
-        #     except:
-        #         path = self.files[count]
+                    self.new_video(path)
+                    ret_val, img0 = self.cap.read()
+
+                self.frame += 1
+                s = f'video {self.count + 1}/{self.nf} ({self.frame}/{self.frames}) {path}: '
+                break
+
+            # Read image, decoding the file exactly once
+            self.count += 1
+            img0, reason = load_image_file(path)  # BGR
+            if img0 is not None:
+                s = f'image {self.count}/{self.nf} {path}: '
+                break
+            self.on_corrupt(path, reason)  # report and continue, files are never moved during iteration
+
+        # Padded resize
+        img = letterbox(img0, self.img_size, stride=self.stride, auto=self.auto)[0]
+
+        # Convert
+        img = img.transpose((2, 0, 1))[::-1]  # HWC to CHW, BGR to RGB
+        img = np.ascontiguousarray(img)
 
         return path, img, img0, self.cap, s
 
@@ -361,6 +315,166 @@ class LoadImages:
         return self.nf  # number of files
 
 
+class LoadImagesPrefetch:
+    # YOLOv5 image dataloader that decodes and letterboxes upcoming images in a thread pool while the caller runs
+    # inference on the current one, i.e. `python detect.py --source images/ --prefetch`. A long-lived `pool` may be
+    # passed in and is left open, else one is created for each iteration
+    def __init__(self,
+                 path,
+                 img_size=640,
+                 stride=32,
+                 auto=True,
+                 workers=NUM_THREADS,
+                 prefetch=32,
+                 manifest=None,
+                 on_corrupt=None,
+                 buckets=None,
+                 pool=None):
+        files = []
+        for p in path if isinstance(path, (list, tuple)) else [path]:  # lists keep their order
+            p = str(Path(p).resolve())
+            if '*' in p:
+                files.extend(sorted(glob.glob(p, recursive=True)))  # glob
+            elif os.path.isdir(p):
+                files.extend(sorted(glob.glob(os.path.join(p, '*.*'))))  # dir
+            elif os.path.isfile(p):
+                files.append(p)  # files
+            else:
+                raise FileNotFoundError(f'{p} does not exist')
+
+        self.img_size = img_size
+        self.stride = stride
+        self.auto = auto
+        self.buckets = buckets  # (h, w) shapes, each image is letterboxed to the one nearest its aspect ratio
+        self.files = [x for x in files if x.split('.')[-1].lower() in IMG_FORMATS]
+        if manifest is not None:  # resume
+            n = len(self.files)
+            self.files = manifest.pending(self.files)
+            LOGGER.info(f'Resuming: {n - len(self.files)} images already processed, {len(self.files)} to go')
+        self.nf = len(self.files)  # number of files
+        self.workers = max(1, workers)
+        self.prefetch = max(1, prefetch)  # maximum decoded images waiting in memory
+        self.on_corrupt = on_corrupt or skip_corrupt
+        self.pool = pool
+        self.mode = 'image'
+        self.cap = None
+        self.frame = 0
+        assert self.nf > 0 or manifest is not None, \
+            f'No images found in {path}. Supported formats are:\nimages: {IMG_FORMATS}'
+
+    def load(self, path):
+        img0, reason = load_image_file(path)  # BGR
+        if img0 is None:
+            return None, reason
+        if self.buckets:
+            img = letterbox(img0, nearest_bucket(img0.shape, self.buckets), stride=self.stride, auto=False)[0]
+        else:
+            img = letterbox(img0, self.img_size, stride=self.stride, auto=self.auto)[0]  # padded resize
+        img = np.ascontiguousarray(img.transpose((2, 0, 1))[::-1])  # HWC to CHW, BGR to RGB
+        return img, img0
+
+    def __iter__(self):
+        if self.pool is not None:
+            yield from self._iter(self.pool)
+            return
+        with ThreadPool(self.workers) as pool:
+            yield from self._iter(pool)
+
+    def _iter(self, pool):
+        # Keep up to self.prefetch images in flight, returned in file order; corrupt images go to on_corrupt()
+        pending = deque()
+        for i, path in enumerate(self.files):
+            pending.append((i, path, pool.apply_async(self.load, (path,))))
+            if len(pending) >= self.prefetch:
+                yield from self._next(*pending.popleft())
+        while pending:
+            yield from self._next(*pending.popleft())
+
+    def _next(self, i, path, result):
+        img, img0 = result.get()
+        if img is None:
+            self.on_corrupt(path, img0)  # img0 holds the reason
+            return
+        yield path, img, img0, self.cap, f'image {i + 1}/{self.nf} {path}: '
+
+    def __len__(self):
+        return self.nf  # number of files
+
+
+def video_keyframes(path, sample_fps=2, threshold=0.02, max_gap=10.0, thumb=(64, 36), pixel_thres=25):
+    # Yield (frame_index, timestamp, score, img0) for the keyframes of a video, timestamp in seconds. Frames are sampled
+    # sample_fps times a second and scored against the last keyframe: score is the fraction of pixels of a small
+    # grayscale thumbnail whose brightness changed by more than pixel_thres levels. The first frame, frames scoring
+    # >= threshold and frames max_gap seconds after the last keyframe are keyframes
+    cap = cv2.VideoCapture(str(path))
+    assert cap.isOpened(), f'Failed to open {path}'
+    fps = cap.get(cv2.CAP_PROP_FPS)  # warning: may return 0 or nan
+    fps = fps if math.isfinite(fps) and fps > 0 else 30
+    step = max(1, round(fps / sample_fps))  # frames per sample
+    ref, last = None, -math.inf  # last keyframe thumbnail and timestamp
+    try:
+        for i in count():
+            if i % step:
+                if not cap.grab():  # skip frame without converting it
+                    break
+                continue
+            ret_val, img0 = cap.read()
+            if not ret_val:
+                break
+            t = i / fps
+            small = cv2.resize(cv2.cvtColor(img0, cv2.COLOR_BGR2GRAY), thumb, interpolation=cv2.INTER_AREA)
+            small = small.astype(np.float32)
+            small -= small.mean()  # ignore global exposure changes, i.e. clouds or IR switching
+            score = 1.0 if ref is None else float((np.abs(small - ref) > pixel_thres).mean())
+            if score >= threshold or t - last >= max_gap:
+                ref, last = small, t
+                yield i, t, score, img0
+    finally:
+        cap.release()
+
+
+class LoadKeyframes:
+    # YOLOv5 video dataloader that only returns keyframes picked by video_keyframes(), i.e.
+    # `python detect.py --source clips/ --keyframes`. self.frame and self.timestamp describe the returned frame
+    def __init__(self, path, img_size=640, stride=32, auto=True, sample_fps=2, threshold=0.02, max_gap=10.0):
+        files = []
+        for p in sorted(path) if isinstance(path, (list, tuple)) else [path]:
+            p = str(Path(p).resolve())
+            if '*' in p:
+                files.extend(sorted(glob.glob(p, recursive=True)))  # glob
+            elif os.path.isdir(p):
+                files.extend(sorted(glob.glob(os.path.join(p, '*.*'))))  # dir
+            elif os.path.isfile(p):
+                files.append(p)  # files
+            else:
+                raise FileNotFoundError(f'{p} does not exist')
+
+        self.img_size = img_size
+        self.stride = stride
+        self.auto = auto
+        self.sample_fps = sample_fps
+        self.threshold = threshold
+        self.max_gap = max_gap
+        self.files = [x for x in files if x.split('.')[-1].lower() in VID_FORMATS]
+        self.nf = len(self.files)  # number of files
+        self.mode = 'video'
+        self.cap = None
+        self.frame, self.timestamp = 0, 0.0
+        assert self.nf > 0, f'No videos found in {path}. Supported formats are:\nvideos: {VID_FORMATS}'
+
+    def __iter__(self):
+        for i, path in enumerate(self.files):
+            keyframes = video_keyframes(path, self.sample_fps, self.threshold, self.max_gap)
+            for n, (self.frame, self.timestamp, _, img0) in enumerate(keyframes):
+                img = letterbox(img0, self.img_size, stride=self.stride, auto=self.auto)[0]  # padded resize
+                img = np.ascontiguousarray(img.transpose((2, 0, 1))[::-1])  # HWC to CHW, BGR to RGB
+                s = f'video {i + 1}/{self.nf} keyframe {n + 1} (frame {self.frame}, {self.timestamp:.1f}s) {path}: '
+                yield path, img, img0, self.cap, s
+
+    def __len__(self):
+        return self.nf  # number of files
+
+
 class LoadWebcam:  # for inference
     # YOLOv5 local webcam dataloader, i.e. `python detect.py --source 0`
     def __init__(self, pipe='0', img_size=640, stride=32):
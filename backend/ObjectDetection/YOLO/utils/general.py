@@ -883,6 +883,76 @@ def non_max_suppression(prediction,
     return output
 
 
+def batched_non_max_suppression(prediction,
+                                conf_thres=0.25,
+                                iou_thres=0.45,
+                                classes=None,
+                                agnostic=False,
+                                multi_label=False,
+                                max_det=300):
+    """Non-Maximum Suppression (NMS) over the whole batch at once. Filters candidates for all images together and runs
+    a single torchvision.ops.batched_nms() with one group per (image, class), so there is no per-image Python loop and
+    no time limit: the output is always complete and deterministic
+
+    Returns:
+         list of detections, on (n,6) tensor per image [xyxy, conf, cls]
+    """
+
+    bs = prediction.shape[0]  # batch size
+    nc = prediction.shape[2] - 5  # number of classes
+
+    # Checks
+    assert 0 <= conf_thres <= 1, f'Invalid Confidence threshold {conf_thres}, valid values are between 0.0 and 1.0'
+    assert 0 <= iou_thres <= 1, f'Invalid IoU {iou_thres}, valid values are between 0.0 and 1.0'
+
+    # Settings
+    max_nms = 30000  # maximum number of boxes per image into torchvision.ops.batched_nms()
+    multi_label &= nc > 1  # multiple labels per box
+
+    bi, ai = (prediction[..., 4] > conf_thres).nonzero(as_tuple=True)  # image and anchor index of candidates
+    x = prediction[bi, ai]  # candidates (copy)
+    x[:, 5:] *= x[:, 4:5]  # conf = obj_conf * cls_conf
+    box = xywh2xyxy(x[:, :4])
+
+    # Detections matrix nx6 (xyxy, conf, cls)
+    if multi_label:
+        i, j = (x[:, 5:] > conf_thres).nonzero(as_tuple=False).T
+        x, bi = torch.cat((box[i], x[i, j + 5, None], j[:, None].float()), 1), bi[i]
+    else:  # best class only
+        conf, j = x[:, 5:].max(1, keepdim=True)
+        keep = conf.view(-1) > conf_thres
+        x, bi = torch.cat((box, conf, j.float()), 1)[keep], bi[keep]
+
+    # Filter by class
+    if classes is not None:
+        keep = (x[:, 5:6] == torch.tensor(classes, device=x.device)).any(1)
+        x, bi = x[keep], bi[keep]
+
+    # Keep the max_nms most confident boxes of each image
+    x, bi = _rank_limit(x, bi, bs, max_nms)
+
+    # Batched NMS, one group per image (and per class unless agnostic)
+    groups = bi if agnostic else bi * nc + x[:, 5].long()
+    i = torchvision.ops.batched_nms(x[:, :4], x[:, 4], groups, iou_thres).sort().values
+    i = i[x[i, 4].argsort(descending=True, stable=True)]  # decreasing score, ties in candidate order
+    x, bi = _rank_limit(x[i], bi[i], bs, max_det, presorted=True)
+
+    return list(x.split(torch.bincount(bi, minlength=bs).tolist()))
+
+
+def _rank_limit(x, bi, bs, limit, presorted=False):
+    # Group detections x by image index bi (confidence-descending within each image) and keep the first `limit` per image
+    if not presorted:
+        order = x[:, 4].argsort(descending=True, stable=True)
+        x, bi = x[order], bi[order]
+    order = bi.argsort(stable=True)
+    x, bi = x[order], bi[order]
+    counts = torch.bincount(bi, minlength=bs)
+    rank = torch.arange(len(bi), device=bi.device) - (counts.cumsum(0) - counts)[bi]
+    keep = rank < limit
+    return x[keep], bi[keep]
+
+
 def strip_optimizer(f='best.pt', s=''):  # from utils.general import *; strip_optimizer()
     # Strip optimizer from 'f' to finalize training, optionally save as 's'
     x = torch.load(f, map_location=torch.device('cpu'))
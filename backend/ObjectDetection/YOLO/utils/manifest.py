@@ -0,0 +1,84 @@
+# YOLOv5 🚀 by Ultralytics, GPL-3.0 license
+"""
+Resume manifest for folder detection runs
+"""
+
+import hashlib
+import os
+import sqlite3
+import time
+from pathlib import Path
+
+HASH_SAMPLE = 1 << 16  # bytes hashed from the start and from the end of each file
+
+
+def file_hash(path, size=None):
+    # Sampled content hash: file size plus the first and last HASH_SAMPLE bytes
+    size = os.path.getsize(path) if size is None else size
+    h = hashlib.blake2b(str(size).encode(), digest_size=16)
+    with open(path, 'rb') as f:
+        h.update(f.read(HASH_SAMPLE))
+        if size > HASH_SAMPLE:
+            f.seek(max(HASH_SAMPLE, size - HASH_SAMPLE))
+            h.update(f.read(HASH_SAMPLE))
+    return h.hexdigest()
+
+
+class DetectionManifest:
+    # SQLite manifest of processed images keyed by resolved path and sampled content hash, i.e.
+    #   manifest = DetectionManifest('logs_files/detected_files.db')
+    #   files = manifest.pending(files)  # drop images already processed with the same content
+    #   manifest.add(path)  # after processing, written batch_size records per transaction
+    def __init__(self, file='detected_files.db', batch_size=256):
+        Path(file).parent.mkdir(parents=True, exist_ok=True)
+        self.file = str(file)
+        self.batch_size = batch_size
+        self.buffer = []
+        self.db = sqlite3.connect(self.file)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS processed ('
+                        'path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, hash TEXT, processed_at REAL)')
+
+    def pending(self, files):
+        # Files not processed yet, in order. One manifest read and one dict lookup per file; a file is only re-hashed
+        # if its size/mtime changed since it was recorded
+        self.flush()
+        done = {r[0]: r[1:] for r in self.db.execute('SELECT path, size, mtime_ns, hash FROM processed')}
+        pending = []
+        for f in files:
+            r = done.get(str(Path(f).resolve()))
+            if r is not None:
+                st = os.stat(f)
+                if (st.st_size, st.st_mtime_ns) == tuple(r[:2]):
+                    continue  # unchanged since processed
+                if st.st_size == r[0] and file_hash(f, st.st_size) == r[2]:
+                    continue  # touched, same content
+            pending.append(f)
+        return pending
+
+    def add(self, path):
+        path = str(Path(path).resolve())
+        st = os.stat(path)
+        self.buffer.append((path, st.st_size, st.st_mtime_ns, file_hash(path, st.st_size), time.time()))
+        if len(self.buffer) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if self.buffer:
+            with self.db:  # one transaction
+                self.db.executemany('INSERT OR REPLACE INTO processed VALUES (?, ?, ?, ?, ?)', self.buffer)
+            self.buffer = []
+
+    def close(self):
+        self.flush()
+        self.db.close()
+
+    def __len__(self):
+        self.flush()
+        return self.db.execute('SELECT COUNT(*) FROM processed').fetchone()[0]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
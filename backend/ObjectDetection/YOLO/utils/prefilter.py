@@ -0,0 +1,128 @@
+# YOLOv5 🚀 by Ultralytics, GPL-3.0 license
+"""
+Empty-frame prefilter: skip detection on camera-trap frames that match their camera's background
+"""
+
+import os
+import random
+import threading
+from collections import OrderedDict, deque
+
+import numpy as np
+
+from utils.general import LOGGER, cv2
+
+THUMB = (64, 48)  # thumbnail size (width, height) the background is modelled at
+
+
+def thumbnail(img, size=THUMB):
+    # Exposure-normalised grayscale thumbnail of a BGR or grayscale image
+    if img.ndim == 3:
+        img = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+    im = cv2.resize(img, size, interpolation=cv2.INTER_AREA).astype(np.float32)
+    return im - im.mean()  # ignore global exposure changes, i.e. clouds or IR switching
+
+
+def thumbnail_file(path, size=THUMB):
+    # thumbnail() of an image file, JPEGs are decoded at 1/8 resolution. None if the file can't be read
+    img = cv2.imread(str(path), cv2.IMREAD_REDUCED_GRAYSCALE_8)
+    return None if img is None else thumbnail(img, size)
+
+
+class Backgrounds(OrderedDict):
+    # Background frames per camera key, created on first access. Several prefilters may share one, i.e. to keep the
+    # backgrounds across uploads; beyond max_keys cameras the least recently used one is dropped
+    def __init__(self, history=8, max_keys=None):
+        super().__init__()
+        self.history = history
+        self.max_keys = max_keys
+        self.lock = threading.Lock()
+
+    def __getitem__(self, key):
+        with self.lock:
+            if key not in self:
+                super().__setitem__(key, deque(maxlen=self.history))
+                if self.max_keys is not None and len(self) > self.max_keys:
+                    self.popitem(last=False)
+            self.move_to_end(key)
+            return super().__getitem__(key)
+
+
+class EmptyFramePrefilter:
+    # Marks frames that match their camera's background as likely empty so the detector can be skipped, i.e.
+    #   prefilter = EmptyFramePrefilter(audit=0.02)
+    #   score, empty, audit = prefilter.check(path, img0)  # run the detector unless empty and not audit
+    #   prefilter.update(path, len(det))  # after running the detector
+    # The background of a camera (frames grouped by key(path), the parent directory by default) is the per-pixel
+    # median of its last `history` frames without detections. A frame is empty when less than `threshold` of its
+    # thumbnail differs from the background by more than pixel_thres levels; frames are never empty before the
+    # camera has `warmup` background frames, and frames whose key is None are never empty. A fraction `audit` of the
+    # empty frames is still sent to the detector, detections on those are audit misses. `backgrounds` may be a
+    # Backgrounds shared with other prefilters
+    def __init__(self, threshold=0.003, pixel_thres=25, history=8, warmup=3, audit=0.02, key=None, seed=0,
+                 backgrounds=None):
+        self.threshold = threshold
+        self.pixel_thres = pixel_thres
+        self.warmup = warmup
+        self.audit = audit
+        self.key = key or (lambda path: os.path.dirname(os.path.abspath(path)))
+        self.random = random.Random(seed)
+        self.backgrounds = Backgrounds(history) if backgrounds is None else backgrounds
+        self.pending = {}  # path: (key, thumbnail, score, empty, audit) of frames sent to the detector
+        self.results = []  # (path, score, empty, audited, detections or None if skipped)
+
+    def check(self, path, img0=None):
+        # Returns (score, empty, audit) for a decoded frame, or for the file at path if img0 is None
+        im = thumbnail_file(path) if img0 is None else thumbnail(img0)
+        if im is None:
+            return 1.0, False, False  # unreadable, left to the detector to report
+        key = self.key(path)
+        bg = self.backgrounds[key] if key is not None else ()
+        if len(bg) < self.warmup:
+            score = 1.0
+        else:
+            ref = np.median(np.stack(list(bg)), 0)  # copy, a shared background may grow meanwhile
+            score = float((np.abs(im - ref) > self.pixel_thres).mean())
+        empty = score < self.threshold
+        audit = empty and self.random.random() < self.audit
+        if empty and not audit:
+            bg.append(im)
+            self.results.append((path, score, True, False, None))
+        else:
+            self.pending[path] = key, im, score, empty, audit
+        return score, empty, audit
+
+    def update(self, path, n):
+        # Report the number of detections for a frame check() sent to the detector
+        key, im, score, empty, audit = self.pending.pop(path)
+        if n == 0 and key is not None:
+            self.backgrounds[key].append(im)  # background frames are confirmed empty
+        self.results.append((path, score, empty, audit, n))
+
+    def metrics(self):
+        frames = len(self.results)
+        skipped = sum(n is None for *_, n in self.results)
+        audited = [n for _, _, _, a, n in self.results if a]
+        misses = sum(n > 0 for n in audited)
+        return {
+            'frames': frames,
+            'empty': sum(e for _, _, e, _, _ in self.results),
+            'skipped': skipped,
+            'skip_rate': skipped / max(frames, 1),
+            'audited': len(audited),
+            'audit_misses': misses,
+            'audit_miss_rate': misses / max(len(audited), 1)}
+
+    def log(self):
+        m = self.metrics()
+        LOGGER.info(f"Prefilter: {m['skipped']}/{m['frames']} frames skipped as empty ({m['skip_rate']:.1%}), "
+                    f"{m['audit_misses']}/{m['audited']} audited empty frames had detections "
+                    f"({m['audit_miss_rate']:.1%} audit miss rate)")
+        return m
+
+    def save(self, file):
+        # CSV of every frame's score and outcome, detections is blank for skipped frames
+        with open(file, 'w') as f:
+            f.write('path,score,empty,audited,detections\n')
+            for path, score, empty, audited, n in self.results:
+                f.write(f"{path},{score:.5f},{int(empty)},{int(audited)},{'' if n is None else n}\n")
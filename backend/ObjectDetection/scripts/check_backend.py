@@ -0,0 +1,118 @@
+"""Check a detection backend against the PyTorch model on a sample set.
+
+Usage (from backend/):
+    python -m ObjectDetection.scripts.check_backend --backend onnx --source samples/
+    python -m ObjectDetection.scripts.check_backend --backend onnx --int8 --threads 4 --source samples/
+
+Every image is run through both models. A reference detection counts as matched
+when the backend reports the same class with IoU >= --iou. The script prints the
+match rate, the largest confidence difference and the mean per-image latency of
+each model, and exits non-zero when the match rate is below --min-match.
+"""
+import argparse
+import logging
+import sys
+import time
+from pathlib import Path
+
+import numpy as np
+import torch as T
+
+from ObjectDetection.scripts.inference import BACKENDS, DATA_PATH, DETECTION_THREADS, backend_weights, read_image
+from ObjectDetection.scripts.detector import Detector
+from utils.dataloaders import IMG_FORMATS
+from utils.metrics import box_iou
+
+logger = logging.getLogger(__name__)
+
+
+def match_detections(ref, det, iou_thres=0.5):
+    """Greedily match reference detections to backend detections of the same class.
+
+    Returns the number of matched reference boxes and the largest confidence
+    difference among the matches.
+    """
+    if len(ref) == 0 or len(det) == 0:
+        return 0, 0.0
+    iou = box_iou(T.from_numpy(ref[:, :4]), T.from_numpy(det[:, :4])).numpy()
+    iou[ref[:, 5:6] != det[:, 5]] = 0  # different class
+    matched, max_diff = 0, 0.0
+    for i in np.argsort(-ref[:, 4]):  # most confident reference boxes first
+        j = iou[i].argmax()
+        if iou[i, j] >= iou_thres:
+            matched += 1
+            max_diff = max(max_diff, abs(float(ref[i, 4] - det[j, 4])))
+            iou[:, j] = 0  # each backend box matches once
+    return matched, max_diff
+
+
+def timed_detect(model, img):
+    t = time.perf_counter()
+    det = model.detect(img)
+    return det, time.perf_counter() - t
+
+
+def check_backend(source, backend, int8=False, threads=DETECTION_THREADS, iou_thres=0.5, limit=100):
+    files = sorted(p for p in Path(source).rglob('*.*') if p.suffix[1:].lower() in IMG_FORMATS)[:limit]
+    if not files:
+        raise FileNotFoundError(f"No images found in {source}")
+
+    if threads:
+        T.set_num_threads(threads)  # for the PyTorch reference, the backend's session gets them from the Detector
+    reference = Detector(backend_weights('pytorch'), data=DATA_PATH, threads=threads)
+    candidate = Detector(backend_weights(backend, int8), data=DATA_PATH, threads=threads)
+
+    total = found = matched = 0
+    max_diff = 0.0
+    ref_time, cand_time = [], []
+    for path in files:
+        img = read_image(path)
+        if img is None:
+            continue
+        ref, t_ref = timed_detect(reference, img)
+        det, t_cand = timed_detect(candidate, img)
+        ref_time.append(t_ref)
+        cand_time.append(t_cand)
+
+        n, diff = match_detections(ref, det, iou_thres)
+        total += len(ref)
+        found += len(det)
+        matched += n
+        max_diff = max(max_diff, diff)
+        logger.debug(f"{path.name}: {len(ref)} reference, {len(det)} {backend}, {n} matched")
+
+    # The first call of each model includes one-off allocations, leave it out of the latency
+    summary = {
+        "images": len(ref_time),
+        "reference_boxes": total,
+        f"{backend}_boxes": found,
+        "match_rate": matched / total if total else 1.0,
+        "max_conf_diff": max_diff,
+        "pytorch_ms": 1000 * float(np.mean(ref_time[1:] or ref_time)),
+        f"{backend}_ms": 1000 * float(np.mean(cand_time[1:] or cand_time)),
+    }
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare a detection backend with the PyTorch model")
+    parser.add_argument('--source', type=str, required=True, help='Directory of sample images')
+    parser.add_argument('--backend', type=str, default='onnx', choices=BACKENDS[1:], help='Backend to check')
+    parser.add_argument('--int8', action='store_true', help='Use the INT8 quantized ONNX model')
+    parser.add_argument('--threads', type=int, default=DETECTION_THREADS, help='Intra-op threads, 0 = default')
+    parser.add_argument('--iou', type=float, default=0.5, help='IoU needed to match a reference box')
+    parser.add_argument('--limit', type=int, default=100, help='Maximum number of images')
+    parser.add_argument('--min-match', type=float, default=0.95, help='Minimum match rate to pass')
+    args = parser.parse_args()
+
+    summary = check_backend(args.source, args.backend, args.int8, args.threads, args.iou, args.limit)
+    for key, value in summary.items():
+        print(f"{key}: {value:.4g}" if isinstance(value, float) else f"{key}: {value}")
+    if summary["match_rate"] < args.min_match:
+        print(f"FAIL: match rate {summary['match_rate']:.3f} is below {args.min_match}")
+        sys.exit(1)
+    print("OK")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,170 @@
+import logging
+import os
+import sys
+from multiprocessing.pool import ThreadPool
+from pathlib import Path
+
+import numpy as np
+import torch as T
+import torchvision
+
+logger = logging.getLogger(__name__)
+
+BACKEND_DIR = Path(__file__).resolve().parent.parent
+YOLO_DIR = BACKEND_DIR / "YOLO"
+
+for path in [BACKEND_DIR, YOLO_DIR]:
+    if str(path) not in sys.path:
+        sys.path.append(str(path))
+
+from models.common import DetectMultiBackend
+from utils.augmentations import letterbox, nearest_bucket
+from utils.dataloaders import LoadImagesPrefetch
+from utils.general import NUM_THREADS, batched_non_max_suppression, check_img_size, scale_coords
+from utils.torch_utils import select_device
+
+
+def tile_origins(length, tile, step):
+    # Start offsets of tiles covering [0, length), the last tile is aligned to the far edge
+    if length <= tile:
+        return [0]
+    return list(range(0, length - tile, step)) + [length - tile]
+
+
+class Detector:
+    """YOLOv5 detector that stays resident in memory.
+
+    The weights are loaded and warmed up once. Each call letterboxes the decoded
+    BGR image, runs the forward pass and NMS, and returns the detections as an
+    (n, 6) array of [x1, y1, x2, y2, conf, cls] in original image pixels.
+    `weights` may be any format DetectMultiBackend loads (e.g. .pt, .onnx or an
+    OpenVINO directory); `threads` sets the ONNX Runtime / OpenVINO thread count
+    (0 = default). torch's intra-op thread count is process-wide and is left to
+    the process running the detector.
+    With `buckets`, a list of (h, w) input shapes, every image is letterboxed to
+    the bucket closest to its aspect ratio instead of to imgsz, and images of
+    the same bucket are batched together. Each bucket is warmed up once here.
+    loader() decodes in one thread pool that lives as long as the detector.
+    """
+
+    def __init__(self, weights, data=None, imgsz=(640, 640), device='', conf_thres=0.25, iou_thres=0.45,
+                 max_det=1000, half=False, threads=0, buckets=None):
+        self.device = select_device(device)
+        self.model = DetectMultiBackend(str(weights), device=self.device, data=data, fp16=half, threads=threads)
+        self.stride, self.names, self.pt = self.model.stride, self.model.names, self.model.pt
+        self.imgsz = check_img_size(imgsz, s=self.stride)
+        self.buckets = [tuple(check_img_size(b, s=self.stride)) for b in buckets] if buckets else None
+        self.conf_thres = conf_thres
+        self.iou_thres = iou_thres
+        self.max_det = max_det
+        self._decode_pool, self._decode_pid = None, None
+        self.warmup()
+
+    @T.no_grad()
+    def warmup(self):
+        # One forward pass per input shape, so Detect() grids and backend kernels are ready before the first request
+        for shape in self.buckets or [self.imgsz]:
+            im = T.zeros(1, 3, *shape, dtype=T.half if self.model.fp16 else T.float, device=self.device)
+            for _ in range(2 if self.model.jit else 1):  # TorchScript optimizes on the second run
+                self.model(im)
+
+    def preprocess(self, im0, auto=None):
+        auto = self.pt if auto is None else auto
+        if self.buckets:
+            shape, auto = nearest_bucket(im0.shape, self.buckets), False
+        else:
+            shape = self.imgsz
+        im = letterbox(im0, shape, stride=self.stride, auto=auto)[0]
+        im = im.transpose((2, 0, 1))[::-1]  # HWC to CHW, BGR to RGB
+        return np.ascontiguousarray(im)
+
+    @property
+    def decode_pool(self):
+        # Created on first use in each process, threads don't survive the fork into inference workers
+        if self._decode_pid != os.getpid():
+            self._decode_pool, self._decode_pid = ThreadPool(NUM_THREADS), os.getpid()
+        return self._decode_pool
+
+    def loader(self, paths, prefetch=32):
+        # Prefetching loader whose images are ready for detect_preprocessed()
+        return LoadImagesPrefetch(paths, img_size=self.imgsz, stride=self.stride, auto=False, prefetch=prefetch,
+                                  buckets=self.buckets, pool=self.decode_pool)
+
+    def _to_tensor(self, im):
+        im = T.from_numpy(im).to(self.device)
+        im = im.half() if self.model.fp16 else im.float()  # uint8 to fp16/32
+        im /= 255  # 0 - 255 to 0.0 - 1.0
+        return im
+
+    @T.no_grad()
+    def detect(self, im0):
+        im = self._to_tensor(self.preprocess(im0))
+        pred = self.model(im[None])
+        det = batched_non_max_suppression(pred, self.conf_thres, self.iou_thres, max_det=self.max_det)[0]
+        det[:, :4] = scale_coords(im.shape[1:], det[:, :4], im0.shape).round()
+        return det.cpu().numpy()
+
+    def detect_batch(self, im0s):
+        # All images are padded to the full inference size (or their bucket) so they stack into forward passes
+        return self.detect_preprocessed([self.preprocess(im0, auto=False) for im0 in im0s], im0s)
+
+    @T.no_grad()
+    def detect_preprocessed(self, ims, im0s):
+        # ims are the outputs of preprocess(im0, auto=False), e.g. prepared ahead by LoadImagesPrefetch.
+        # Images of the same shape share one forward pass
+        groups = {}
+        for i, im in enumerate(ims):
+            groups.setdefault(im.shape, []).append(i)
+        out = [None] * len(ims)
+        for idx in groups.values():
+            im = self._to_tensor(np.stack([ims[i] for i in idx]))
+            pred = self.model(im)
+            dets = batched_non_max_suppression(pred, self.conf_thres, self.iou_thres, max_det=self.max_det)
+            for i, det in zip(idx, dets):
+                det[:, :4] = scale_coords(im.shape[2:], det[:, :4], im0s[i].shape).round()
+                out[i] = det.cpu().numpy()
+        return out
+
+    @T.no_grad()
+    def detect_tiled(self, im0, tile=640, overlap=0.2, proposal_conf=0.05, tile_batch=32):
+        """Sliced inference for high-resolution images.
+
+        A low-res pass over the whole letterboxed image finds proposals (conf >=
+        proposal_conf); only the tile x tile crops overlapping a proposal are run at
+        full resolution, tile_batch crops per forward pass. Tile detections and the
+        low-res detections (which cover animals larger than a tile) are merged with
+        class-wise NMS.
+        """
+        im = self._to_tensor(self.preprocess(im0))
+        low = batched_non_max_suppression(self.model(im[None]), min(proposal_conf, self.conf_thres), self.iou_thres,
+                                          max_det=self.max_det)[0]
+        low[:, :4] = scale_coords(im.shape[1:], low[:, :4], im0.shape).round()
+        low = low.cpu().numpy()
+        dets = [low[low[:, 4] >= self.conf_thres]]
+
+        h, w = im0.shape[:2]
+        if h <= tile and w <= tile or not len(low):
+            return dets[0]  # nothing to refine
+
+        # Tiles that overlap a proposal
+        step = max(1, int(tile * (1 - overlap)))
+        tiles = np.array([(x, y, min(x + tile, w), min(y + tile, h))
+                          for y in tile_origins(h, tile, step)
+                          for x in tile_origins(w, tile, step)])
+        hit = ((low[:, None, 0] < tiles[None, :, 2]) & (low[:, None, 2] > tiles[None, :, 0]) &
+               (low[:, None, 1] < tiles[None, :, 3]) & (low[:, None, 3] > tiles[None, :, 1])).any(0)
+        tiles = tiles[hit]
+        logger.debug(f"Tiled inference: {len(tiles)}/{len(hit)} tiles of {w}x{h} image")
+
+        for i in range(0, len(tiles), tile_batch):
+            batch = tiles[i:i + tile_batch]
+            for det, (x1, y1, x2, y2) in zip(self.detect_batch([im0[y1:y2, x1:x2] for x1, y1, x2, y2 in batch]),
+                                             batch):
+                det[:, [0, 2]] += x1  # tile to image coordinates
+                det[:, [1, 3]] += y1
+                dets.append(det)
+
+        # Cross-tile NMS
+        det = T.from_numpy(np.concatenate(dets))
+        i = torchvision.ops.batched_nms(det[:, :4], det[:, 4], det[:, 5].long(), self.iou_thres)[:self.max_det]
+        return det[i].numpy()
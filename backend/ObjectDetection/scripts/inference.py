@@ -1,10 +1,14 @@
-import torch as T
-from PIL import Image
 import sys
 from pathlib import Path
 import argparse
+import hashlib
+import json
 import logging
+import os
 import shutil
+import tempfile
+
+import torch
 
 logging.basicConfig(
     level=logging.DEBUG,
@@ -20,26 +24,157 @@ for path in [BACKEND_DIR, YOLO_DIR]:
         sys.path.append(str(path))
 
 from YOLO.detect import run
+from ObjectDetection.scripts.detector import Detector
+from ObjectDetection.scripts.sequences import SequenceTracker, capture_info, group_sequences
+from utils.dataloaders import VID_FORMATS, load_image_file, video_keyframes
+from utils.prefilter import Backgrounds, EmptyFramePrefilter
 
 WEIGHTS_PATH = YOLO_DIR / "runs/train/wii_28_072/weights/best.pt"
+DATA_PATH = YOLO_DIR / "data/wii_aite_2022_testing.yaml"
+CACHE_DIR = Path(os.getenv('DETECTION_CACHE_DIR', YOLO_DIR / "runs/cache"))  # compiled model artifacts
+IMGSZ = (640, 640)
+BATCH_SIZE = int(os.getenv('DETECTION_BATCH_SIZE', 16))
+# Images per forward pass within a batch, the next ones are decoded while these run
+PIPELINE_BATCH_SIZE = int(os.getenv('DETECTION_PIPELINE_BATCH_SIZE', max(1, BATCH_SIZE // 4)))
+# Input shape buckets as 'HxW,...', e.g. '480x640,640x640,640x480'; empty pads every image to IMGSZ
+DETECTION_BUCKETS = [tuple(map(int, b.split('x'))) for b in os.getenv('DETECTION_BUCKETS', '').split(',') if b]
+DETECTION_BACKEND = os.getenv('DETECTION_BACKEND', 'torchscript').lower()  # one of BACKENDS
+DETECTION_THREADS = int(os.getenv('DETECTION_THREADS', 0))  # onnx/openvino threads, 0 = runtime default
+DETECTION_INT8 = os.getenv('DETECTION_INT8', 'false').lower() in ('1', 'true', 'yes')  # onnx backend only
+CALIBRATION_DIR = os.getenv('DETECTION_CALIBRATION_DIR')  # INT8 calibration images from the deployment's cameras
+TILE_SIZE = int(os.getenv('DETECTION_TILE_SIZE', 640))  # tiled inference crop size in pixels
+TILE_OVERLAP = float(os.getenv('DETECTION_TILE_OVERLAP', 0.2))  # fraction of a tile shared with its neighbour
+VIDEO_SAMPLE_FPS = float(os.getenv('VIDEO_SAMPLE_FPS', 2))  # frames scored per second of video
+VIDEO_SCENE_THRESHOLD = float(os.getenv('VIDEO_SCENE_THRESHOLD', 0.02))  # changed fraction of frame for a keyframe
+VIDEO_MAX_GAP = float(os.getenv('VIDEO_MAX_GAP', 10))  # seconds, longest stretch of video without a keyframe
+SEQUENCE_MAX_GAP = float(os.getenv('SEQUENCE_MAX_GAP', 5))  # seconds between burst images of one sequence
+SEQUENCE_MAX_LEN = int(os.getenv('SEQUENCE_MAX_LEN', 20))  # images per sequence
+PREFILTER = os.getenv('PREFILTER', 'false').lower() in ('1', 'true', 'yes')  # skip detection on likely-empty images
+PREFILTER_THRESHOLD = float(os.getenv('PREFILTER_THRESHOLD', 0.003))  # changed image fraction that is not empty
+PREFILTER_AUDIT = float(os.getenv('PREFILTER_AUDIT', 0.02))  # fraction of likely-empty images detected anyway
+PREFILTER_CAMERAS = int(os.getenv('PREFILTER_CAMERAS', 1000))  # camera backgrounds kept across uploads
+
+BACKENDS = ('pytorch', 'torchscript', 'onnx', 'openvino')
+
+def weights_digest(weights):
+    # Content hash of the weights file. It is remembered in a CACHE_DIR sidecar against the file's size and mtime, so
+    # later starts and workers don't hash the whole checkpoint again
+    weights = Path(weights)
+    st = weights.stat()
+    stamp = {'path': str(weights.resolve()), 'size': st.st_size, 'mtime_ns': st.st_mtime_ns}
+    sidecar = CACHE_DIR / f"{weights.name}.digest"
+    try:
+        saved = json.loads(sidecar.read_text())
+        if all(saved.get(k) == v for k, v in stamp.items()):
+            return saved['digest']
+    except (OSError, ValueError, KeyError, AttributeError):
+        pass
+
+    h = hashlib.blake2b(digest_size=8)
+    with open(weights, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+    digest = h.hexdigest()
+    try:
+        CACHE_DIR.mkdir(parents=True, exist_ok=True)
+        with tempfile.NamedTemporaryFile('w', dir=CACHE_DIR, suffix='.tmp', delete=False) as f:
+            json.dump({**stamp, 'digest': digest}, f)
+        os.replace(f.name, sidecar)  # atomic
+    except OSError as err:
+        logger.warning(f"Could not save the digest of {weights}: {err}")
+    return digest
+
+def export_device():
+    # Device Detector will run on (select_device('') picks the first GPU), traces are exported there
+    return '0' if torch.cuda.is_available() else 'cpu'
+
+def weights_key(weights, imgsz=IMGSZ, device='cpu'):
+    # Cache key: weights content, input size, torch version (TorchScript files are tied to it) and export device
+    h = hashlib.blake2b(digest_size=8)
+    h.update(f"{weights_digest(weights)} {tuple(imgsz)} {torch.__version__} {device}".encode())
+    return h.hexdigest()
+
+def torchscript_weights(weights, imgsz=IMGSZ, device=None):
+    """Return a fused, eval-mode TorchScript trace of `weights` from CACHE_DIR, creating it on first use.
+
+    Later starts only deserialize the trace: no checkpoint unpickling and no Conv+BN fusing.
+    The trace is exported on `device` (default: export_device()), the one it will be loaded on.
+    """
+    device = device or export_device()
+    path = CACHE_DIR / f"{weights.stem}-{weights_key(weights, imgsz, device)}.torchscript"
+    if path.exists():
+        return path
+
+    from YOLO.export import run as export
+
+    logger.info(f"Compiling {weights} to {path}")
+    CACHE_DIR.mkdir(parents=True, exist_ok=True)
+    with tempfile.TemporaryDirectory(dir=CACHE_DIR) as tmp:  # private copy, workers may compile at the same time
+        src = Path(tmp) / weights.name
+        shutil.copy2(weights, src)
+        export(data=DATA_PATH, weights=src, imgsz=imgsz, device=device, include=('torchscript',))
+        if not src.with_suffix('.torchscript').exists():
+            raise RuntimeError(f"TorchScript export of {weights} failed")
+        os.replace(src.with_suffix('.torchscript'), path)  # atomic
+    return path
 
-def load_model():
+def backend_weights(backend=DETECTION_BACKEND, int8=DETECTION_INT8, dynamic=True, calib=CALIBRATION_DIR):
+    """Return the model file for `backend`, exporting it from the PyTorch weights on first use.
+
+    ONNX and OpenVINO exports are cached in CACHE_DIR like TorchScript traces,
+    keyed by weights_key and the dynamic (batch size) and int8 flags, so
+    retrained weights are exported again. INT8 calibration needs images like
+    the deployment's in `calib`.
+    """
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown detection backend '{backend}', expected one of {BACKENDS}")
+    if backend == 'pytorch':
+        return WEIGHTS_PATH
+    if backend == 'torchscript':
+        return torchscript_weights(WEIGHTS_PATH)
+    if int8 and backend != 'onnx':
+        raise ValueError("INT8 quantization is only supported for the onnx backend")
+
+    name = f"{WEIGHTS_PATH.stem}-{weights_key(WEIGHTS_PATH)}{'-dynamic' if dynamic else ''}{'-int8' if int8 else ''}"
+    path = CACHE_DIR / (name + ('.onnx' if backend == 'onnx' else '_openvino_model'))
+    if path.exists():
+        return path
+    if int8 and not (calib and Path(calib).is_dir()):
+        raise ValueError(f"INT8 quantization needs a directory of calibration images from the deployment's cameras, "
+                         f"set DETECTION_CALIBRATION_DIR (got {calib!r})")
+
+    from YOLO.export import run as export
+
+    logger.info(f"Exporting {WEIGHTS_PATH} to {path}")
+    CACHE_DIR.mkdir(parents=True, exist_ok=True)
+    with tempfile.TemporaryDirectory(dir=CACHE_DIR) as tmp:  # private copy, workers may export at the same time
+        src = Path(tmp) / WEIGHTS_PATH.name
+        shutil.copy2(WEIGHTS_PATH, src)
+        export(data=DATA_PATH, weights=src, imgsz=IMGSZ, include=(backend,), dynamic=dynamic, int8=int8, calib=calib)
+        out = src.with_name(src.stem + ('-int8.onnx' if int8 else '.onnx' if backend == 'onnx' else '_openvino_model'))
+        if not out.exists():
+            raise RuntimeError(f"Export of {WEIGHTS_PATH} to {backend} failed")
+        try:
+            os.replace(out, path)  # atomic
+        except OSError:
+            if not path.exists():  # else another worker's export of a directory won
+                raise
+    return path
+
+def load_model(backend=DETECTION_BACKEND, int8=DETECTION_INT8, threads=DETECTION_THREADS, buckets=DETECTION_BUCKETS):
     logger.debug(f"Loading model from path: {WEIGHTS_PATH}")
     
     if not WEIGHTS_PATH.exists():
         logger.error(f"Weights file not found at {str(WEIGHTS_PATH)}")
         raise FileNotFoundError(f"Weights file not found at {str(WEIGHTS_PATH)}")
+    if buckets and backend == 'torchscript':
+        raise ValueError("TorchScript traces have a fixed input shape, shape buckets need the pytorch, onnx "
+                         "or openvino backend")
 
-    try:    
-        from ultralytics import YOLO
-        model = YOLO(str(WEIGHTS_PATH))
-        
-        device = 'cuda' if T.cuda.is_available() else 'cpu'
-        logger.info(f"Using device: {device}")
-        
-        model = model.to(device)
-        model.eval()
-        
+    try:
+        weights = backend_weights(backend, int8)
+        model = Detector(weights, data=DATA_PATH, imgsz=IMGSZ, threads=threads, buckets=buckets)
+        logger.info(f"Using device: {model.device}, backend: {backend}{' (int8)' if int8 else ''}, weights: {weights}")
         logger.info("Model loaded successfully")
         return model
 
@@ -48,45 +183,40 @@ def load_model():
         logger.exception(err)
         raise RuntimeError(f"Failed to load YOLOv5 model: {str(err)}")
 
-def parse_detection_line(line, img_width, img_height):
-    class_id, x_center, y_center, width, height, conf = map(float, line.strip().split())
+def detection_to_dict(det):
+    x1, y1, x2, y2, conf, class_id = det.tolist()
     
     return {
-        "x": x_center * img_width,
-        "y": y_center * img_height,
-        "width": width * img_width,
-        "height": height * img_height,
+        "x": (x1 + x2) / 2,
+        "y": (y1 + y2) / 2,
+        "width": x2 - x1,
+        "height": y2 - y1,
         "confidence": conf,
         "class_id": int(class_id)
     }
 
-def run_inference(image_path, model):
+def read_image(image_path):
+    img, reason = load_image_file(str(image_path))
+    if img is None:
+        logger.error(f"Could not read image {image_path}: {reason}")
+    return img
+
+def detect_tiled(model, img):
+    return model.detect_tiled(img, tile=TILE_SIZE, overlap=TILE_OVERLAP)
+
+def run_inference(image_path, model, tiled=False):
     logger.debug(f"Starting inference on image: {image_path}")
     
-    with Image.open(image_path) as img:
-        img_width, img_height = img.size
-        logger.debug(f"Original image dimensions: {img_width}x{img_height}")
+    img = read_image(image_path)
+    if img is None:
+        raise RuntimeError(f"Inference failed: could not read image {image_path}")
+    logger.debug(f"Original image dimensions: {img.shape[1]}x{img.shape[0]}")
 
     try:
-        results = run(
-            weights=str(WEIGHTS_PATH),
-            source=image_path,
-            save_txt=True,
-            save_conf=True,
-            exist_ok=True,
-            nosave=True
-        )
-        
-        detections = []
-        image_name = Path(image_path).stem
-        labels_path = YOLO_DIR / "runs/detect/exp/labels" / f"{image_name}.txt"
-        
-        if labels_path.exists():
-            with open(labels_path, 'r') as f:
-                for line in f:
-                    detection = parse_detection_line(line, img_width, img_height)
-                    detections.append(detection)
-                    logger.debug(f"Detection (scaled): {detection}")
+        dets = detect_tiled(model, img) if tiled else model.detect(img)
+        detections = [detection_to_dict(det) for det in dets]
+        for detection in detections:
+            logger.debug(f"Detection (scaled): {detection}")
         
         logger.info(f"Processed {len(detections)} detections")
         return detections
@@ -96,6 +226,170 @@ def run_inference(image_path, model):
         logger.exception(err)
         raise RuntimeError(f"Inference failed: {str(err)}")
 
+def run_batch_inference(image_paths, model, batch_size=BATCH_SIZE, tiled=False):
+    """Run detection on many images, batch_size images per forward pass.
+
+    Upcoming images are decoded and letterboxed in the model's decode pool while
+    it runs on the current batch, so a batch_size smaller than the number of
+    images (e.g. PIPELINE_BATCH_SIZE) overlaps decode with inference. Returns one entry per path, in order: the
+    list of detections, or None if the image could not be read or its batch failed.
+    With tiled=True each image goes through sliced inference instead, its tiles
+    forming the batches.
+    """
+    results = [None] * len(image_paths)
+    if tiled:
+        for i, path in enumerate(image_paths):
+            img = read_image(path)
+            if img is None:
+                continue
+            try:
+                results[i] = [detection_to_dict(det) for det in detect_tiled(model, img)]
+            except Exception as err:
+                logger.error(f"Tiled inference failed for {path}: {str(err)}")
+                logger.exception(err)
+        return results
+
+    existing = [path for path in image_paths if os.path.isfile(path)]
+    for path in set(image_paths) - set(existing):
+        logger.error(f"Inference failed: could not read image {path}")
+    try:
+        loader = model.loader(existing, prefetch=2 * batch_size)
+    except AssertionError as err:  # no images left
+        logger.error(f"Batch inference failed: {str(err)}")
+        return results
+    positions = {str(Path(path).resolve()): i for i, path in enumerate(image_paths)}  # loader paths are resolved
+
+    def run_batch(batch):
+        try:
+            dets = model.detect_preprocessed([img for _, img, _ in batch], [img0 for _, _, img0 in batch])
+            for (i, _, _), det in zip(batch, dets):
+                results[i] = [detection_to_dict(d) for d in det]
+        except Exception as err:
+            logger.error(f"Batch inference failed: {str(err)}")
+            logger.exception(err)
+        logger.info(f"Processed batch of {len(batch)} images")
+
+    batches = {}  # one per input shape (bucket)
+    for path, img, img0, _, _ in loader:
+        batch = batches.setdefault(img.shape, [])
+        batch.append((positions[path], img, img0))
+        if len(batch) == batch_size:
+            run_batch(batch)
+            batches[img.shape] = []
+    for batch in batches.values():
+        if batch:
+            run_batch(batch)
+    return results
+
+prefilter_backgrounds = Backgrounds(max_keys=PREFILTER_CAMERAS)
+
+def make_prefilter(user_id):
+    """Empty-frame prefilter for one upload of `user_id`.
+
+    Images are compared with earlier images of the same user and EXIF camera
+    (make, model and serial number), including those of previous uploads.
+    Images without an EXIF camera always go to the detector.
+    """
+    def key(path):
+        camera = capture_info(path)[0]
+        return None if camera is None else (user_id, camera)
+
+    return EmptyFramePrefilter(threshold=PREFILTER_THRESHOLD, audit=PREFILTER_AUDIT, key=key,
+                               backgrounds=prefilter_backgrounds)
+
+def read_keyframes(video_path):
+    """Yield (frame_index, timestamp, scene_score, frame) for the keyframes of a video, see video_keyframes()."""
+    return video_keyframes(video_path, VIDEO_SAMPLE_FPS, VIDEO_SCENE_THRESHOLD, VIDEO_MAX_GAP)
+
+def run_frame_inference(frames, model):
+    """Run detection on decoded BGR frames in one forward pass, one entry per frame (None if the batch failed)."""
+    try:
+        return [[detection_to_dict(det) for det in dets] for dets in model.detect_batch(frames)]
+    except Exception as err:
+        logger.error(f"Frame inference failed: {str(err)}")
+        logger.exception(err)
+        return [None] * len(frames)
+
+def run_video_inference(video_path, model, batch_size=BATCH_SIZE):
+    """Run detection on the keyframes of a video only, batch_size keyframes per forward pass.
+
+    Returns one dict per keyframe with its frame_index, timestamp (seconds),
+    scene_score and detections (None if its batch failed).
+    """
+    results = []
+    batch = []
+
+    def run_batch(batch):
+        detections = run_frame_inference([frame for *_, frame in batch], model)
+        for (frame_index, timestamp, score, _), dets in zip(batch, detections):
+            results.append({
+                "frame_index": frame_index,
+                "timestamp": timestamp,
+                "scene_score": score,
+                "detections": dets
+            })
+
+    for keyframe in read_keyframes(video_path):
+        batch.append(keyframe)
+        if len(batch) == batch_size:
+            run_batch(batch)
+            batch = []
+    if batch:
+        run_batch(batch)
+    logger.info(f"Processed {len(results)} keyframes of {video_path}")
+    return results
+
+def read_sequences(image_paths):
+    """Group image paths into burst sequences, see group_sequences(). Each sequence also lists its paths."""
+    sequences = group_sequences(image_paths, SEQUENCE_MAX_GAP, SEQUENCE_MAX_LEN)
+    for seq in sequences:
+        seq["paths"] = [image_paths[i] for i in seq["indices"]]
+    return sequences
+
+def run_sequence_inference(sequences, model):
+    """Run detection on burst sequences, each a list of image paths in capture order.
+
+    The first image of a sequence is detected and its boxes are tracked into the
+    following images (SequenceTracker); the detector only runs again on an image
+    whose boxes can't be followed or that shows new activity. Sequences advance
+    in lockstep so the images that do need the detector share forward passes.
+    Returns, per sequence, one entry per image: a dict with its detections and
+    whether they were tracked, or None if the image could not be read or its
+    batch failed.
+    """
+    results = [[None] * len(seq) for seq in sequences]
+    trackers = [SequenceTracker() for _ in sequences]
+    detected = tracked = 0
+    for t in range(max(map(len, sequences), default=0)):
+        todo = []
+        for k, seq in enumerate(sequences):
+            if t >= len(seq):
+                continue
+            img = read_image(seq[t])
+            if img is None:
+                continue
+            det = trackers[k].propagate(img)
+            if det is None:
+                todo.append((k, img))
+            else:
+                results[k][t] = {"detections": [detection_to_dict(d) for d in det], "tracked": True}
+                tracked += 1
+        if not todo:
+            continue
+        try:
+            dets = model.detect_batch([img for _, img in todo])
+        except Exception as err:
+            logger.error(f"Sequence inference failed: {str(err)}")
+            logger.exception(err)
+            dets = [None] * len(todo)
+        for (k, img), det in zip(todo, dets):
+            trackers[k].reset(img, det)
+            if det is not None:
+                results[k][t] = {"detections": [detection_to_dict(d) for d in det], "tracked": False}
+                detected += 1
+    logger.info(f"Processed {len(sequences)} sequences: {detected} images detected, {tracked} tracked")
+    return results
+
 def setup_directories(storage_path):
     paths = {
         'raw': storage_path / "raw_images",
@@ -175,7 +175,10 @@ def initialize_database():
                 
             return drop_database() and create_database() and create_tables()
                 
-        return db_exists or (create_database() and create_tables())
+        if db_exists:
+            return create_tables()  # schema.sql only adds tables that are missing, i.e. added since the last start
+
+        return create_database() and create_tables()
             
     except Error as e:
         print(f"Error initializing database: {e}")
@@ -36,4 +36,63 @@ CREATE TABLE IF NOT EXISTS annotations (
     height FLOAT NOT NULL,
     cluster_centers JSONB NOT NULL,
     created_at TIMESTAMP DEFAULT NOW()
+);
+
+CREATE TABLE IF NOT EXISTS video_frames (
+    id SERIAL PRIMARY KEY,
+    image_id INTEGER REFERENCES images(id),
+    frame_index INTEGER NOT NULL,
+    timestamp_sec FLOAT NOT NULL,
+    scene_score FLOAT NOT NULL,
+    created_at TIMESTAMP DEFAULT NOW()
+);
+
+CREATE TABLE IF NOT EXISTS frame_boxes (
+    id SERIAL PRIMARY KEY,
+    frame_id INTEGER REFERENCES video_frames(id),
+    class_id INTEGER REFERENCES classes(id),
+    x FLOAT NOT NULL,
+    y FLOAT NOT NULL,
+    width FLOAT NOT NULL,
+    height FLOAT NOT NULL,
+    confidence FLOAT NOT NULL,
+    created_at TIMESTAMP DEFAULT NOW()
+);
+
+CREATE TABLE IF NOT EXISTS prefilter_results (
+    id SERIAL PRIMARY KEY,
+    image_id INTEGER REFERENCES images(id),
+    score FLOAT NOT NULL,
+    empty BOOLEAN NOT NULL,
+    audited BOOLEAN NOT NULL,
+    detections INTEGER,
+    created_at TIMESTAMP DEFAULT NOW()
+);
+
+CREATE TABLE IF NOT EXISTS sequences (
+    id SERIAL PRIMARY KEY,
+    user_id INTEGER REFERENCES users(id),
+    camera TEXT NOT NULL,
+    start_time TIMESTAMP NOT NULL,
+    end_time TIMESTAMP NOT NULL,
+    image_count INTEGER NOT NULL,
+    created_at TIMESTAMP DEFAULT NOW()
+);
+
+CREATE TABLE IF NOT EXISTS sequence_images (
+    sequence_id INTEGER REFERENCES sequences(id),
+    image_id INTEGER REFERENCES images(id),
+    position INTEGER NOT NULL,
+    tracked BOOLEAN NOT NULL,
+    PRIMARY KEY (sequence_id, image_id)
+);
+
+CREATE TABLE IF NOT EXISTS sequence_species (
+    id SERIAL PRIMARY KEY,
+    sequence_id INTEGER REFERENCES sequences(id),
+    class_id INTEGER REFERENCES classes(id),
+    max_count INTEGER NOT NULL,
+    images INTEGER NOT NULL,
+    max_confidence FLOAT NOT NULL,
+    created_at TIMESTAMP DEFAULT NOW()
 );
\ No newline at end of file
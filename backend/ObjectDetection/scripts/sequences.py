@@ -0,0 +1,202 @@
+import argparse
+import logging
+import os
+from datetime import datetime
+
+import cv2
+import numpy as np
+from PIL import Image
+
+logger = logging.getLogger(__name__)
+
+EXIF_IFD = 0x8769
+DATETIME_ORIGINAL = 0x9003
+DATETIME = 0x0132
+MAKE, MODEL = 0x010F, 0x0110
+BODY_SERIAL = 0xA431
+UNKNOWN_CAMERA = "unknown"  # camera of images that are not grouped
+
+
+def file_time(path):
+    """Modification time of a file in seconds, 0.0 when it can't be read."""
+    try:
+        return os.path.getmtime(path)
+    except OSError:
+        return 0.0
+
+
+def capture_info(path, file_fallback=False):
+    """Return (camera, timestamp) of an image from its EXIF data.
+
+    The camera is make, model and body serial number and the timestamp is
+    DateTimeOriginal in seconds, falling back to DateTime; either is None when
+    the EXIF data doesn't have it. With file_fallback they default to the
+    image's directory and modification time instead, which only makes sense
+    for folders of camera trap images copied with their times preserved.
+    """
+    camera = timestamp = None
+    try:
+        with Image.open(path) as img:
+            exif = img.getexif()
+        sub = exif.get_ifd(EXIF_IFD)
+        camera = " ".join(str(v).strip() for v in (exif.get(MAKE), exif.get(MODEL), sub.get(BODY_SERIAL)) if v) or None
+        taken = sub.get(DATETIME_ORIGINAL) or exif.get(DATETIME)
+        if taken:
+            timestamp = datetime.strptime(str(taken).strip("\x00 "), "%Y:%m:%d %H:%M:%S").timestamp()
+    except Exception as err:
+        logger.debug(f"No EXIF data for {path}: {err}")
+    if file_fallback and camera is None:
+        camera = os.path.dirname(os.path.abspath(path))
+    if file_fallback and timestamp is None:
+        timestamp = os.path.getmtime(path)
+    return camera, timestamp
+
+
+def group_sequences(paths, max_gap=5.0, max_len=20, file_fallback=False):
+    """Split images into camera-trap bursts.
+
+    Images of the same camera taken at most max_gap seconds after the previous
+    one form a sequence of at most max_len images. An image without an EXIF
+    camera or capture time (see capture_info for file_fallback) is a sequence
+    of its own, with camera UNKNOWN_CAMERA unless it has one and its file time
+    as start and end. Returns a list of dicts with the camera, start and end
+    timestamps and the indices into `paths`: the grouped sequences in capture
+    order, then the single images in the order of `paths`.
+    """
+    info, single = [], []
+    for i, path in enumerate(paths):
+        try:
+            camera, timestamp = capture_info(path, file_fallback)
+        except OSError as err:  # missing file, reported by the detector
+            logger.error(f"Could not read {path}: {err}")
+            camera = timestamp = None
+        if camera is None or timestamp is None:
+            t = file_time(path) if timestamp is None else timestamp
+            single.append({"camera": camera or UNKNOWN_CAMERA, "start": t, "end": t, "indices": [i]})
+        else:
+            info.append((camera, timestamp, i))
+    info.sort(key=lambda x: (x[0], x[1], str(paths[x[2]])))
+
+    sequences = []
+    for camera, timestamp, i in info:
+        seq = sequences[-1] if sequences else None
+        if seq is None or seq["camera"] != camera or timestamp - seq["end"] > max_gap or len(seq["indices"]) >= max_len:
+            seq = {"camera": camera, "start": timestamp, "end": timestamp, "indices": []}
+            sequences.append(seq)
+        seq["end"] = timestamp
+        seq["indices"].append(i)
+    return sequences + single
+
+
+class SequenceTracker:
+    """Carries detections from one burst frame to the next without running the detector.
+
+    After reset() with a detected frame, propagate() follows every box into the
+    next frame by template matching (normalized cross-correlation on a grayscale
+    copy `width` pixels wide, searched within `search` box sizes of its last
+    position). It returns the moved (n, 6) detections, or None when the full
+    detector has to run instead: a box could not be matched with a score of at
+    least match_thres, or more than change_thres of the frame outside the boxes
+    changed, i.e. something new entered.
+    """
+
+    def __init__(self, width=480, match_thres=0.6, search=0.5, change_thres=0.003, pixel_thres=25):
+        self.width = width
+        self.match_thres = match_thres
+        self.search = search
+        self.change_thres = change_thres
+        self.pixel_thres = pixel_thres
+        self.gray = self.det = None
+
+    def _small(self, img0):
+        h, w = img0.shape[:2]
+        s = min(1.0, self.width / w)
+        gray = cv2.cvtColor(img0, cv2.COLOR_BGR2GRAY)
+        gray = cv2.resize(gray, (round(w * s), round(h * s)), interpolation=cv2.INTER_AREA)
+        return gray, s
+
+    def reset(self, img0, det):
+        # det: detector output for img0, None forces detection of the next frame
+        self.gray = self._small(img0)[0] if det is not None else None
+        self.det = det
+
+    def _changed(self, gray, boxes):
+        # Fraction of pixels outside the boxes whose exposure-normalised brightness changed
+        mask = np.ones(gray.shape, bool)
+        for x1, y1, x2, y2 in boxes:
+            mask[max(int(y1), 0):int(np.ceil(y2)), max(int(x1), 0):int(np.ceil(x2))] = False
+        if not mask.any():
+            return 0.0
+        a, b = self.gray.astype(np.float32), gray.astype(np.float32)
+        a -= a[mask].mean()
+        b -= b[mask].mean()
+        return float((np.abs(a - b)[mask] > self.pixel_thres).mean())
+
+    def propagate(self, img0):
+        if self.det is None:
+            return None
+        gray, s = self._small(img0)
+        if gray.shape != self.gray.shape:
+            return None
+        h, w = gray.shape
+        det = self.det.copy()
+        old = det[:, :4] * s
+        new = old.copy()
+        for k, (x1, y1, x2, y2) in enumerate(old):
+            ix1, iy1, ix2, iy2 = int(x1), int(y1), int(np.ceil(x2)), int(np.ceil(y2))
+            template = self.gray[max(iy1, 0):iy2, max(ix1, 0):ix2]
+            if min(template.shape) < 4:
+                return None  # too small to match, detect again
+            mx, my = int((x2 - x1) * self.search) + 1, int((y2 - y1) * self.search) + 1
+            sx1, sy1 = max(ix1 - mx, 0), max(iy1 - my, 0)
+            region = gray[sy1:min(iy2 + my, h), sx1:min(ix2 + mx, w)]
+            if region.shape[0] < template.shape[0] or region.shape[1] < template.shape[1]:
+                return None
+            _, score, _, (dx, dy) = cv2.minMaxLoc(cv2.matchTemplate(region, template, cv2.TM_CCOEFF_NORMED))
+            if score < self.match_thres:
+                return None
+            new[k] += (sx1 + dx - max(ix1, 0), sy1 + dy - max(iy1, 0)) * 2
+        if self._changed(gray, np.concatenate([old, new])) > self.change_thres:
+            return None
+        det[:, :4] = new / s
+        self.gray, self.det = gray, det
+        return det
+
+
+def sequence_summary(results):
+    """Species summary of a sequence from its per-image detections.
+
+    For every class: the largest number of boxes in one image (a lower bound on
+    the individuals seen), the number of images it appears in and its highest
+    confidence, ordered by class id.
+    """
+    summary = {}
+    for detections in results:
+        counts = {}
+        for box in detections or []:
+            counts[box["class_id"]] = counts.get(box["class_id"], 0) + 1
+            s = summary.setdefault(box["class_id"], {"class_id": box["class_id"], "max_count": 0, "images": 0,
+                                                     "max_confidence": 0.0})
+            s["max_confidence"] = max(s["max_confidence"], box["confidence"])
+        for class_id, n in counts.items():
+            summary[class_id]["max_count"] = max(summary[class_id]["max_count"], n)
+            summary[class_id]["images"] += 1
+    return [summary[k] for k in sorted(summary)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Group camera trap images into burst sequences")
+    parser.add_argument('images', nargs='+', help='Image paths')
+    parser.add_argument('--max-gap', type=float, default=5.0, help='Seconds between images of one sequence')
+    parser.add_argument('--max-len', type=int, default=20, help='Images per sequence')
+    parser.add_argument('--file-fallback', action='store_true',
+                        help='Group images without EXIF data by directory and modification time')
+    args = parser.parse_args()
+
+    for seq in group_sequences(args.images, args.max_gap, args.max_len, args.file_fallback):
+        start = datetime.fromtimestamp(seq["start"]).isoformat(sep=" ")
+        print(f"{seq['camera']}  {start}  {len(seq['indices'])} images: "
+              + " ".join(args.images[i] for i in seq["indices"]))
+
+if __name__ == "__main__":
+    main()
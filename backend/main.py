@@ -1,3 +1,6 @@
+import asyncio
+import base64
+import hashlib
 import io
 import json
 import logging
@@ -5,12 +8,16 @@ import os
 import secrets
 import time
 import uuid
+from functools import partial
+from itertools import islice
 from typing import List, Optional
 from zipfile import ZipFile
 import zipfile
 
 import cv2
+import numpy as np
 import psycopg2
+import torch
 from psycopg2.extras import DictCursor
 from PIL import Image
 import torchvision.transforms.functional as TF
@@ -24,8 +31,14 @@ from starlette.middleware.sessions import SessionMiddleware
 from starlette.responses import FileResponse, JSONResponse
 
 from ObjectDetection.scripts.initialize_database import initialize_database
-from ObjectDetection.scripts.inference import load_model, run_inference
-import BirdCount.model_files.demomodified as demo
+from ObjectDetection.scripts.inference import (BATCH_SIZE, PIPELINE_BATCH_SIZE, PREFILTER, VID_FORMATS, load_model,
+                                               make_prefilter, read_keyframes, read_sequences, run_batch_inference,
+                                               run_frame_inference, run_sequence_inference)
+from ObjectDetection.scripts.sequences import sequence_summary
+from BirdCount.model_files.runtime import ANALYSIS_OUTPUTS, CLUSTER_PARAMETERS, parse_levels
+from model_loader import ModelLoader
+from scheduler import BatchScheduler
+from worker_pool import InferencePool
 
 
 from dotenv import load_dotenv
@@ -42,15 +55,30 @@ DB_CONFIG = {
     "port": os.getenv('DB_PORT')
 }
 
+SCHEDULER_MAX_WAIT_MS = float(os.getenv('SCHEDULER_MAX_WAIT_MS', 10))
+COUNT_BATCH_SIZE = int(os.getenv('COUNT_BATCH_SIZE', 4))
+INFERENCE_WORKERS = int(os.getenv('INFERENCE_WORKERS', 0))  # forked inference processes, 0 = run in the API process
+# torch intra-op threads of the API process, or of each worker; 0 = runtime default, cores / workers with workers
+INFERENCE_THREADS = int(os.getenv('INFERENCE_THREADS', 0))
+BIRDCOUNT_LOADING = os.getenv('BIRDCOUNT_LOADING', 'background').lower()  # background, lazy (first request) or eager
+BIRDCOUNT_IDLE_SECONDS = float(os.getenv('BIRDCOUNT_IDLE_SECONDS', 0))  # unload the counting model when idle, 0 = never
+SESSION_SECRET = os.getenv('SESSION_SECRET')
+if not SESSION_SECRET:
+    logger.warning("SESSION_SECRET is not set, sessions will not survive a restart or be shared between processes")
+    SESSION_SECRET = secrets.token_urlsafe(32)
+
 UPLOAD_DIR = "uploads"
 os.makedirs(UPLOAD_DIR, exist_ok=True)
 
+# The counting model is built and loaded when its module is imported, which is kept off the startup path
+birdcount = ModelLoader("BirdCount.model_files.demomodified", "birdcount", idle_timeout=BIRDCOUNT_IDLE_SECONDS)
+
 app = FastAPI()
 app.mount("/uploads", StaticFiles(directory=UPLOAD_DIR), name="uploads")
 
 app.add_middleware(
     SessionMiddleware,
-    secret_key=secrets.token_urlsafe(32),
+    secret_key=SESSION_SECRET,
     session_cookie="wildlife_session",
     max_age=7200,
     https_only=False
@@ -88,14 +116,81 @@ async def startup_event():
         if not initialize_database():
             raise Exception("Failed to initialize database")
         logger.info("Database configuration verified successfully")
-        
+
+        if INFERENCE_THREADS:
+            torch.set_num_threads(INFERENCE_THREADS)  # process-wide, the only place both models get it from
+        if BIRDCOUNT_LOADING == "background" and INFERENCE_WORKERS == 0:
+            birdcount.start()  # loads while the YOLO model loads and detection requests are served
+
         app.state.model = load_model()
         logger.info("YOLO model loaded successfully")
+
+        # Workers are forked once both models are loaded and share their weights; the detection scheduler can
+        # then keep every worker busy. Unloading the counting model would not free the workers' shared copy.
+        # The counting model's latent and cluster caches live in each worker, so BirdCount requests get one
+        # scheduler per worker and are routed to it by image content
+        runner, concurrency = None, 1
+        count_runners = [None]
+        app.state.pool = None
+        if INFERENCE_WORKERS > 0 or BIRDCOUNT_LOADING == "eager":
+            if INFERENCE_WORKERS > 0:
+                birdcount.idle_timeout = 0
+            birdcount.start(background=False)
+        if INFERENCE_WORKERS > 0:
+            try:
+                app.state.pool = InferencePool(INFERENCE_WORKERS, INFERENCE_THREADS)
+                app.state.pool.start()
+                runner, concurrency = app.state.pool.run, INFERENCE_WORKERS
+                count_runners = [partial(app.state.pool.run, worker=i) for i in range(INFERENCE_WORKERS)]
+            except RuntimeError as e:
+                logger.warning(f"Inference pool disabled, running in the API process: {e}")
+                app.state.pool = None
+
+        app.state.detection_scheduler = BatchScheduler(
+            run_detection_batch,
+            max_batch_size=BATCH_SIZE,
+            max_wait_ms=SCHEDULER_MAX_WAIT_MS,
+            name="detection",
+            runner=runner,
+            concurrency=concurrency
+        )
+        app.state.count_schedulers = [
+            BatchScheduler(
+                run_birdcount_batch,
+                max_batch_size=COUNT_BATCH_SIZE,
+                max_wait_ms=SCHEDULER_MAX_WAIT_MS,
+                name="birdcount" if len(count_runners) == 1 else f"birdcount-{i}",
+                runner=count_runner
+            )
+            for i, count_runner in enumerate(count_runners)
+        ]
+        app.state.detection_scheduler.start()
+        for scheduler in app.state.count_schedulers:
+            scheduler.start()
     except Exception as e:
         logger.error(f"Initialization error: {e}")
         raise RuntimeError("Could not initialize application")
 
 
+@app.on_event("shutdown")
+async def shutdown_event():
+    await app.state.detection_scheduler.stop()
+    for scheduler in app.state.count_schedulers:
+        await scheduler.stop()
+    if app.state.pool is not None:
+        app.state.pool.stop()
+    birdcount.stop()
+
+
+@app.get("/ready")
+async def ready():
+    # Object detection is ready once startup completes; the counting model may still be loading or unloaded
+    # (it loads on the next BirdCount request then)
+    detection = getattr(app.state, "detection_scheduler", None) is not None
+    body = {"ready": detection, "object_detection": {"ready": detection}, "bird_count": birdcount.status()}
+    return JSONResponse(content=body, status_code=200 if detection else 503)
+
+
 @app.get("/images/ObjectDetection/")
 async def get_images(request: Request, class_id: Optional[int] = None, image_id: Optional[int] = None):
     user_id = await get_user_id(request)
@@ -153,16 +248,165 @@ async def get_boxes(request: Request, image_id: int):
         return {"error": str(e)}
 
 
+def insert_boxes(cur, image_id, detections, table="boxes", key="image_id"):
+    # Video keyframe detections go to frame_boxes, keyed by frame_id
+    for box in detections:
+        cur.execute(
+            f"""
+            INSERT INTO {table} ({key}, class_id, x, y, width, height, confidence) 
+            VALUES (%s, %s, %s, %s, %s, %s, %s)
+            """,
+            (
+                image_id,
+                box['class_id'],
+                box['x'],
+                box['y'],
+                box['width'],
+                box['height'],
+                box['confidence']
+            )
+        )
+
+
+def run_detection_batch(items):
+    # Items are (source, tiled) pairs, source being an image path, a decoded video keyframe or a tuple of
+    # image paths forming a burst sequence. Keyframes, sequences, whole-image and tiled requests are run
+    # as separate groups. Whole images run PIPELINE_BATCH_SIZE at a time, the next ones decode meanwhile
+    results = [None] * len(items)
+    frames = [i for i, (source, _) in enumerate(items) if isinstance(source, np.ndarray)]
+    if frames:
+        for i, detections in zip(frames, run_frame_inference([items[i][0] for i in frames], app.state.model)):
+            results[i] = detections
+    sequences = [i for i, (source, _) in enumerate(items) if isinstance(source, tuple)]
+    if sequences:
+        seqs = [list(items[i][0]) for i in sequences]
+        for i, detections in zip(sequences, run_sequence_inference(seqs, app.state.model)):
+            results[i] = detections
+    for tiled in (False, True):
+        indices = [i for i, (source, t) in enumerate(items) if t == tiled and isinstance(source, str)]
+        if not indices:
+            continue
+        paths = [items[i][0] for i in indices]
+        detections = run_batch_inference(paths, app.state.model, PIPELINE_BATCH_SIZE, tiled=tiled)
+        for i, dets in zip(indices, detections):
+            results[i] = dets
+    return results
+
+
+async def prefiltered_detections(cur, user_id, image_ids, file_paths, tiled=False):
+    # Files are checked BATCH_SIZE at a time against the background of their camera, built from the user's
+    # earlier images; likely-empty files get no detections without a forward pass, except for the audit sample.
+    # Every outcome is recorded in prefilter_results
+    loop = asyncio.get_running_loop()
+    prefilter = make_prefilter(user_id)
+    results = []
+    for start in range(0, len(file_paths), BATCH_SIZE):
+        ids, paths = image_ids[start:start + BATCH_SIZE], file_paths[start:start + BATCH_SIZE]
+        checks = await loop.run_in_executor(None, lambda: [prefilter.check(path) for path in paths])
+        run = [i for i, (_, empty, audit) in enumerate(checks) if not empty or audit]
+        detected = await asyncio.gather(
+            *(app.state.detection_scheduler.submit((paths[i], tiled)) for i in run)
+        )
+        chunk = [[] for _ in paths]  # skipped files have no detections
+        for i, detections in zip(run, detected):
+            chunk[i] = detections
+            if detections is not None:
+                prefilter.update(paths[i], len(detections))
+
+        for i, (image_id, (score, empty, audit)) in enumerate(zip(ids, checks)):
+            skipped = empty and not audit
+            cur.execute(
+                """
+                INSERT INTO prefilter_results (image_id, score, empty, audited, detections) 
+                VALUES (%s, %s, %s, %s, %s)
+                """,
+                (image_id, score, empty, audit, None if skipped or chunk[i] is None else len(chunk[i]))
+            )
+        results.extend(chunk)
+    prefilter.log()
+    return results
+
+
+async def insert_batch_detections(cur, user_id, image_ids, file_paths, tiled=False):
+    # Each file is queued separately so uploads from concurrent sessions share forward passes
+    if PREFILTER:
+        results = await prefiltered_detections(cur, user_id, image_ids, file_paths, tiled)
+    else:
+        results = await asyncio.gather(*(app.state.detection_scheduler.submit((path, tiled)) for path in file_paths))
+    for image_id, detections in zip(image_ids, results):
+        if detections is None:
+            logger.error(f"Inference error for image {image_id}")
+            continue
+        insert_boxes(cur, image_id, detections)
+
+
+async def insert_sequence_detections(cur, user_id, image_ids, file_paths):
+    # Images are grouped into bursts by EXIF capture time and camera; each burst is one scheduler item,
+    # detected on its first image and tracked through the rest. Stores the sequences, their images and
+    # species summaries, returns the sequence ids
+    loop = asyncio.get_running_loop()
+    sequences = await loop.run_in_executor(None, read_sequences, file_paths)
+    results = await asyncio.gather(
+        *(app.state.detection_scheduler.submit((tuple(seq["paths"]), False)) for seq in sequences)
+    )
+    sequence_ids = []
+    for seq, seq_results in zip(sequences, results):
+        cur.execute(
+            """
+            INSERT INTO sequences (user_id, camera, start_time, end_time, image_count) 
+            VALUES (%s, %s, to_timestamp(%s), to_timestamp(%s), %s) 
+            RETURNING id
+            """,
+            (user_id, seq["camera"], seq["start"], seq["end"], len(seq["indices"]))
+        )
+        sequence_id = cur.fetchone()[0]
+        sequence_ids.append(sequence_id)
+
+        for position, (i, result) in enumerate(zip(seq["indices"], seq_results)):
+            cur.execute(
+                "INSERT INTO sequence_images (sequence_id, image_id, position, tracked) VALUES (%s, %s, %s, %s)",
+                (sequence_id, image_ids[i], position, bool(result and result["tracked"]))
+            )
+            if result is None:
+                logger.error(f"Inference error for image {image_ids[i]}")
+                continue
+            insert_boxes(cur, image_ids[i], result["detections"])
+
+        for species in sequence_summary([result["detections"] for result in seq_results if result]):
+            cur.execute(
+                """
+                INSERT INTO sequence_species (sequence_id, class_id, max_count, images, max_confidence) 
+                VALUES (%s, %s, %s, %s, %s)
+                """,
+                (sequence_id, species["class_id"], species["max_count"], species["images"],
+                 species["max_confidence"])
+            )
+    return sequence_ids
+
+
+async def insert_detections(cur, user_id, image_ids, file_paths, tiled=False, sequences=False):
+    # Sequence grouping replaces both tiling and the prefilter, the tracker already skips unchanged frames
+    response = {"uploaded_image_ids": image_ids}
+    if sequences:
+        response["sequence_ids"] = await insert_sequence_detections(cur, user_id, image_ids, file_paths)
+    else:
+        await insert_batch_detections(cur, user_id, image_ids, file_paths, tiled)
+    return response
+
+
 @app.post("/images/ObjectDetection/")
 async def upload_images(
     request: Request,
-    files: List[UploadFile] = File(...)
+    files: List[UploadFile] = File(...),
+    tiled: bool = False,
+    sequences: bool = False
 ):
     user_id = await get_user_id(request)
     try:
         with psycopg2.connect(**DB_CONFIG, cursor_factory=DictCursor) as conn:
             with conn.cursor() as cur:
                 uploaded_ids = []
+                file_paths = []
                 for file in files:
                     unique_filename = f"{uuid.uuid4()}_{file.filename}"
                     file_path = os.path.join(UPLOAD_DIR, unique_filename)
@@ -181,37 +425,23 @@ async def upload_images(
                     )
                     image_id = cur.fetchone()[0]
                     uploaded_ids.append(image_id)
-                    
-                    try:
-                        detections = run_inference(image_path=file_path, model=app.state.model)
-                        for box in detections:
-                            cur.execute(
-                                """
-                                INSERT INTO boxes (image_id, class_id, x, y, width, height, confidence) 
-                                VALUES (%s, %s, %s, %s, %s, %s, %s)
-                                """,
-                                (
-                                    image_id,
-                                    box['class_id'],
-                                    box['x'],
-                                    box['y'],
-                                    box['width'],
-                                    box['height'],
-                                    box['confidence']
-                                )
-                            )
-                    except Exception as infer_err:
-                        logger.error(f"Inference error for image {image_id}: {infer_err}")
+                    file_paths.append(file_path)
                 
+                response = await insert_detections(cur, user_id, uploaded_ids, file_paths, tiled, sequences)
                 conn.commit()
-                return {"uploaded_image_ids": uploaded_ids}
+                return response
     except Exception as e:
         logger.error(f"Upload error: {e}")
         return {"error": str(e)}
 
 
 @app.post("/folders/ObjectDetection/")
-async def upload_folder(request: Request, folder: UploadFile = File(...)):
+async def upload_folder(
+    request: Request,
+    folder: UploadFile = File(...),
+    tiled: bool = False,
+    sequences: bool = False
+):
     if not folder.filename.endswith('.zip'):
         raise HTTPException(status_code=400, detail="Only ZIP files are allowed")
         
@@ -224,6 +454,7 @@ async def upload_folder(request: Request, folder: UploadFile = File(...)):
             buffer.write(content)
             
         uploaded_ids = []
+        file_paths = []
         with psycopg2.connect(**DB_CONFIG, cursor_factory=DictCursor) as conn:
             with conn.cursor() as cur:
                 with ZipFile(temp_zip) as zip_ref:
@@ -247,35 +478,16 @@ async def upload_folder(request: Request, folder: UploadFile = File(...)):
                             )
                             image_id = cur.fetchone()[0]
                             uploaded_ids.append(image_id)
-                            logger.error(f"ddd{user_id}")
-                            try:
-                                detections = run_inference(image_path=file_path, model=app.state.model)
-                                for box in detections:
-                                    cur.execute(
-                                        """
-                                        INSERT INTO boxes (image_id, class_id, x, y, width, height, confidence) 
-                                        VALUES (%s, %s, %s, %s, %s, %s, %s)
-                                        """,
-                                        (
-                                            image_id,
-                                            box['class_id'],
-                                            box['x'],
-                                            box['y'],
-                                            box['width'],
-                                            box['height'],
-                                            box['confidence']
-                                        )
-                                    )
-                            except Exception as infer_err:
-                                logger.error(f"Inference error for image {image_id}: {infer_err}")
+                            file_paths.append(file_path)
                 
+                response = await insert_detections(cur, user_id, uploaded_ids, file_paths, tiled, sequences)
                 conn.commit()
         
         os.remove(temp_zip)
         
         return {
             "message": "Folder uploaded successfully",
-            "uploaded_image_ids": uploaded_ids
+            **response
         }
         
     except Exception as e:
@@ -285,6 +497,191 @@ async def upload_folder(request: Request, folder: UploadFile = File(...)):
         return {"error": str(e)}
 
 
+async def insert_video_detections(cur, video_id, file_path):
+    # Keyframes are decoded BATCH_SIZE at a time in a worker thread, so a long clip is never held in memory,
+    # and queued one by one like image uploads. Returns the number of keyframes
+    loop = asyncio.get_running_loop()
+    keyframes = read_keyframes(file_path)
+    n = 0
+    while True:
+        chunk = await loop.run_in_executor(None, lambda: list(islice(keyframes, BATCH_SIZE)))
+        if not chunk:
+            return n
+        results = await asyncio.gather(
+            *(app.state.detection_scheduler.submit((frame, False)) for *_, frame in chunk)
+        )
+        for (frame_index, timestamp, score, _), detections in zip(chunk, results):
+            cur.execute(
+                """
+                INSERT INTO video_frames (image_id, frame_index, timestamp_sec, scene_score) 
+                VALUES (%s, %s, %s, %s) 
+                RETURNING id
+                """,
+                (video_id, frame_index, timestamp, score)
+            )
+            frame_id = cur.fetchone()[0]
+            if detections is None:
+                logger.error(f"Inference error for frame {frame_index} of video {video_id}")
+                continue
+            insert_boxes(cur, frame_id, detections, table="frame_boxes", key="frame_id")
+        n += len(chunk)
+
+
+@app.post("/videos/ObjectDetection/")
+async def upload_video(request: Request, file: UploadFile = File(...)):
+    if not file.filename.lower().endswith(tuple(f".{ext}" for ext in VID_FORMATS)):
+        raise HTTPException(status_code=400, detail=f"Only video files are allowed ({', '.join(VID_FORMATS)})")
+
+    user_id = await get_user_id(request)
+    try:
+        with psycopg2.connect(**DB_CONFIG, cursor_factory=DictCursor) as conn:
+            with conn.cursor() as cur:
+                unique_filename = f"{uuid.uuid4()}_{file.filename}"
+                file_path = os.path.join(UPLOAD_DIR, unique_filename)
+
+                with open(file_path, "wb") as buffer:
+                    while chunk := await file.read(1 << 20):
+                        buffer.write(chunk)
+
+                cur.execute(
+                    """
+                    INSERT INTO images (filename, filepath, user_id, model_type) 
+                    VALUES (%s, %s, %s, 3) 
+                    RETURNING id
+                    """,
+                    (unique_filename, file_path, user_id)
+                )
+                video_id = cur.fetchone()[0]
+
+                keyframes = await insert_video_detections(cur, video_id, file_path)
+                conn.commit()
+                logger.info(f"Video {video_id}: detection run on {keyframes} keyframes")
+                return {"uploaded_video_id": video_id, "keyframes": keyframes}
+    except Exception as e:
+        logger.error(f"Video upload error: {e}")
+        return {"error": str(e)}
+
+
+@app.get("/videos/ObjectDetection/")
+async def get_videos(request: Request, video_id: Optional[int] = None):
+    user_id = await get_user_id(request)
+    try:
+        with psycopg2.connect(**DB_CONFIG, cursor_factory=DictCursor) as conn:
+            with conn.cursor() as cur:
+                if video_id:
+                    cur.execute(
+                        "SELECT filepath FROM images WHERE id = %s AND user_id = %s AND model_type = 3",
+                        (video_id, user_id)
+                    )
+                    result = cur.fetchone()
+                    if not result:
+                        raise HTTPException(status_code=404, detail="Video not found")
+
+                    file_path = result['filepath']
+                    if not os.path.exists(file_path):
+                        raise HTTPException(status_code=404, detail="Video file not found")
+                    return FileResponse(file_path)
+
+                cur.execute(
+                    "SELECT id FROM images WHERE user_id = %s AND model_type = 3",
+                    (user_id,)
+                )
+                return {"video_ids": [row[0] for row in cur.fetchall()]}
+    except HTTPException as he:
+        raise he
+    except Exception as e:
+        logger.error(f"Database error: {e}")
+        return {"error": str(e)}
+
+
+@app.get("/videos/ObjectDetection/{video_id}/frames")
+async def get_video_frames(request: Request, video_id: int):
+    # Keyframes in playback order, each with its timestamp and bounding boxes
+    user_id = await get_user_id(request)
+    try:
+        with psycopg2.connect(**DB_CONFIG, cursor_factory=DictCursor) as conn:
+            with conn.cursor() as cur:
+                cur.execute("""
+                    SELECT f.id, f.frame_index, f.timestamp_sec, f.scene_score FROM video_frames f
+                    JOIN images i ON f.image_id = i.id
+                    WHERE i.id = %s AND i.user_id = %s AND i.model_type = 3
+                    ORDER BY f.frame_index
+                """, (video_id, user_id))
+                frames = {row['id']: {**dict(row), "boxes": []} for row in cur.fetchall()}
+                if frames:
+                    cur.execute(
+                        "SELECT * FROM frame_boxes WHERE frame_id = ANY(%s) ORDER BY id",
+                        (list(frames),)
+                    )
+                    for box in cur.fetchall():
+                        frames[box['frame_id']]["boxes"].append(dict(box))
+                return {"frames": list(frames.values())}
+    except Exception as e:
+        logger.error(f"Database error: {e}")
+        return {"error": str(e)}
+
+
+@app.get("/sequences/ObjectDetection/")
+async def get_sequences(request: Request):
+    # The user's burst sequences in capture order, with their images and species summary
+    user_id = await get_user_id(request)
+    try:
+        with psycopg2.connect(**DB_CONFIG, cursor_factory=DictCursor) as conn:
+            with conn.cursor() as cur:
+                cur.execute("""
+                    SELECT id, camera, start_time, end_time, image_count FROM sequences
+                    WHERE user_id = %s
+                    ORDER BY start_time, id
+                """, (user_id,))
+                sequences = {row['id']: {**dict(row), "images": [], "species": []} for row in cur.fetchall()}
+                if sequences:
+                    cur.execute("""
+                        SELECT sequence_id, image_id, tracked FROM sequence_images
+                        WHERE sequence_id = ANY(%s)
+                        ORDER BY sequence_id, position
+                    """, (list(sequences),))
+                    for row in cur.fetchall():
+                        sequences[row['sequence_id']]["images"].append(
+                            {"image_id": row['image_id'], "tracked": row['tracked']}
+                        )
+                    cur.execute("""
+                        SELECT sequence_id, class_id, max_count, images, max_confidence FROM sequence_species
+                        WHERE sequence_id = ANY(%s)
+                        ORDER BY sequence_id, class_id
+                    """, (list(sequences),))
+                    for row in cur.fetchall():
+                        species = dict(row)
+                        sequences[species.pop('sequence_id')]["species"].append(species)
+                return {"sequences": list(sequences.values())}
+    except Exception as e:
+        logger.error(f"Database error: {e}")
+        return {"error": str(e)}
+
+
+@app.get("/metrics/prefilter")
+async def get_prefilter_metrics():
+    # Skip rate: likely-empty images that never reached the detector. Audit miss rate: audited likely-empty
+    # images on which the detector still found something
+    try:
+        with psycopg2.connect(**DB_CONFIG, cursor_factory=DictCursor) as conn:
+            with conn.cursor() as cur:
+                cur.execute("""
+                    SELECT COUNT(*) AS images,
+                           COUNT(*) FILTER (WHERE empty) AS empty,
+                           COUNT(*) FILTER (WHERE empty AND NOT audited) AS skipped,
+                           COUNT(*) FILTER (WHERE audited) AS audited,
+                           COUNT(*) FILTER (WHERE audited AND detections > 0) AS audit_misses
+                    FROM prefilter_results
+                """)
+                metrics = dict(cur.fetchone())
+                metrics["skip_rate"] = metrics["skipped"] / max(metrics["images"], 1)
+                metrics["audit_miss_rate"] = metrics["audit_misses"] / max(metrics["audited"], 1)
+                return metrics
+    except Exception as e:
+        logger.error(f"Database error: {e}")
+        return {"error": str(e)}
+
+
 @app.post("/images/ObjectDetection/{image_id}/bounding-boxes")
 async def upload_boxes(request: Request, image_id: int, boxes: List[dict]):
     user_id = await get_user_id(request)
@@ -410,41 +807,111 @@ async def download_all_images(request: Request):
 
 #BIRD COUNT
 
-def helper_get_heatmap(file: UploadFile = File(...)):
-    image = Image.open(file.file)
-    count, elapsed_time, heatmap_file, cluster_centers, image_dimensions,subgrid_counts,pred_cnt_flt,subgridcounts_error = demo.run_demo_image_nomongo(image)
-    return heatmap_file
+def run_birdcount_batch(items):
+    # items are (image, outputs, cluster_levels) for demo.analyze_image, the model is loaded first if needed
+    with birdcount.use() as demo:
+        results = []
+        for image, outputs, cluster_levels in items:
+            try:
+                results.append(demo.analyze_image(image, outputs, cluster_levels))
+            except Exception as e:
+                results.append(e)
+    return results
+
+
+def count_scheduler(image):
+    # The BirdCount scheduler of an image: with several workers, the same image content always goes to the same
+    # one, whose caches hold its latents and cluster sets
+    schedulers = app.state.count_schedulers
+    if len(schedulers) == 1:
+        return schedulers[0]
+    digest = hashlib.blake2b(image.tobytes(), digest_size=8).digest()
+    return schedulers[int.from_bytes(digest, "little") % len(schedulers)]
+
+
+async def run_birdcount(image, outputs=ANALYSIS_OUTPUTS, cluster_levels=None):
+    # One model run per image, only the requested outputs (and cluster sets, by index) are computed
+    levels = None if cluster_levels is None else tuple(cluster_levels)
+    return await count_scheduler(image).submit((image, tuple(outputs), levels))
+
+
+def cluster_levels_param(levels):
+    # Parsed cluster_levels query parameter, None (all levels) when not given
+    if levels is None:
+        return None
+    try:
+        return parse_levels(levels)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
 
 
-@app.post("/model_heatmap/")
-async def predict(file: UploadFile = File(...)):
-    heatmap_file=helper_get_heatmap(file)
+def heatmap_png(heatmap_file):
     to_pil = transforms.ToPILImage()
     image = to_pil(heatmap_file)
     buffer = io.BytesIO()
     image.save(buffer, format="PNG")
-    buffer.seek(0)
-    return Response(content=buffer.getvalue(), media_type="image/png")
+    return buffer.getvalue()
+
+
+@app.post("/model_analysis/")
+async def analyze_birdcount(file: UploadFile = File(...), outputs: str = ",".join(ANALYSIS_OUTPUTS),
+                            cluster_levels: Optional[str] = None):
+    # Runs the bird counting model once and returns the requested outputs (comma separated):
+    # count, grid (3x3 subgrid counts as [int, decimal part]), clusters (cluster centers sets in image pixels,
+    # only those in cluster_levels, comma separated indices into /model_clusters/parameters, the others null)
+    # and heatmap (base64 encoded PNG)
+    requested = [o.strip() for o in outputs.split(",") if o.strip()]
+    unknown = set(requested) - set(ANALYSIS_OUTPUTS)
+    if not requested or unknown:
+        raise HTTPException(status_code=400, detail=f"outputs must be a comma separated subset of "
+                                                    f"{', '.join(ANALYSIS_OUTPUTS)}")
+    levels = cluster_levels_param(cluster_levels)
+    image = Image.open(file.file)
+    result = await run_birdcount(image, requested, levels)
+    response = {"image_size": {"width": image.width, "height": image.height},
+                "elapsed_time": result["elapsed_time"]}
+    if "count" in result:
+        response["count"] = result["count"]
+        response["rounded_count"] = result["count_int"]
+    if "grid" in result:
+        response["grid"] = result["grid"]
+    if "clusters" in result:
+        tensor_height, tensor_width = result["image_size"]
+        response["clusters"] = [None if centers is None else
+                                scale_coordinates(centers, (tensor_width, tensor_height), image.size)
+                                for centers in result["clusters"]]
+    if "heatmap" in result:
+        response["heatmap"] = base64.b64encode(heatmap_png(result["heatmap"])).decode()
+    return response
+
+
+async def helper_get_heatmap(file: UploadFile = File(...)):
+    result = await run_birdcount(Image.open(file.file), ["heatmap"])
+    return result["heatmap"]
 
 
-def helper_get_gridmap(file: UploadFile = File(...)):
-    image = Image.open(file.file)
-    count, elapsed_time, heatmap_file, cluster_centers, image_dimensions,subgrid_counts,pred_cnt_flt,subgridcounts_error = demo.run_demo_image_nomongo(image)
-    return subgridcounts_error
+@app.post("/model_heatmap/")
+async def predict(file: UploadFile = File(...)):
+    heatmap_file=await helper_get_heatmap(file)
+    return Response(content=heatmap_png(heatmap_file), media_type="image/png")
+
+
+async def helper_get_gridmap(file: UploadFile = File(...)):
+    result = await run_birdcount(Image.open(file.file), ["grid"])
+    return result["grid"]
 
 @app.post("/model_gridmap/")
 async def predict(file: UploadFile = File(...)):
-    gridmap=helper_get_gridmap(file)
+    gridmap=await helper_get_gridmap(file)
     return gridmap
 
-def helper_get_count(file: UploadFile = File(...)):
-    image = Image.open(file.file)
-    count, elapsed_time, heatmap_file, cluster_centers, image_dimensions,subgrid_counts,pred_cnt_flt,subgridcounts_error = demo.run_demo_image_nomongo(image)
-    return pred_cnt_flt
+async def helper_get_count(file: UploadFile = File(...)):
+    result = await run_birdcount(Image.open(file.file), ["count"])
+    return result["count"]
 
 @app.post("/model_count/")
 async def predict(file: UploadFile = File(...)):
-    count=helper_get_count(file)
+    count=await helper_get_count(file)
     return count
 
 def scale_coordinates(cluster_centers, original_size, target_size):
@@ -461,30 +928,47 @@ def scale_coordinates(cluster_centers, original_size, target_size):
     ]
     return scaled_points
 
-def helper_get_cluster1(file: UploadFile = File(...)):
+async def helper_get_cluster1(file: UploadFile = File(...)):
     image = Image.open(file.file)
     original_tensor_size = (480, 384)  # Tensor size (width, height)
     target_image_size = image.size  # Actual image size (width, height)
     print(image.size)
 
-    # Replace the demo logic with the real function generating cluster centers
-    count, elapsed_time, heatmap_file, cluster_centers, image_dimensions, subgrid_counts, pred_cnt_flt, subgridcounts_error = demo.run_demo_image_nomongo(image)
-    print(len(cluster_centers[0]))
+    cluster_centers = (await run_birdcount(image, ["clusters"], [3]))["clusters"]
     # Scale the cluster centers
     scaled_cluster_centers = scale_coordinates(cluster_centers[3], original_tensor_size, target_image_size)
     print(len(scaled_cluster_centers))
     return scaled_cluster_centers
 
-def helper_get_cluster2(file: UploadFile = File(...)):
-    image = Image.open(file.file)
-    count, elapsed_time, heatmap_file, cluster_centers, image_dimensions,subgrid_counts,pred_cnt_flt,subgridcounts_error = demo.run_demo_image_nomongo(image)
-    return cluster_centers
+async def helper_get_cluster2(file: UploadFile = File(...)):
+    result = await run_birdcount(Image.open(file.file), ["clusters"])
+    return result["clusters"]
 
 @app.post("/model_cluster/")
 async def predict(file: UploadFile = File(...)):
-    cluster_centers=helper_get_cluster1(file)
+    cluster_centers=await helper_get_cluster1(file)
     return cluster_centers
 
+
+@app.get("/model_clusters/parameters")
+async def get_cluster_parameters():
+    # The cluster sets that can be requested, by index, from fine to coarse
+    return [{"level": level, **param} for level, param in enumerate(CLUSTER_PARAMETERS)]
+
+
+@app.post("/model_clusters/")
+async def get_cluster_sets(file: UploadFile = File(...), levels: str = "3"):
+    # Cluster centers of the requested levels (comma separated indices) in image pixels. The cluster sets of recent
+    # images are cached, so fetching other levels of the same image later does not run the model again
+    requested = cluster_levels_param(levels)
+    image = Image.open(file.file)
+    result = await run_birdcount(image, ["clusters"], requested)
+    tensor_height, tensor_width = result["image_size"]
+    return {"image_size": {"width": image.width, "height": image.height},
+            "elapsed_time": result["elapsed_time"],
+            "clusters": {level: scale_coordinates(result["clusters"][level], (tensor_width, tensor_height), image.size)
+                         for level in requested}}
+
 @app.get("/images/BirdCount/")
 async def get_images_birdcount(request: Request, image_id: Optional[int] = None):
     user_id = await get_user_id(request)
@@ -561,7 +1045,7 @@ async def upload_images_BirdCount(
                     image_id = cur.fetchone()[0]
                     
                     try:
-                        cluster_centers=helper_get_cluster1(file)
+                        cluster_centers=await helper_get_cluster1(file)
                         print(cluster_centers)
                         image = Image.open(file.file)
                         target_image_size = image.size 
@@ -628,7 +1112,7 @@ async def upload_folder_birdcount(request: Request, folder: UploadFile = File(..
                             uploaded_ids.append(image_id)
                 
                             try:
-                                cluster_centers=helper_get_cluster1(file_info)
+                                cluster_centers=await helper_get_cluster1(file_info)
                                 image = Image.open(file_info.file)
                                 target_image_size = image.size 
                                 target_width, target_height = target_image_size
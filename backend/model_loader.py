@@ -0,0 +1,131 @@
+import gc
+import importlib
+import logging
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+import torch
+
+logger = logging.getLogger(__name__)
+
+
+class ModelLoader:
+    """Imports a module that loads a model at import time, in the background and on demand.
+
+    start() begins the import in a background thread so the API can serve
+    other traffic meanwhile; `with loader.use() as module:` waits for it,
+    importing again if the module was unloaded. With idle_timeout (seconds)
+    the module is dropped after that long without use, freeing the model's
+    memory until the next request. status() reports the state for readiness
+    checks: not loaded, loading, ready, unloaded or failed.
+    """
+
+    def __init__(self, module, name, idle_timeout=0):
+        self.module = module
+        self.name = name
+        self.idle_timeout = idle_timeout
+        self.value = None
+        self.state = "not loaded"
+        self.error = None
+        self.load_seconds = None
+        self.last_used = time.monotonic()
+        self.users = 0
+        self.cond = threading.Condition()
+        self.evictor = None
+        self.stopping = False
+
+    def start(self, background=True):
+        # Begins loading; blocks until loaded (or failed) when background is False
+        with self.cond:
+            load = self.state not in ("loading", "ready")
+            if load:
+                self.state = "loading"
+        if load and background:
+            threading.Thread(target=self._load, name=f"{self.name}-loader", daemon=True).start()
+        elif load:
+            self._load()
+        if not background:
+            with self.cond:
+                self.cond.wait_for(lambda: self.state != "loading")
+        if self.idle_timeout > 0 and self.evictor is None:
+            self.evictor = threading.Thread(target=self._evict_idle, name=f"{self.name}-evictor", daemon=True)
+            self.evictor.start()
+
+    def _forget(self):
+        # Drop the module so the next import runs it again and nothing keeps its model alive
+        sys.modules.pop(self.module, None)
+        parent, _, child = self.module.rpartition(".")
+        if parent in sys.modules and hasattr(sys.modules[parent], child):
+            delattr(sys.modules[parent], child)
+
+    def _load(self):
+        t = time.perf_counter()
+        try:
+            value = importlib.import_module(self.module)
+        except Exception as e:
+            logger.error(f"{self.name}: loading failed: {e}")
+            self._forget()  # let the next attempt import it again
+            with self.cond:
+                self.state, self.error = "failed", str(e)
+                self.cond.notify_all()
+            return
+        with self.cond:
+            self.value, self.state, self.error = value, "ready", None
+            self.load_seconds = time.perf_counter() - t
+            self.last_used = time.monotonic()
+            self.cond.notify_all()
+        logger.info(f"{self.name}: loaded in {self.load_seconds:.1f}s")
+
+    @contextmanager
+    def use(self):
+        with self.cond:
+            if self.state in ("not loaded", "unloaded", "failed"):
+                self.state = "loading"
+                threading.Thread(target=self._load, name=f"{self.name}-loader", daemon=True).start()
+            self.cond.wait_for(lambda: self.state != "loading")
+            if self.state != "ready":
+                raise RuntimeError(f"{self.name} is not available: {self.error}")
+            self.users += 1
+        try:
+            yield self.value
+        finally:
+            with self.cond:
+                self.users -= 1
+                self.last_used = time.monotonic()
+
+    def unload(self):
+        with self.cond:
+            if self.state != "ready" or self.users:
+                return False
+            self.value, self.state = None, "unloaded"
+            self._forget()
+        gc.collect()
+        if torch.cuda.is_available() and torch.cuda.is_initialized():
+            torch.cuda.empty_cache()
+        logger.info(f"{self.name}: unloaded after {self.idle_timeout:.0f}s idle")
+        return True
+
+    def _evict_idle(self):
+        while not self.stopping:
+            time.sleep(min(self.idle_timeout, 30))
+            with self.cond:
+                idle = self.state == "ready" and not self.users and \
+                    time.monotonic() - self.last_used > self.idle_timeout
+            if idle:
+                self.unload()
+
+    def stop(self):
+        self.stopping = True
+
+    def status(self):
+        with self.cond:
+            status = {"state": self.state, "ready": self.state == "ready"}
+            if self.load_seconds is not None:
+                status["load_seconds"] = round(self.load_seconds, 1)
+            if self.state == "ready":
+                status["idle_seconds"] = round(time.monotonic() - self.last_used, 1)
+            if self.error:
+                status["error"] = self.error
+            return status
@@ -0,0 +1,119 @@
+import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class BatchScheduler:
+    """Merges single-item inference requests from concurrent sessions into batches.
+
+    Callers await `submit(item)`. A background task takes the first queued item,
+    waits up to `max_wait_ms` for more (at most `max_batch_size` in total), runs
+    `batch_fn(items)` in a worker thread and resolves every caller's future with
+    its own entry of the returned list. An entry that is an Exception instance is
+    raised in that caller only. Batches run one at a time, so the shared
+    model never sees two forward passes at once.
+
+    With `runner` (an async callable taking batch_fn and the items, e.g.
+    InferencePool.run) batches run there instead, up to `concurrency` at a
+    time; the next batch is only collected once one of them finishes.
+    """
+
+    def __init__(self, batch_fn, max_batch_size=16, max_wait_ms=10, name="scheduler", runner=None, concurrency=1):
+        self.batch_fn = batch_fn
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.name = name
+        self.runner = runner or self._run_in_thread
+        self.concurrency = concurrency
+        self.queue = None
+        self.task = None
+        self.running = set()
+        self.collecting = []  # items taken off the queue for the next batch
+
+    def start(self):
+        self.queue = asyncio.Queue()
+        self.task = asyncio.create_task(self._run())
+        logger.info(f"{self.name}: started (max_batch_size={self.max_batch_size}, max_wait={self.max_wait * 1000:g}ms, "
+                    f"concurrency={self.concurrency})")
+
+    async def stop(self):
+        # Cancels collecting and running batches; every caller still waiting gets a RuntimeError
+        if self.task is None:
+            return
+        self.task.cancel()
+        running = list(self.running)
+        for task in running:
+            task.cancel()
+        await asyncio.gather(self.task, *running, return_exceptions=True)
+        stopped = RuntimeError(f"{self.name} stopped")
+        self._fail(self.collecting, stopped)
+        self.collecting = []
+        while not self.queue.empty():
+            self._fail([self.queue.get_nowait()], stopped)
+        self.task = None
+
+    @staticmethod
+    def _fail(batch, err):
+        for _, future in batch:
+            if not future.done():
+                future.set_exception(err)
+
+    async def submit(self, item):
+        if self.task is None:
+            raise RuntimeError(f"{self.name} is not running")
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((item, future))
+        return await future
+
+    async def _collect(self):
+        loop = asyncio.get_running_loop()
+        self.collecting = batch = [await self.queue.get()]
+        deadline = loop.time() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            if not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+                continue
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def _run_in_thread(self, batch_fn, items):
+        return await asyncio.get_running_loop().run_in_executor(None, batch_fn, items)
+
+    async def _run(self):
+        slots = asyncio.Semaphore(self.concurrency)
+        while True:
+            await slots.acquire()
+            batch = await self._collect()
+            self.collecting = []
+            task = asyncio.create_task(self._run_batch(batch))
+            self.running.add(task)
+            task.add_done_callback(self.running.discard)
+            task.add_done_callback(lambda _: slots.release())
+
+    async def _run_batch(self, batch):
+        items = [item for item, _ in batch]
+        try:
+            results = await self.runner(self.batch_fn, items)
+        except asyncio.CancelledError:
+            self._fail(batch, RuntimeError(f"{self.name} stopped"))
+            raise
+        except Exception as err:
+            logger.error(f"{self.name}: batch of {len(items)} failed: {err}")
+            self._fail(batch, err)
+            return
+
+        logger.debug(f"{self.name}: ran batch of {len(items)}")
+        for (_, future), result in zip(batch, results):
+            if future.done():
+                continue
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
@@ -0,0 +1,47 @@
+import asyncio
+
+import pytest
+
+from scheduler import BatchScheduler
+
+
+def test_batches_resolve_every_caller():
+    async def run():
+        scheduler = BatchScheduler(lambda items: [i * 2 for i in items], max_batch_size=4, name="double")
+        scheduler.start()
+        try:
+            return await asyncio.gather(*(scheduler.submit(i) for i in range(10)))
+        finally:
+            await scheduler.stop()
+
+    assert asyncio.run(run()) == [i * 2 for i in range(10)]
+
+
+def test_stop_fails_running_and_collecting_batches():
+    async def slow(batch_fn, items):
+        await asyncio.sleep(10)
+        return batch_fn(items)
+
+    async def run():
+        # Items 0 and 1 are a running batch, 2 is being collected into the next one and 3 is still queued
+        scheduler = BatchScheduler(lambda items: items, max_batch_size=2, max_wait_ms=1000, name="slow", runner=slow,
+                                   concurrency=1)
+        scheduler.start()
+        requests = [asyncio.create_task(scheduler.submit(i)) for i in range(4)]
+        await asyncio.sleep(0.05)
+        await scheduler.stop()
+        return await asyncio.wait_for(asyncio.gather(*requests, return_exceptions=True), 1)
+
+    results = asyncio.run(run())
+    assert all(isinstance(r, RuntimeError) for r in results)
+
+
+def test_submit_after_stop_raises():
+    async def run():
+        scheduler = BatchScheduler(lambda items: items, name="stopped")
+        scheduler.start()
+        await scheduler.stop()
+        await scheduler.submit(1)
+
+    with pytest.raises(RuntimeError):
+        asyncio.run(run())
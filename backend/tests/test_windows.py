@@ -0,0 +1,40 @@
+import pytest
+import torch
+
+from BirdCount.model_files.benchmarks import StubModel, legacy_density
+from BirdCount.model_files.windows import WINDOW, sliding_window_density, window_starts
+
+
+@pytest.fixture(scope="module")
+def model():
+    return StubModel(depth=1).eval()
+
+
+@pytest.fixture(scope="module")
+def boxes():
+    return torch.rand(1, 3, 3, 64, 64, generator=torch.Generator().manual_seed(0))
+
+
+@pytest.mark.parametrize("width", [384, 400, 640, 2048])
+def test_sliding_window_density_matches_legacy_stitching(model, boxes, width):
+    samples = torch.rand(1, 3, WINDOW, width, generator=torch.Generator().manual_seed(width))
+    legacy = legacy_density(samples, boxes, model)
+    batched = sliding_window_density(samples, boxes, model)[0]
+    assert torch.allclose(batched, legacy, rtol=1e-5, atol=1e-5)
+
+
+@pytest.mark.parametrize("width", [400, 640, 2048])
+def test_last_window_is_aligned_to_the_right_edge(width):
+    starts = window_starts(width)
+    assert starts[-1] == width - WINDOW
+    assert all(b - a <= 128 for a, b in zip(starts, starts[1:]))
+
+
+def test_small_batches_match_one_batch(model, boxes):
+    samples = torch.rand(2, 3, WINDOW, 640, generator=torch.Generator().manual_seed(1))
+    assert torch.allclose(sliding_window_density(samples, boxes, model, max_batch=2),
+                          sliding_window_density(samples, boxes, model), rtol=1e-5, atol=1e-5)
+
+
+def test_narrow_image_has_empty_density(model, boxes):
+    assert not sliding_window_density(torch.rand(1, 3, WINDOW, 300), boxes, model).any()
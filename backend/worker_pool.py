@@ -0,0 +1,158 @@
+import asyncio
+import gc
+import itertools
+import logging
+import multiprocessing as mp
+import os
+import pickle
+import threading
+from multiprocessing.connection import wait
+
+import torch
+
+logger = logging.getLogger(__name__)
+
+
+def _worker(index, threads, tasks, conn):
+    # Runs in the forked child: take the next task from its queue, report start and result on conn
+    torch.set_num_threads(threads)
+    logger.info(f"inference-{index}: ready (pid {os.getpid()}, {threads} threads)")
+    while True:
+        msg = tasks.get()
+        if msg is None:
+            break
+        task_id, fn, args = pickle.loads(msg)
+        conn.send_bytes(pickle.dumps((task_id, False, None)))
+        try:
+            result = fn(*args)
+        except Exception as err:
+            result = err
+        try:
+            payload = pickle.dumps((task_id, True, result))
+        except Exception as err:
+            error = RuntimeError(f"{fn.__name__} returned an unpicklable result: {err}")
+            payload = pickle.dumps((task_id, True, error))
+        conn.send_bytes(payload)
+
+
+def _set_result(future, result):
+    if future.done():
+        return
+    if isinstance(result, BaseException):
+        future.set_exception(result)
+    else:
+        future.set_result(result)
+
+
+class InferencePool:
+    """Runs inference functions in worker processes forked after the models are loaded.
+
+    Load the models in the API process, then call start(): the `workers`
+    children share the weights copy-on-write instead of loading their own copy,
+    and each limits itself to `threads` intra-op threads. Callers await
+    `run(fn, *args)`. Each worker has its own task queue; a task goes to the
+    worker with the fewest unfinished tasks, or to worker `worker` when given,
+    e.g. so that requests for one image find the caches of the worker that
+    saw it before. fn is pickled by reference and runs against the
+    module state (e.g. the loaded models) as it was at fork time; its arguments
+    and result are pickled. A worker that dies fails its current task and is
+    forked again.
+    """
+
+    def __init__(self, workers, threads=0):
+        self.workers = workers
+        self.threads = threads or max(1, (os.cpu_count() or 1) // workers)
+        self.ctx = mp.get_context("fork")
+        self.tasks = []
+        self.load = [0] * workers  # unfinished tasks per worker
+        self.procs, self.conns, self.current = [], [], []
+        self.pending = {}
+        self.ids = itertools.count()
+        self.reader = None
+        self.stopping = False
+
+    def start(self):
+        if torch.cuda.is_initialized():
+            raise RuntimeError("Cannot fork inference workers after CUDA initialization")
+        gc.collect()
+        gc.freeze()  # keep the loaded models out of the children's garbage collector so their pages stay shared
+        self.tasks = [self.ctx.Queue() for _ in range(self.workers)]
+        self.procs, self.conns, self.current = [None] * self.workers, [None] * self.workers, [None] * self.workers
+        for i in range(self.workers):
+            self._fork(i)
+        self.reader = threading.Thread(target=self._read, name="inference-pool", daemon=True)
+        self.reader.start()
+        logger.info(f"inference pool: started {self.workers} workers with {self.threads} threads each")
+
+    def _fork(self, i):
+        receiver, sender = self.ctx.Pipe(duplex=False)
+        proc = self.ctx.Process(target=_worker, args=(i, self.threads, self.tasks[i], sender),
+                                name=f"inference-{i}", daemon=True)
+        proc.start()
+        sender.close()
+        self.procs[i], self.conns[i], self.current[i] = proc, receiver, None
+
+    async def run(self, fn, *args, worker=None):
+        if self.reader is None:
+            raise RuntimeError("inference pool is not running")
+        if worker is None:
+            worker = min(range(self.workers), key=self.load.__getitem__)
+        task_id = next(self.ids)
+        future = asyncio.get_running_loop().create_future()
+        self.pending[task_id] = future
+        self.load[worker] += 1
+        try:
+            self.tasks[worker].put(pickle.dumps((task_id, fn, args)))  # pickled here so errors reach the caller
+            return await future
+        finally:
+            self.load[worker] -= 1
+            self.pending.pop(task_id, None)
+
+    def _resolve(self, task_id, result):
+        future = self.pending.get(task_id)
+        if future is not None:
+            future.get_loop().call_soon_threadsafe(_set_result, future, result)
+
+    def _receive(self, i):
+        task_id, done, result = pickle.loads(self.conns[i].recv_bytes())
+        self.current[i] = None if done else task_id
+        if done:
+            self._resolve(task_id, result)
+
+    def _read(self):
+        # Results and worker deaths are handled in this thread, results are passed to the callers' event loops
+        while not self.stopping:
+            conns = {conn: i for i, conn in enumerate(self.conns)}
+            sentinels = {proc.sentinel: i for i, proc in enumerate(self.procs)}
+            ready = wait(list(conns) + list(sentinels), timeout=1)
+            for r in ready:  # results before deaths, a worker may have answered before exiting
+                if r in conns:
+                    try:
+                        self._receive(conns[r])
+                    except EOFError:
+                        pass
+            for r in ready:
+                if r in sentinels and not self.stopping:
+                    i = sentinels[r]
+                    self.procs[i].join(1)  # reap it for the exit code
+                    logger.error(f"inference-{i}: died with exit code {self.procs[i].exitcode}, restarting")
+                    if self.current[i] is not None:
+                        self._resolve(self.current[i], RuntimeError(f"inference worker {i} died"))
+                    self.conns[i].close()
+                    self._fork(i)
+
+    def stop(self, timeout=5):
+        if self.reader is None:
+            return
+        self.stopping = True
+        for tasks in self.tasks:
+            tasks.put(None)
+        for proc in self.procs:
+            proc.join(timeout)
+            if proc.is_alive():
+                proc.terminate()
+        self.reader.join(timeout)
+        for task_id in list(self.pending):
+            self._resolve(task_id, RuntimeError("inference pool stopped"))
+        self.reader = None
+        logger.info("inference pool: stopped")